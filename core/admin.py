@@ -1,5 +1,11 @@
+from itertools import groupby
+
 from django.contrib import admin
-from .models import Player, Match, RegistrationToken
+from django.db import transaction
+from django.utils.html import format_html, format_html_join
+from .models import Player, Match, RegistrationToken, RequestProfile
+from .pairs import remove_match
+from .recompute import recompute_suffix
 
 @admin.register(Player)
 class PlayerAdmin(admin.ModelAdmin):
@@ -19,6 +25,26 @@ class MatchAdmin(admin.ModelAdmin):
     search_fields = ('team1_player1__name', 'team1_player2__name', 'team2_player1__name', 'team2_player2__name')
     list_filter = ('date_played', 'result')
     ordering = ('-date_played',)
+    
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, Match.objects.filter(pk=obj.pk))
+    
+    def delete_queryset(self, request, queryset):
+        """
+        "Delete selected" deletes in SQL, bypassing Match.delete(), so its work is
+        done here for the whole selection: pair records are adjusted per match and
+        each year is re-rated once, from its earliest deleted match
+        """
+        with transaction.atomic():
+            Player.objects.lock()
+            deleted = list(queryset.order_by('year', 'date_played', 'id'))
+            Match.objects.filter(pk__in=[match.pk for match in deleted]).delete()
+            for match in deleted:
+                remove_match(match)
+            for year, year_matches in groupby(deleted, key=lambda match: match.year):
+                year_matches = list(year_matches)
+                first = year_matches[0]
+                recompute_suffix(year, first.date_played, first.pk, removed=year_matches)
 
 @admin.register(RegistrationToken)
 class RegistrationTokenAdmin(admin.ModelAdmin):
@@ -32,4 +58,49 @@ class RegistrationTokenAdmin(admin.ModelAdmin):
         # Make certain fields readonly when editing existing tokens
         if obj:  # editing an existing object
             return self.readonly_fields + ('created_by', 'expires_at')
-        return self.readonly_fields
\ No newline at end of file
+        return self.readonly_fields
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'method', 'path', 'view_name', 'status_code', 'duration_ms', 'query_count', 'query_time_ms', 'mode', 'user')
+    list_filter = ('mode', 'view_name', 'created_at')
+    search_fields = ('path', 'view_name')
+    ordering = ('-created_at',)
+    exclude = ('python_profile', 'queries')
+    readonly_fields = ('created_at', 'user', 'mode', 'method', 'path', 'view_name', 'status_code', 'duration_ms',
+                       'query_count', 'query_time_ms', 'slowest_queries', 'query_log', 'python_profile_report')
+    
+    def has_add_permission(self, request):
+        # Profiles are only captured from live requests
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def slowest_queries(self, obj):
+        """Total time per call site, the usual starting point for a slow page"""
+        totals = {}
+        for query in obj.queries:
+            count, duration = totals.get(query['call_site'], (0, 0))
+            totals[query['call_site']] = (count + 1, duration + query['duration_ms'])
+        rows = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+        return format_html(
+            '<table><tr><th>Call site</th><th>Queries</th><th>Total ms</th></tr>{}</table>',
+            format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td></tr>',
+                             ((site or '(framework)', count, round(duration, 1)) for site, (count, duration) in rows)),
+        )
+    slowest_queries.short_description = 'Query time by call site'
+    
+    def query_log(self, obj):
+        return format_html(
+            '<table><tr><th>#</th><th>ms</th><th>Call site</th><th>SQL</th></tr>{}</table>',
+            format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td><td><code>{}</code></td></tr>', (
+                (index, query['duration_ms'], query['call_site'], query['sql'])
+                for index, query in enumerate(obj.queries, 1)
+            )),
+        )
+    query_log.short_description = 'Queries'
+    
+    def python_profile_report(self, obj):
+        return format_html('<pre style="white-space: pre; overflow-x: auto;">{}</pre>', obj.python_profile)
+    python_profile_report.short_description = 'Python profile'
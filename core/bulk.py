@@ -0,0 +1,159 @@
+"""
+Bulk loading helpers for seeding and imports.
+
+On PostgreSQL rows are streamed into the table with COPY, which skips the
+per-instance work of bulk_create (model construction, field preparation and
+a parameter per value). Other backends fall back to bulk_create, so callers
+don't need to care which database they are running against.
+"""
+import csv
+import io
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import connection, transaction
+
+
+def truncate(*models):
+    """Empties the tables of `models`, and of anything that references them"""
+    if connection.vendor != 'postgresql':
+        for model in models:
+            model.objects.all().delete()
+        return
+    tables = ', '.join(connection.ops.quote_name(model._meta.db_table) for model in models)
+    with connection.cursor() as cursor:
+        cursor.execute(f"TRUNCATE {tables} CASCADE")
+
+
+def reserve_ids(model, count):
+    """Reserves `count` primary keys for `model`, for rows that reference each other before they are written"""
+    if count <= 0:
+        return []
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [table, count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+        # No sequence to draw from; only safe while nothing else inserts into the table
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)}")
+        first = cursor.fetchone()[0] + 1
+    return list(range(first, first + count))
+
+
+@contextmanager
+def foreign_keys_checked_after(*models):
+    """
+    Drops the foreign keys of the given models' tables for the duration of the
+    block and adds them back at the end, so loaded rows are validated in a single
+    pass per constraint instead of one deferred check per row.
+
+    Must be used inside a transaction, which keeps the tables locked meanwhile
+    and restores the constraints if anything fails. A no-op except on PostgreSQL.
+    """
+    if connection.vendor != 'postgresql':
+        yield
+        return
+
+    tables = [model._meta.db_table for model in models]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT conrelid::regclass::text, confrelid::regclass::text, conname, pg_get_constraintdef(oid) "
+            "FROM pg_constraint WHERE contype = 'f' AND conrelid = ANY(%s::regclass[])",
+            [tables],
+        )
+        constraints = cursor.fetchall()
+        for table, _, name, _ in constraints:
+            cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {connection.ops.quote_name(name)}")
+
+    yield
+
+    with connection.cursor() as cursor:
+        # Fresh statistics, or validation plans the join as if the tables were still empty
+        for table in sorted({table for constraint in constraints for table in constraint[:2]}):
+            cursor.execute(f"ANALYZE {table}")
+        for table, _, name, definition in constraints:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {connection.ops.quote_name(name)} {definition}")
+
+
+def copy_rows(model, fields, rows, batch_size=50000):
+    """
+    Writes `rows` (tuples of values in `fields` order, using attnames such as
+    'player_id') into the table of `model`. Returns the number of rows written.
+
+    Primary keys must be included in the rows, e.g. from reserve_ids(). Nothing
+    is validated and no signals are sent, exactly like bulk_create.
+    """
+    rows = iter(rows)
+    written = 0
+
+    if connection.vendor != 'postgresql':
+        while batch := list(islice(rows, batch_size)):
+            model.objects.bulk_create(
+                [model(**dict(zip(fields, row))) for row in batch], batch_size=batch_size
+            )
+            written += len(batch)
+        return written
+
+    quote = connection.ops.quote_name
+    columns = [quote(model._meta.get_field(name).column) for name in fields]
+    sql = f"COPY {quote(model._meta.db_table)} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    with connection.cursor() as cursor:
+        while batch := list(islice(rows, batch_size)):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            # csv writes None as an empty unquoted field, which COPY reads as NULL; the str() of
+            # booleans and datetimes is valid PostgreSQL input as-is
+            writer.writerows(batch)
+            buffer.seek(0)
+            cursor.cursor.copy_expert(sql, buffer)
+            written += len(batch)
+    return written
+
+
+def update_instances(model, objs, fields, batch_size=50000):
+    """
+    Saves `fields` of already existing `objs`, like QuerySet.bulk_update().
+
+    On PostgreSQL the values are copied into a temporary table and applied with
+    a single UPDATE ... FROM, instead of bulk_update's CASE WHEN per row and
+    field, whose size (and compile time) grows with every row in the batch.
+    """
+    objs = list(objs)
+    if not objs:
+        return 0
+    if connection.vendor != 'postgresql':
+        return model.objects.bulk_update(objs, fields, batch_size=batch_size)
+
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    pk = model._meta.pk
+    model_fields = [model._meta.get_field(name) for name in fields]
+    columns = [quote(field.column) for field in model_fields]
+    staging = quote(f'{model._meta.db_table}_update')
+
+    # The savepoint drops the staging table again if anything fails
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {staging} AS "
+            f"SELECT {quote(pk.column)}, {', '.join(columns)} FROM {table} WITH NO DATA"
+        )
+        sql = f"COPY {staging} ({quote(pk.column)}, {', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        for start in range(0, len(objs), batch_size):
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                [obj.pk] + [getattr(obj, field.attname) for field in model_fields]
+                for obj in objs[start:start + batch_size]
+            )
+            buffer.seek(0)
+            cursor.cursor.copy_expert(sql, buffer)
+        assignments = ', '.join(f"{column} = staged.{column}" for column in columns)
+        cursor.execute(
+            f"UPDATE {table} SET {assignments} FROM {staging} staged "
+            f"WHERE {table}.{quote(pk.column)} = staged.{quote(pk.column)}"
+        )
+        updated = cursor.rowcount
+        cursor.execute(f"DROP TABLE {staging}")
+    return updated
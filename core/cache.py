@@ -0,0 +1,152 @@
+"""
+Leaderboard caching keyed by a league version counter.
+
+Anything that changes ratings bumps the version once its transaction commits.
+Entries are tagged with the version they were built for (and expire after a
+few minutes, since inactivity decay changes scores over time) and kept in a
+per-process LRU in front of the shared Django cache. When the version moves on,
+one worker rebuilds the entry while the others keep serving the stale copy, so
+readers never queue behind a rebuild or a running recompute.
+
+Player pages use the same kind of counters, one per player plus an epoch for
+everyone: recording a match bumps its four players, while recomputes, archives
+and renames bump the epoch. Their entries are keyed by both counters, so a
+bump simply leaves the old entry to expire.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import transaction
+
+LEAGUE_VERSION_KEY = 'league:version'
+LOCAL_CACHE_SIZE = 256
+# Upper bound on how long a crashed rebuild can keep others on the stale entry
+REBUILD_LOCK_TIMEOUT = 60
+# TrueSkill decay moves scores without any write, so entries also age out
+DEFAULT_MAX_AGE = 300
+PLAYER_PAGES_EPOCH_KEY = 'player-pages:epoch'
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used mapping"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LRUCache(LOCAL_CACHE_SIZE)
+
+
+def _get_counter(key):
+    value = cache.get(key)
+    if value is None:
+        # A lost counter must never collide with a version entries were built for
+        cache.add(key, time.time_ns(), timeout=None)
+        value = cache.get(key)
+    return value
+
+
+def _increment(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=None)
+
+
+def get_league_version():
+    return _get_counter(LEAGUE_VERSION_KEY)
+
+
+def _increment_league_version():
+    _increment(LEAGUE_VERSION_KEY)
+
+
+def bump_league_version():
+    """Invalidates every cached leaderboard once the current transaction commits"""
+    transaction.on_commit(_increment_league_version)
+
+
+def get_or_build(name, build, max_age=DEFAULT_MAX_AGE):
+    """
+    Returns the cached value for `name` at the current league version, calling
+    build() to produce it when missing, stale or older than max_age seconds.
+
+    A stale entry is served as-is while another worker holds the rebuild lock.
+    """
+    version = get_league_version()
+    key = f'leaderboard:{name}'
+
+    def is_fresh(entry):
+        return entry[0] == version and time.time() - entry[1] < max_age
+
+    entry = local_cache.get(key)
+    if entry is not None and is_fresh(entry):
+        return entry[2]
+
+    shared_entry = cache.get(key)
+    if shared_entry is not None and is_fresh(shared_entry):
+        local_cache.set(key, shared_entry)
+        return shared_entry[2]
+
+    stale_entry = shared_entry or entry
+    lock_key = f'{key}:rebuild'
+    if stale_entry is not None and not cache.add(lock_key, 1, timeout=REBUILD_LOCK_TIMEOUT):
+        return stale_entry[2]
+
+    try:
+        value = build()
+        entry = (version, time.time(), value)
+        cache.set(key, entry, timeout=None)
+        local_cache.set(key, entry)
+    finally:
+        if stale_entry is not None:
+            cache.delete(lock_key)
+    return value
+
+
+def _player_version_key(player_id):
+    return f'player-page:{player_id}:version'
+
+
+def player_page_key(player_id, year):
+    """Cache key of a player's page for a season at the current versions"""
+    versions = cache.get_many([PLAYER_PAGES_EPOCH_KEY, _player_version_key(player_id)])
+    epoch = versions.get(PLAYER_PAGES_EPOCH_KEY) or _get_counter(PLAYER_PAGES_EPOCH_KEY)
+    version = versions.get(_player_version_key(player_id)) or _get_counter(_player_version_key(player_id))
+    return f'player-page:{player_id}:{year}:{epoch}:{version}'
+
+
+def bump_player_versions(player_ids=None):
+    """
+    Invalidates the cached pages of the given players, or of everyone, once
+    the current transaction commits
+    """
+    keys = [PLAYER_PAGES_EPOCH_KEY] if player_ids is None else [_player_version_key(pk) for pk in set(player_ids)]
+
+    def increment():
+        for key in keys:
+            _increment(key)
+
+    transaction.on_commit(increment)
@@ -0,0 +1,251 @@
+"""
+Rating checkpoints: the whole league's ratings at the end of every day with
+matches, and every RATING_CHECKPOINT_INTERVAL matches within a busy one.
+
+Each checkpoint packs one fixed-size record per player who had played by
+then into a NumPy structured array, zlib-compressed, so a league of 10,000
+players costs a few hundred KB per checkpoint. The ratings at any moment
+are the nearest earlier checkpoint plus a replay of the matches after it
+(state_at(), or standings_at() for a past leaderboard), and recompute_year()
+can restart from one instead of from January.
+
+Checkpoints are only valid while nothing before them changes. Every path
+that rates a match out of order drops the checkpoints from that match on
+(invalidate()), and build_checkpoints() adds the missing ones again. It runs
+after every match Match.save() or Match.delete() rates, once the change
+commits, and in the rating queue worker when idle, so a replay never covers
+more than today's matches or one interval's worth.
+"""
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import PLAYER_SLOTS, Match, Player, RatingCheckpoint, decayed_sigma
+from .recompute import RatingTable
+
+RECORD = np.dtype([
+    ('player', '<i8'), ('elo', '<i4'), ('mu', '<f8'), ('sigma', '<f8'),
+    ('played', '<i4'), ('won', '<i4'), ('last_played', '<i8'),
+])
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+# Checkpoints are written in batches of this many as a replay takes them, not held until the end
+WRITE_BATCH = 10
+
+
+def pack(table):
+    """Compressed records of everyone in a RatingTable who has played"""
+    player_ids = [player_id for player_id, played in table.played.items() if played]
+    records = np.empty(len(player_ids), dtype=RECORD)
+    records['player'] = player_ids
+    records['elo'] = [table.elo[player_id] for player_id in player_ids]
+    records['mu'] = [table.mu[player_id] for player_id in player_ids]
+    records['sigma'] = [table.sigma[player_id] for player_id in player_ids]
+    records['played'] = [table.played[player_id] for player_id in player_ids]
+    records['won'] = [table.won[player_id] for player_id in player_ids]
+    records['last_played'] = [(table.last_played[player_id] - EPOCH) // MICROSECOND for player_id in player_ids]
+    return zlib.compress(records.tobytes())
+
+
+def unpack(data):
+    """The RatingTable a checkpoint was packed from"""
+    table = RatingTable()
+    records = np.frombuffer(zlib.decompress(bytes(data)), dtype=RECORD)
+    for player_id, elo, mu, sigma, played, won, last_played in records.tolist():
+        table.add(player_id, elo, mu, sigma, played, won, EPOCH + last_played * MICROSECOND)
+    return table
+
+
+def table_from_players(players):
+    """RatingTable of the Player instances that have played"""
+    table = RatingTable()
+    for player in players:
+        if player.matches_played:
+            table.add_player(player)
+    return table
+
+
+def checkpoint(match, matches, table):
+    """Unsaved checkpoint of `table` right after `match`, the `matches`-th of its year"""
+    return RatingCheckpoint(
+        year=match.year, date_played=match.date_played, match_id=match.pk, matches=matches,
+        players=sum(1 for played in table.played.values() if played), data=pack(table),
+    )
+
+
+def after(point, id_field='match_id'):
+    """Rows positioned after a checkpoint in (date_played, match id) order"""
+    return Q(date_played__gt=point.date_played) | Q(date_played=point.date_played, **{f'{id_field}__gt': point.match_id})
+
+
+def latest(year, moment=None):
+    """The latest checkpoint of `year`, at or before `moment` if given"""
+    checkpoints = RatingCheckpoint.objects.filter(year=year)
+    if moment is not None:
+        checkpoints = checkpoints.filter(date_played__lte=moment)
+    return checkpoints.order_by('-date_played', '-match_id').first()
+
+
+def invalidate(year, date_played, match_id=None):
+    """Drops the checkpoints of `year` at or after a match (or a date), which no longer hold"""
+    if match_id is None:
+        stale = Q(date_played__gte=date_played)
+    else:
+        stale = Q(date_played__gt=date_played) | Q(date_played=date_played, match_id__gte=match_id)
+    RatingCheckpoint.objects.filter(stale, year=year).delete()
+
+
+class CheckpointSchedule:
+    """
+    Where a replay in rating order takes checkpoints: after the last match of
+    each day that is over, and after every `interval` matches (default: the
+    RATING_CHECKPOINT_INTERVAL setting) since the previous checkpoint.
+    """
+
+    def __init__(self, since=None, interval=None):
+        self.interval = interval or settings.RATING_CHECKPOINT_INTERVAL
+        self.counted = self.taken = since.matches if since is not None else 0
+        self.today = timezone.localdate()
+
+    def due(self, date_played, next_date_played=None):
+        """
+        Counts one replayed match and returns whether a checkpoint goes right
+        after it. `next_date_played` is the following match's, None for the last.
+        """
+        self.counted += 1
+        day = timezone.localdate(date_played)
+        if next_date_played is None:
+            # More matches may still come today
+            day_over = day < self.today
+        else:
+            day_over = timezone.localdate(next_date_played) != day
+        if day_over or self.counted - self.taken >= self.interval:
+            self.taken = self.counted
+            return True
+        return False
+
+
+class CheckpointWriter:
+    """Saves checkpoints WRITE_BATCH at a time as they are added"""
+
+    def __init__(self):
+        self.batch = []
+        self.written = 0
+
+    def add(self, point):
+        self.batch.append(point)
+        if len(self.batch) >= WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        RatingCheckpoint.objects.bulk_create(self.batch)
+        self.written += len(self.batch)
+        self.batch = []
+
+
+def _rated_matches(year, since=None):
+    """Matches of `year` after checkpoint `since` up to the first queued one, in rating order"""
+    matches = Match.objects.filter(year=year)
+    if since is not None:
+        matches = matches.filter(after(since, 'id'))
+    first_queued = (
+        Match.objects.filter(year=year, rating_queued_at__isnull=False)
+        .order_by('date_played', 'id').values('date_played', 'id').first()
+    )
+    if first_queued is not None:
+        matches = matches.filter(
+            Q(date_played__lt=first_queued['date_played'])
+            | Q(date_played=first_queued['date_played'], id__lt=first_queued['id'])
+        )
+    return matches.order_by('date_played', 'id')
+
+
+def _replay(table, matches, on_match=None):
+    """
+    Plays `matches` into `table`, calling on_match(match, next_date_played)
+    after each one, once the next match's date is known
+    """
+    rows = matches.values_list('id', *(f'{slot}_id' for slot in PLAYER_SLOTS), 'result', 'date_played', 'year')
+    previous = None
+    for match_id, *player_ids, result, date_played, year in rows.iterator(chunk_size=5000):
+        if previous is not None and on_match is not None:
+            on_match(previous, date_played)
+        for player_id in player_ids:
+            if player_id not in table.elo:
+                table.add(player_id)
+        table.play(match_id, player_ids, result == Match.MatchResult.TEAM1_WIN, date_played, year)
+        previous = Match(pk=match_id, date_played=date_played, year=year)
+    if previous is not None and on_match is not None:
+        on_match(previous, None)
+
+
+def state_at(year, moment=None):
+    """
+    RatingTable of everyone who had played in `year` by `moment` (default:
+    now), from the nearest checkpoint and a replay of the rated matches after
+    it. Queued matches are left out until they are rated.
+    """
+    since = latest(year, moment)
+    table = unpack(since.data) if since is not None else RatingTable()
+    matches = _rated_matches(year, since)
+    if moment is not None:
+        matches = matches.filter(date_played__lte=moment)
+    _replay(table, matches)
+    return table
+
+
+def build_checkpoints(year, interval=None):
+    """
+    Adds the checkpoints missing after the latest one of `year`, on the
+    CheckpointSchedule. Returns how many were added.
+    """
+    since = latest(year)
+    schedule = CheckpointSchedule(since, interval)
+    remaining = _rated_matches(year, since)
+    start_of_today = timezone.make_aware(datetime.combine(schedule.today, datetime.min.time()))
+    # Only today's matches left, and fewer than a checkpoint's worth
+    if not remaining.filter(date_played__lt=start_of_today).exists() and not remaining[schedule.interval - 1:].exists():
+        return 0
+
+    with transaction.atomic():
+        # Nothing may be rated meanwhile; matches rated in order lock their players
+        Player.objects.lock()
+        since = latest(year)
+        schedule = CheckpointSchedule(since, interval)
+        table = unpack(since.data) if since is not None else RatingTable()
+        writer = CheckpointWriter()
+
+        def on_match(match, next_date_played):
+            if schedule.due(match.date_played, next_date_played):
+                writer.add(checkpoint(match, schedule.counted, table))
+
+        _replay(table, _rated_matches(year, since), on_match)
+        writer.flush()
+    return writer.written
+
+
+def standings_at(moment):
+    """
+    Every player as they stood at `moment` in that season, rated from
+    state_at() and with inactivity decay evaluated at `moment`. Players who
+    had not played yet keep the start-of-season defaults.
+    """
+    table = state_at(moment.year, moment)
+    players = list(
+        Player.objects.filter(Q(pk__in=list(table.elo)) | Q(created_at__lte=moment))
+        .only('name', 'created_at').order_by('pk')
+    )
+    for player in players:
+        if player.pk not in table.elo:
+            table.add(player.pk)
+        table.apply_to(player)
+        # The same attributes PlayerQuerySet.with_trueskill_score() and with_win_percentage() annotate
+        player.decayed_trueskill_sigma = decayed_sigma(player.trueskill_sigma, player.last_match_date, moment)
+        player.conservative_score = player.trueskill_mu - 3 * player.decayed_trueskill_sigma
+        player.win_rate = player.win_percentage
+    return players
@@ -0,0 +1,10 @@
+from django.conf import settings
+
+from .rating_queue import cached_queue_status
+
+
+def rating_queue(request):
+    """Queue length and lag for the "ratings pending" banner, when the rating queue is on"""
+    if not settings.RATING_QUEUE:
+        return {}
+    return {'rating_queue': cached_queue_status()}
@@ -0,0 +1,170 @@
+"""
+Streaming exports of matches, players and archived player stats as CSV or NDJSON.
+
+Rows are read with values_list().iterator(), which uses a server-side cursor
+on PostgreSQL, and encoded a chunk at a time, so memory stays flat whether a
+year has a hundred matches or a million. Match exports name players by email
+under the same columns import_matches reads, so an export can be re-imported.
+"""
+import csv
+import io
+import json
+from datetime import date, datetime, timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import PLAYER_SLOTS, ArchivedPlayerStats, Match, MatchParticipant, Player
+
+CHUNK_SIZE = 2000
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+# (column, lookup) pairs for each dataset
+MATCH_COLUMNS = (
+    [('id', 'id')]
+    + [(slot, f'{slot}__email') for slot in PLAYER_SLOTS]
+    + [(name, name) for name in ['team1_score', 'team2_score', 'result', 'date_played', 'year', 'elo_change']]
+    + [(f'{slot}_elo_before',) * 2 for slot in PLAYER_SLOTS]
+    + [(f'{slot}_trueskill_{name}_before',) * 2 for slot in PLAYER_SLOTS for name in ('mu', 'sigma')]
+)
+PLAYER_COLUMNS = [(name, name) for name in [
+    'id', 'name', 'email', 'elo_rating', 'trueskill_mu', 'trueskill_sigma',
+    'matches_played', 'matches_won', 'matches_lost', 'last_match_date', 'current_year', 'created_at',
+]]
+ARCHIVED_STATS_COLUMNS = [('year', 'archive__year')] + [(name, name) for name in [
+    'player_name', 'player_email', 'elo_rating', 'trueskill_mu', 'trueskill_sigma',
+    'matches_played', 'matches_won', 'matches_lost',
+]]
+
+
+class ExportError(ValueError):
+    """Invalid dataset, format or filter"""
+
+
+def parse_bound(value, name, end=False):
+    """
+    Parses a since/until filter; a bare date means the start of that day, or
+    the start of the next day for an (exclusive) end bound.
+    """
+    if value in (None, ''):
+        return None
+    try:
+        # Dates first: parse_datetime() also takes a bare date, as midnight
+        day = parse_date(value)
+        moment = parse_datetime(value) if day is None else None
+    except ValueError:
+        # Well formed but impossible, like 2025-02-30
+        day = moment = None
+    if day is not None:
+        moment = datetime.combine(day + timedelta(days=1) if end else day, datetime.min.time())
+    elif moment is None:
+        raise ExportError(f"{name} must be a date (YYYY-MM-DD) or an ISO datetime")
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def matches_queryset(year, since, until):
+    matches = Match.objects.all()
+    if year is not None:
+        matches = matches.filter(year=year)
+    if since is not None:
+        matches = matches.filter(date_played__gte=since)
+    if until is not None:
+        matches = matches.filter(date_played__lt=until)
+    return matches.order_by('date_played', 'id')
+
+
+def players_queryset(year, since, until):
+    """Everyone, or only the players who played in the year / date range"""
+    players = Player.objects.all()
+    if year is not None or since is not None or until is not None:
+        participations = MatchParticipant.objects.all()
+        if year is not None:
+            participations = participations.filter(year=year)
+        if since is not None:
+            participations = participations.filter(date_played__gte=since)
+        if until is not None:
+            participations = participations.filter(date_played__lt=until)
+        players = players.filter(pk__in=participations.values('player'))
+    return players.order_by('id')
+
+
+def archived_stats_queryset(year, since, until):
+    if since is not None or until is not None:
+        raise ExportError("archived-stats can only be filtered by year")
+    stats = ArchivedPlayerStats.objects.all()
+    if year is not None:
+        stats = stats.filter(archive__year=year)
+    return stats.order_by('archive__year', 'id')
+
+
+DATASETS = {
+    'matches': (MATCH_COLUMNS, matches_queryset),
+    'players': (PLAYER_COLUMNS, players_queryset),
+    'archived-stats': (ARCHIVED_STATS_COLUMNS, archived_stats_queryset),
+}
+
+
+def export(dataset, export_format, year=None, since=None, until=None):
+    """
+    Validates the request and returns a generator of text chunks for the export.
+
+    year, since and until are raw strings (e.g. from a query string); since is
+    inclusive and until exclusive, except that a bare date includes that day.
+    """
+    if dataset not in DATASETS:
+        raise ExportError(f"Unknown dataset {dataset!r}, expected one of: {', '.join(DATASETS)}")
+    if export_format not in CONTENT_TYPES:
+        raise ExportError(f"Unknown format {export_format!r}, expected one of: {', '.join(CONTENT_TYPES)}")
+    if year not in (None, ''):
+        try:
+            year = int(year)
+        except ValueError:
+            raise ExportError("year must be a number")
+    else:
+        year = None
+
+    columns, build_queryset = DATASETS[dataset]
+    rows = build_queryset(year, parse_bound(since, 'since'), parse_bound(until, 'until', end=True)).values_list(
+        *[lookup for _, lookup in columns]
+    )
+    names = [name for name, _ in columns]
+    if export_format == 'csv':
+        return _stream(rows, _encode_csv, header=_encode_csv([names]))
+    return _stream(rows, lambda chunk: _encode_ndjson(names, chunk))
+
+
+def _stream(rows, encode, header=None):
+    if header:
+        yield header
+    chunk = []
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield encode(chunk)
+            chunk = []
+    if chunk:
+        yield encode(chunk)
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _encode_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_plain(value) for value in row] for row in rows)
+    return buffer.getvalue()
+
+
+def _encode_ndjson(names, rows):
+    return ''.join(
+        json.dumps({name: _plain(value) for name, value in zip(names, row)}) + '\n'
+        for row in rows
+    )
@@ -0,0 +1,144 @@
+"""
+TrueSkill history for player charts.
+
+A player's history is kept as columns (one list per field) rather than a dict
+per match. Long histories are cut down with largest-triangle-three-buckets,
+which keeps the peaks and dips a line chart would show, and sent delta-encoded:
+dates as day offsets and ratings as integer hundredths relative to the
+previous point, so payload size depends on the chart width, not on how many
+matches the player has.
+"""
+import numpy as np
+
+# Points a chart is drawn with unless asked otherwise; more than a card's width in pixels
+CHART_POINTS = 500
+MAX_CHART_POINTS = 5000
+# Ratings are shown to two decimals
+SCALE = 100
+ENCODINGS = ('delta', 'columns')
+
+
+def history_columns(events):
+    """
+    Columns of a player's TrueSkill progression from chronological rating
+    events, starting with their ratings before the first match. The starting
+    point has no match_id and no result. Empty if there are no events.
+    """
+    if not events:
+        return {}
+
+    first = events[0]
+    columns = {
+        'date': [first.date_played.date()],
+        'mu': [first.trueskill_mu_before],
+        'sigma': [first.trueskill_sigma_before],
+        'match_id': [None],
+        'won': [None],
+    }
+    for event in events:
+        columns['date'].append(event.date_played.date())
+        columns['mu'].append(event.trueskill_mu_after)
+        columns['sigma'].append(event.trueskill_sigma_after)
+        columns['match_id'].append(event.match_id)
+        columns['won'].append(event.won)
+    return columns
+
+
+def largest_triangle_three_buckets(values, threshold):
+    """
+    Indexes of `threshold` points of an evenly spaced series that best keep its
+    shape. The first and last points are always kept; every other point is the
+    one of its bucket spanning the largest triangle with the point kept before
+    it and the average of the next bucket.
+    """
+    count = len(values)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+
+    y = np.asarray(values, dtype=float)
+    x = np.arange(count, dtype=float)
+    # threshold - 2 buckets between the first and the last point, none of them empty
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.intp)
+    edges = np.append(edges, count)
+
+    selected = np.empty(threshold, dtype=np.intp)
+    selected[0], selected[-1] = 0, count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+        average_x = x[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+        area = np.abs(
+            (x[previous] - average_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (average_y - y[previous])
+        )
+        previous = start + int(area.argmax())
+        selected[bucket + 1] = previous
+    return selected
+
+
+def downsample(columns, max_points=CHART_POINTS):
+    """At most `max_points` points of a history, chosen by the shape of mu"""
+    if not columns or len(columns['mu']) <= max_points:
+        return columns
+    keep = largest_triangle_three_buckets(columns['mu'], max_points).tolist()
+    return {name: [values[index] for index in keep] for name, values in columns.items()}
+
+
+def _deltas(values):
+    return np.diff(np.asarray(values, dtype=np.int64), prepend=0).tolist()
+
+
+def delta_encode(columns, total=None):
+    """
+    Compact JSON-ready form of a history:
+
+    - start: ISO date of the first point; days: days since the previous point
+    - mu, sigma: hundredths, each relative to the previous point
+    - match_id: relative to the previous point, 0 for the starting point
+    - won: one character per point, '1' won, '0' lost, '-' starting point
+    - total: points in the history before downsampling
+    """
+    if not columns:
+        return {'encoding': 'delta', 'scale': SCALE, 'total': 0, 'start': None,
+                'days': [], 'mu': [], 'sigma': [], 'match_id': [], 'won': ''}
+
+    start = columns['date'][0]
+    match_ids = []
+    last_match_id = 0
+    for match_id in columns['match_id']:
+        last_match_id = last_match_id if match_id is None else match_id
+        match_ids.append(last_match_id)
+    return {
+        'encoding': 'delta',
+        'scale': SCALE,
+        'total': len(columns['mu']) if total is None else total,
+        'start': start.isoformat(),
+        'days': _deltas([(date - start).days for date in columns['date']]),
+        'mu': _deltas(np.rint(np.asarray(columns['mu']) * SCALE)),
+        'sigma': _deltas(np.rint(np.asarray(columns['sigma']) * SCALE)),
+        'match_id': _deltas(match_ids),
+        'won': ''.join('-' if won is None else '1' if won else '0' for won in columns['won']),
+    }
+
+
+def columns_encode(columns, total=None):
+    """Plain columns with ISO dates and ratings rounded to two decimals"""
+    columns = columns or {'date': [], 'mu': [], 'sigma': [], 'match_id': [], 'won': []}
+    return {
+        'encoding': 'columns',
+        'total': len(columns['mu']) if total is None else total,
+        'date': [date.isoformat() for date in columns['date']],
+        'mu': [round(mu, 2) for mu in columns['mu']],
+        'sigma': [round(sigma, 2) for sigma in columns['sigma']],
+        'match_id': columns['match_id'],
+        'won': columns['won'],
+    }
+
+
+def chart_payload(columns, max_points=CHART_POINTS, encoding='delta'):
+    """Downsampled and encoded history, ready for json.dumps"""
+    total = len(columns['mu']) if columns else 0
+    encode = delta_encode if encoding == 'delta' else columns_encode
+    return encode(downsample(columns, max_points), total=total)
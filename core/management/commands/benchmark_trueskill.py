@@ -0,0 +1,68 @@
+import random
+import time
+
+import numpy as np
+import trueskill
+from django.core.management.base import BaseCommand
+
+from core.models import TRUESKILL_DEFAULT_MU, TRUESKILL_DEFAULT_SIGMA
+from core.ratings import rate_2v2, rate_2v2_batch
+
+
+class Command(BaseCommand):
+    help = "Microbenchmark of the closed-form 2v2 TrueSkill kernel against trueskill.rate()"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--matches', type=int, default=20000, help='Number of random matches to rate')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        n = options['matches']
+
+        # Random but realistic ratings: mu around the default, sigma anywhere between settled and new
+        mu = [[rng.gauss(TRUESKILL_DEFAULT_MU, 5) for _ in range(4)] for _ in range(n)]
+        sigma = [[rng.uniform(0.8, TRUESKILL_DEFAULT_SIGMA) for _ in range(4)] for _ in range(n)]
+        team1_won = [rng.random() < 0.5 for _ in range(n)]
+
+        start = time.perf_counter()
+        library = []
+        for m, s, won in zip(mu, sigma, team1_won):
+            groups = [
+                (trueskill.Rating(m[0], s[0]), trueskill.Rating(m[1], s[1])),
+                (trueskill.Rating(m[2], s[2]), trueskill.Rating(m[3], s[3])),
+            ]
+            (r1, r2), (r3, r4) = trueskill.rate(groups, ranks=[0, 1] if won else [1, 0])
+            library.append([(r.mu, r.sigma) for r in (r1, r2, r3, r4)])
+        library_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scalar = []
+        for m, s, won in zip(mu, sigma, team1_won):
+            (r1, r2), (r3, r4) = rate_2v2(((m[0], s[0]), (m[1], s[1])), ((m[2], s[2]), (m[3], s[3])), won)
+            scalar.append([r1, r2, r3, r4])
+        scalar_time = time.perf_counter() - start
+
+        mu_array, sigma_array, won_array = np.array(mu), np.array(sigma), np.array(team1_won)
+        start = time.perf_counter()
+        batch_mu, batch_sigma = rate_2v2_batch(mu_array, sigma_array, won_array)
+        batch_time = time.perf_counter() - start
+
+        expected = np.array(library)
+        scalar_error = np.abs(np.array(scalar) - expected).max()
+        batch_error = max(
+            np.abs(batch_mu - expected[:, :, 0]).max(),
+            np.abs(batch_sigma - expected[:, :, 1]).max(),
+        )
+
+        self.stdout.write(f"Rated {n} matches")
+        for label, elapsed in [
+            ('trueskill.rate', library_time),
+            ('rate_2v2', scalar_time),
+            ('rate_2v2_batch', batch_time),
+        ]:
+            self.stdout.write(
+                f"  {label:<16} {elapsed:8.4f}s  {n / elapsed:12.0f} matches/s  "
+                f"{library_time / elapsed:8.1f}x"
+            )
+        self.stdout.write(f"Max abs difference vs trueskill.rate: scalar {scalar_error:.2e}, batch {batch_error:.2e}")
@@ -0,0 +1,309 @@
+import json
+import subprocess
+import time
+import tracemalloc
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from core.bulk import truncate
+from core.cache import local_cache
+from core.metrics import QueryRecorder
+from core.models import Match, Player, RatingCheckpoint, RegistrationToken, YearArchive
+from core.synthetic import generate_league
+
+# Budgets for the hot paths. Query counts must not grow with the league; latency
+# budgets are deliberately loose and meant to be tightened per deployment with --budgets.
+DEFAULT_BUDGETS = {
+    'home': {'queries': 10, 'p95_ms': 250},
+    'player-list': {'queries': 10},
+    'player-detail': {'queries': 10, 'p95_ms': 500},
+    'match-list': {'queries': 10, 'p95_ms': 250},
+    'match-list-deep': {'queries': 10, 'p95_ms': 250},
+    'match-list-player': {'queries': 10, 'p95_ms': 250},
+    'match-detail': {'queries': 10, 'p95_ms': 100},
+    'rankings': {'queries': 10},
+    'rankings-win-percentage': {'queries': 10},
+    'rankings-as-of': {'queries': 10},
+    'player-history': {'queries': 10, 'p95_ms': 100},
+    'player-search': {'queries': 5, 'p95_ms': 50},
+    'head-to-head': {'queries': 10, 'p95_ms': 100},
+    'matchmaking': {'queries': 10, 'p95_ms': 250},
+    'win-probabilities': {'queries': 10, 'p95_ms': 250},
+    'export-matches-day': {'queries': 10},
+    'metrics': {'queries': 10, 'p95_ms': 100},
+    'elo-recompute-post': {'queries': 50},
+    'archive-year-post': {'queries': 50},
+}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = (
+        "Times every view in core/urls.py plus the recompute and archive jobs, recording "
+        "query counts, p50/p95 latency and peak memory, and checks them against budgets"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--generate', action='store_true',
+                            help='DELETE all league data and generate a synthetic league first')
+        parser.add_argument('--players', type=int, default=10000)
+        parser.add_argument('--matches', type=int, default=1000000)
+        parser.add_argument('--years', type=int, default=3, help='Number of seasons, ending with the current one')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--iterations', type=int, default=20, help='Timed requests per view')
+        parser.add_argument('--job-iterations', type=int, default=1, help='Timed runs of the recompute and archive jobs')
+        parser.add_argument('--skip-jobs', action='store_true', help='Do not run the recompute and archive POSTs')
+        parser.add_argument('--cold-cache', action='store_true', help='Clear the leaderboard cache before every request')
+        parser.add_argument('--budgets', help='JSON file of per-view budgets overriding the defaults')
+        parser.add_argument('--output', help='Write results to this JSON file')
+        parser.add_argument('--compare', help='Previous --output file to compare against')
+        parser.add_argument('--max-regression', type=float, default=25.0,
+                            help='Allowed p95 increase over --compare, in percent')
+
+    def handle(self, *args, **options):
+        if options['generate']:
+            self.generate(options)
+
+        # The default budgets assume leaderboards are served from the cache
+        budgets = {} if options['cold_cache'] else dict(DEFAULT_BUDGETS)
+        if options['budgets']:
+            with open(options['budgets']) as budgets_file:
+                budgets.update(json.load(budgets_file))
+
+        self.client = Client(HTTP_HOST=(settings.ALLOWED_HOSTS or ['localhost'])[0])
+        admin, _ = User.objects.get_or_create(username='benchmark', defaults={'is_superuser': True, 'is_staff': True})
+        self.client.force_login(admin)
+        token = RegistrationToken.objects.create(created_by=admin)
+
+        try:
+            results = {}
+            for name, method, url in self.build_targets(token, options['skip_jobs']):
+                iterations = options['job_iterations'] if method == 'post' else options['iterations']
+                results[name] = self.measure(method, url, iterations, options['cold_cache'])
+                self.report(name, results[name])
+        finally:
+            token.delete()
+
+        failures = self.check_budgets(results, budgets)
+        if options['compare']:
+            failures += self.compare(results, options['compare'], options['max_regression'])
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({'meta': self.metadata(options), 'results': results}, output_file, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if failures:
+            for failure in failures:
+                self.stderr.write(failure)
+            raise CommandError(f"{len(failures)} benchmark budget(s) exceeded")
+        self.stdout.write(self.style.SUCCESS("All budgets met"))
+
+    def generate(self, options):
+        current_year = timezone.now().year
+        years = list(range(current_year - options['years'] + 1, current_year + 1))
+        self.stdout.write(
+            f"Generating {options['players']} players and {options['matches']} matches over {years}..."
+        )
+        start = time.perf_counter()
+        truncate(Player, Match, YearArchive, RatingCheckpoint)
+        # Leave the last past season unarchived so ArchiveYearView has something to do
+        generate_league(
+            options['players'], options['matches'], years, archived_years=years[:-2],
+            seed=options['seed'], log=self.stdout.write,
+        )
+        self.stdout.write(f"Generated in {time.perf_counter() - start:.1f}s")
+
+    def build_targets(self, token, skip_jobs):
+        """
+        (name, method, url) for every route in core/urls.py. method is 'get',
+        'post' for the jobs, whose url is a (path, form data) pair, or
+        'post-json' for a (path, JSON body) pair.
+        """
+        current_year = timezone.now().year
+        regulars = list(Player.objects.order_by('-matches_played', 'pk').values_list('pk', flat=True)[:12])
+        player = Player.objects.filter(pk=regulars[0]).first() if regulars else None
+        match = Match.objects.order_by('-date_played', '-id').first()
+        middle = Match.objects.order_by('-date_played', '-id')[Match.objects.count() // 2:].first()
+        archive = YearArchive.objects.first()
+        unarchived_year = (
+            Match.objects.filter(year__lt=current_year).exclude(year__in=YearArchive.objects.values('year'))
+            .order_by('-year').values_list('year', flat=True).first()
+        )
+
+        targets = [
+            ('home', 'get', reverse('home')),
+            ('player-list', 'get', reverse('player-list')),
+            ('player-create', 'get', reverse('player-create')),
+            ('match-list', 'get', reverse('match-list')),
+            ('match-create', 'get', reverse('match-create')),
+            ('rankings', 'get', reverse('rankings')),
+            ('rankings-win-percentage', 'get', f"{reverse('rankings')}?sort=win_percentage&direction=desc"),
+            ('rankings-elo', 'get', f"{reverse('rankings')}?sort=elo_rating&direction=desc"),
+            ('archived-years-list', 'get', reverse('archived-years-list')),
+            ('archive-year', 'get', reverse('archive-year')),
+            ('elo-recompute', 'get', reverse('elo-recompute')),
+            ('metrics', 'get', reverse('metrics')),
+            ('export-players', 'get', reverse('export', kwargs={'dataset': 'players'})),
+            ('register', 'get', reverse('register')),
+            ('create-registration-token', 'get', reverse('create-registration-token')),
+            ('token-registration', 'get', reverse('token-registration', kwargs={'token': token.token})),
+        ]
+        if player is not None:
+            targets += [
+                ('player-detail', 'get', reverse('player-detail', kwargs={'pk': player.pk})),
+                ('player-update', 'get', reverse('player-update', kwargs={'pk': player.pk})),
+                ('match-list-player', 'get', f"{reverse('match-list')}?player={player.pk}"),
+                ('player-history', 'get', reverse('player-history', kwargs={'pk': player.pk})),
+                ('player-search', 'get', f"{reverse('player-search')}?{urlencode({'q': player.name[:3]})}"),
+            ]
+        if len(regulars) >= 4:
+            # A full request's worth of matchups among the most active players
+            matchups = [[regulars[(index + offset) % len(regulars)] for offset in range(4)] for index in range(1000)]
+            targets += [
+                ('head-to-head', 'get', reverse('head-to-head', kwargs={'pk': regulars[0], 'other_pk': regulars[1]})),
+                ('matchmaking', 'get', f"{reverse('matchmaking')}?{urlencode({'players': ','.join(map(str, regulars))})}"),
+                ('win-probabilities', 'post-json', (reverse('win-probabilities'), {'matchups': matchups})),
+            ]
+        if match is not None:
+            targets += [
+                ('match-detail', 'get', reverse('match-detail', kwargs={'pk': match.pk})),
+                ('export-matches-day', 'get',
+                 f"{reverse('export', kwargs={'dataset': 'matches'})}?since={match.date_played.date().isoformat()}"),
+            ]
+        if middle is not None:
+            cursor = f"{middle.date_played.isoformat()}_{middle.pk}"
+            targets += [
+                ('match-list-deep', 'get', f"{reverse('match-list')}?{urlencode({'before': cursor})}"),
+                ('rankings-as-of', 'get', f"{reverse('rankings')}?as_of={middle.date_played.date().isoformat()}"),
+            ]
+        if archive is not None:
+            targets.append(('archived-year-detail', 'get', reverse('archived-year-detail', kwargs={'year': archive.year})))
+
+        if not skip_jobs:
+            targets.append(('elo-recompute-post', 'post', reverse('elo-recompute')))
+            if unarchived_year is not None:
+                targets.append(('archive-year-post', 'post', (reverse('archive-year'), {'year': unarchived_year})))
+        return targets
+
+    def request(self, method, url):
+        """Makes one request and reads its body to the end; returns the status and body size"""
+        if method == 'post':
+            path, data = url if isinstance(url, tuple) else (url, {})
+            # Jobs rewrite the league; roll them back so every run and view sees the same data
+            with transaction.atomic():
+                response = self.client.post(path, data)
+                transaction.set_rollback(True)
+        elif method == 'post-json':
+            path, data = url
+            response = self.client.post(path, json.dumps(data), content_type='application/json')
+        else:
+            response = self.client.get(url)
+        if response.streaming:
+            # Exports stream; they are only done once the last row is out
+            return response.status_code, sum(len(chunk) for chunk in response.streaming_content)
+        return response.status_code, len(response.content)
+
+    def measure(self, method, url, iterations, cold_cache):
+        def prepare():
+            if cold_cache:
+                cache.clear()
+                local_cache.clear()
+
+        # Warm-up, then one instrumented run for queries and memory, then timed runs
+        prepare()
+        self.request(method, url)
+
+        prepare()
+        tracemalloc.start()
+        queries = QueryRecorder()
+        with connection.execute_wrapper(queries):
+            status, size = self.request(method, url)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        timings = []
+        for _ in range(iterations):
+            prepare()
+            start = time.perf_counter()
+            self.request(method, url)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        return {
+            'status': status,
+            'bytes': size,
+            'queries': queries.count,
+            'query_ms': round(queries.elapsed * 1000, 2),
+            'p50_ms': round(percentile(timings, 0.5), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'peak_kb': round(peak / 1024, 1),
+        }
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:<28} {result['status']:>4} {result['queries']:>6} queries {result['query_ms']:>10.2f} ms in SQL "
+            f"p50 {result['p50_ms']:>9.2f} ms  p95 {result['p95_ms']:>9.2f} ms  peak {result['peak_kb']:>10.1f} KB"
+        )
+
+    def check_budgets(self, results, budgets):
+        failures = []
+        for name, budget in budgets.items():
+            result = results.get(name)
+            if result is None:
+                continue
+            if result['status'] >= 400:
+                failures.append(f"{name}: HTTP {result['status']}")
+            for metric, limit in budget.items():
+                if metric in result and result[metric] > limit:
+                    failures.append(f"{name}: {metric} {result[metric]} exceeds budget {limit}")
+        return failures
+
+    def compare(self, results, baseline_path, max_regression):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+        failures = []
+        self.stdout.write(f"Compared with {baseline_path}:")
+        for name, result in results.items():
+            previous = baseline.get(name)
+            if previous is None:
+                continue
+            change = (result['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100 if previous['p95_ms'] else 0
+            self.stdout.write(
+                f"  {name:<28} queries {previous['queries']:>6} -> {result['queries']:<6} "
+                f"p95 {previous['p95_ms']:>9.2f} -> {result['p95_ms']:<9.2f} ms ({change:+.0f}%)"
+            )
+            if result['queries'] > previous['queries']:
+                failures.append(f"{name}: queries grew from {previous['queries']} to {result['queries']}")
+            if change > max_regression:
+                failures.append(f"{name}: p95 regressed {change:.0f}% (limit {max_regression:.0f}%)")
+        return failures
+
+    def metadata(self, options):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=settings.BASE_DIR
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'commit': commit,
+            'timestamp': timezone.now().isoformat(),
+            'players': Player.objects.count(),
+            'matches': Match.objects.count(),
+            'iterations': options['iterations'],
+            'cold_cache': options['cold_cache'],
+        }
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.db.models.functions import Length
+
+from core.checkpoints import build_checkpoints
+from core.models import Match, RatingCheckpoint
+
+
+class Command(BaseCommand):
+    help = (
+        "Adds the missing rating checkpoints of a year (default: every year with matches): one at the end "
+        "of each day, and one every --interval matches within a day (default: RATING_CHECKPOINT_INTERVAL). "
+        "Safe to run from cron; the rating queue worker also does it when idle"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, action='append', help='Year to checkpoint; repeatable')
+        parser.add_argument('--interval', type=int)
+
+    def handle(self, *args, **options):
+        years = options['year'] or Match.objects.order_by('year').values_list('year', flat=True).distinct()
+        for year in years:
+            added = build_checkpoints(year, options['interval'])
+            stored = RatingCheckpoint.objects.filter(year=year).aggregate(count=Count('pk'), size=Sum(Length('data')))
+            self.stdout.write(
+                f"{year}: added {added}, {stored['count']} checkpoints taking {(stored['size'] or 0) / 1024:.0f} KB"
+            )
@@ -0,0 +1,42 @@
+import contextlib
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.exports import CONTENT_TYPES, DATASETS, ExportError, export
+
+
+class Command(BaseCommand):
+    help = (
+        "Streams matches (with every pre-match rating snapshot), players or archived player stats "
+        "as CSV or NDJSON. Match exports can be loaded back with import_matches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=list(DATASETS))
+        parser.add_argument('--format', choices=list(CONTENT_TYPES), default='csv')
+        parser.add_argument('--year', help='Only this season')
+        parser.add_argument('--since', help='Date or datetime, inclusive')
+        parser.add_argument('--until', help='Date (inclusive) or datetime (exclusive)')
+        parser.add_argument('--output', default='-', help='File to write, or - for standard output')
+
+    def handle(self, *args, **options):
+        try:
+            chunks = export(
+                options['dataset'], options['format'],
+                year=options['year'], since=options['since'], until=options['until'],
+            )
+        except ExportError as e:
+            raise CommandError(e)
+
+        with self.open(options['output']) as stream:
+            for chunk in chunks:
+                stream.write(chunk)
+
+    def open(self, path):
+        if path == '-':
+            return contextlib.nullcontext(sys.stdout)
+        try:
+            return open(path, 'w', newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(f"Cannot open {path}: {e}")
@@ -0,0 +1,272 @@
+import contextlib
+import csv
+import json
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+from itertools import groupby, islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from core.bulk import copy_rows, foreign_keys_checked_after, reserve_ids
+from core.cache import bump_league_version
+from core.models import (
+    PLAYER_SLOTS, TRUESKILL_DEFAULT_MU, TRUESKILL_DEFAULT_SIGMA, Match, MatchParticipant, PairRecord, Player,
+    RatingEvent, YearArchive,
+)
+from core.checkpoints import build_checkpoints
+from core.pairs import rebuild_year as rebuild_pair_records
+from core.player_pages import invalidate as invalidate_player_pages
+from core.recompute import (
+    EVENT_ROW_FIELDS, MATCH_ROW_FIELDS, PARTICIPANT_ROW_FIELDS, PLAYER_RATING_FIELDS, RatingTable, recompute_year,
+)
+
+# elo_change and snapshots of matches that recompute_year() rates after loading
+UNRATED = [0] * 5 + [TRUESKILL_DEFAULT_MU, TRUESKILL_DEFAULT_SIGMA] * 4
+# Below this many rows the per-row foreign key checks are cheaper than locking the tables
+DROP_FOREIGN_KEYS_ABOVE = 10000
+MAX_REPORTED_ERRORS = 20
+AMBIGUOUS = object()
+
+ImportedMatch = namedtuple('ImportedMatch', ['date_played', 'line', 'player_ids', 'team1_score', 'team2_score'])
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports matches from a CSV or JSON Lines file with the columns team1_player1, team1_player2, "
+        "team2_player1, team2_player2 (player email or name), team1_score, team2_score and date_played"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or - for standard input")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=50000)
+        parser.add_argument('--dry-run', action='store_true', help='Validate and rate everything, then roll back')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or self.guess_format(options['path'])
+        start = time.perf_counter()
+
+        with self.open(options['path']) as stream:
+            rows = self.parse(self.read_records(stream, file_format), self.build_lookup())
+        if not rows:
+            raise CommandError("Nothing to import")
+        parsed_at = time.perf_counter()
+        self.stdout.write(
+            f"Parsed {len(rows)} matches in {parsed_at - start:.2f}s ({len(rows) / (parsed_at - start):.0f} rows/s)"
+        )
+
+        rows.sort()
+        years = sorted({row.date_played.year for row in rows})
+        archived = set(YearArchive.objects.filter(year__in=years).values_list('year', flat=True))
+        if archived:
+            raise CommandError(f"Cannot import into archived years: {', '.join(map(str, sorted(archived)))}")
+
+        big_import = len(rows) >= DROP_FOREIGN_KEYS_ABOVE
+        foreign_keys = (
+            foreign_keys_checked_after(Match, MatchParticipant, RatingEvent, PairRecord)
+            if big_import else contextlib.nullcontext()
+        )
+        with transaction.atomic():
+            # Imported ratings continue from the players' rows, which must not move meanwhile
+            Player.objects.lock()
+            with foreign_keys:
+                for year, year_rows in groupby(rows, key=lambda row: row.date_played.year):
+                    self.load_year(year, list(year_rows), options['batch_size'])
+            bump_league_version()
+            invalidate_player_pages()
+            if options['dry_run']:
+                transaction.set_rollback(True)
+
+        elapsed = time.perf_counter() - parsed_at
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Validated' if options['dry_run'] else 'Imported'} {len(rows)} matches in {elapsed:.2f}s "
+            f"({len(rows) / elapsed:.0f} rows/s)"
+            + (" - dry run, nothing was saved" if options['dry_run'] else "")
+        ))
+
+    def guess_format(self, path):
+        for extension, file_format in (('.csv', 'csv'), ('.jsonl', 'jsonl'), ('.ndjson', 'jsonl')):
+            if path.lower().endswith(extension):
+                return file_format
+        raise CommandError("Cannot tell the file format from its name; pass --format")
+
+    def open(self, path):
+        if path == '-':
+            return contextlib.nullcontext(sys.stdin)
+        try:
+            return open(path, newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(f"Cannot open {path}: {e}")
+
+    def read_records(self, stream, file_format):
+        """Yields (line number, record dict) pairs one at a time"""
+        if file_format == 'csv':
+            reader = csv.DictReader(stream)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, e
+                continue
+            yield line_number, record
+
+    def build_lookup(self):
+        """One map from casefolded player email or name to id; names shared by several players are ambiguous"""
+        lookup = {}
+        emails = {}
+        for player_id, name, email in Player.objects.values_list('pk', 'name', 'email').iterator():
+            key = name.strip().casefold()
+            lookup[key] = AMBIGUOUS if key in lookup else player_id
+            emails[email.casefold()] = player_id
+        lookup.update(emails)
+        return lookup
+
+    def parse(self, records, lookup):
+        """Validates every record, keeping only the compact fields needed to load it"""
+        rows = []
+        errors = []
+        for line, record in records:
+            try:
+                rows.append(self.parse_record(line, record, lookup))
+            except ValueError as e:
+                errors.append(f"line {line}: {e}")
+
+        if errors:
+            shown = "\n".join(errors[:MAX_REPORTED_ERRORS])
+            more = len(errors) - MAX_REPORTED_ERRORS
+            raise CommandError(
+                f"{len(errors)} invalid rows, nothing was imported:\n{shown}"
+                + (f"\n... and {more} more" if more > 0 else "")
+            )
+        return rows
+
+    def parse_record(self, line, record, lookup):
+        if isinstance(record, Exception):
+            raise ValueError(f"invalid JSON ({record})")
+        if not isinstance(record, dict):
+            raise ValueError("expected an object")
+
+        player_ids = []
+        for slot in PLAYER_SLOTS:
+            reference = str(record.get(slot) or '').strip()
+            if not reference:
+                raise ValueError(f"missing {slot}")
+            player_id = lookup.get(reference.casefold())
+            if player_id is None:
+                raise ValueError(f"unknown player {reference!r}")
+            if player_id is AMBIGUOUS:
+                raise ValueError(f"several players are called {reference!r}, use their email")
+            player_ids.append(player_id)
+        if len(set(player_ids)) != 4:
+            raise ValueError("all four players in a match must be distinct")
+
+        try:
+            team1_score = int(record.get('team1_score'))
+            team2_score = int(record.get('team2_score'))
+        except (TypeError, ValueError):
+            raise ValueError("scores must be whole numbers")
+        if team1_score < 0 or team2_score < 0:
+            raise ValueError("scores cannot be negative")
+        if team1_score == team2_score:
+            raise ValueError("match scores cannot be equal; draws are not allowed")
+
+        return ImportedMatch(
+            self.parse_date(record.get('date_played')), line, tuple(player_ids), team1_score, team2_score
+        )
+
+    def parse_date(self, value):
+        value = str(value or '').strip()
+        try:
+            date_played = parse_datetime(value)
+            if date_played is None:
+                day = parse_date(value)
+                date_played = day and datetime.combine(day, datetime.min.time())
+        except ValueError:
+            date_played = None
+        if date_played is None:
+            raise ValueError(f"invalid date_played {value!r}")
+        if timezone.is_naive(date_played):
+            date_played = timezone.make_aware(date_played)
+        return date_played
+
+    def load_year(self, year, rows, batch_size):
+        """
+        Loads one year's matches. Matches that all come after the year's existing
+        ones are rated in memory as they are loaded, continuing from each player's
+        latest ratings in that year; otherwise the year is recomputed afterwards.
+        Players only take the new ratings for the current year.
+        """
+        current_season = year == timezone.now().year
+        last_existing = Match.objects.filter(year=year).aggregate(last=Max('date_played'))['last']
+        appends = last_existing is None or last_existing <= rows[0].date_played
+        ratings = self.seed_ratings(year, rows, current_season) if appends else None
+
+        first_date = rows[0].date_played
+        rows = iter(rows)
+        loaded = 0
+        while chunk := list(islice(rows, batch_size)):
+            matches, participants, events = [], [], []
+            for match_id, row in zip(reserve_ids(Match, len(chunk)), chunk):
+                team1_won = row.team1_score > row.team2_score
+                match = [match_id, *row.player_ids, row.team1_score, row.team2_score,
+                         Match.MatchResult.TEAM1_WIN if team1_won else Match.MatchResult.TEAM2_WIN,
+                         row.date_played, year]
+                if ratings is not None:
+                    match += ratings.play(match_id, row.player_ids, team1_won, row.date_played, year,
+                                          participants, events)
+                else:
+                    match += UNRATED
+                matches.append(match)
+
+            copy_rows(Match, MATCH_ROW_FIELDS, matches, batch_size)
+            copy_rows(MatchParticipant, PARTICIPANT_ROW_FIELDS, participants, batch_size)
+            copy_rows(RatingEvent, EVENT_ROW_FIELDS, events, batch_size)
+            loaded += len(chunk)
+
+        if ratings is None:
+            # Rebuilds snapshots, events, participants and pairs for the whole year
+            recompute_year(year, batch_size=batch_size, update_players=current_season, since=first_date)
+            self.stdout.write(f"{year}: {loaded} matches interleave with existing ones, recomputed the year")
+            return
+
+        rebuild_pair_records(year)
+        build_checkpoints(year)
+        if current_season:
+            players = list(Player.objects.filter(pk__in=ratings.elo))
+            for player in players:
+                ratings.apply_to(player)
+            Player.objects.bulk_update(players, PLAYER_RATING_FIELDS, batch_size=batch_size)
+        self.stdout.write(f"{year}: appended {loaded} matches")
+
+    def seed_ratings(self, year, rows, current_season):
+        """Every imported player's ratings just before the import, within `year`"""
+        player_ids = {player_id for row in rows for player_id in row.player_ids}
+        ratings = RatingTable()
+        if current_season:
+            for player in Player.objects.filter(pk__in=player_ids):
+                ratings.add_player(player)
+            return ratings
+
+        for player_id in player_ids:
+            ratings.add(player_id)
+        # Past years: the player rows hold current ratings, so replay from the year's own history
+        latest = (
+            RatingEvent.objects.filter(year=year, player_id__in=player_ids)
+            .order_by('date_played', 'match_id')
+            .values_list('player_id', 'elo_after', 'trueskill_mu_after', 'trueskill_sigma_after', 'won', 'date_played')
+        )
+        for player_id, elo, mu, sigma, won, date_played in latest.iterator():
+            ratings.add(player_id, elo, mu, sigma, ratings.played[player_id] + 1,
+                        ratings.won[player_id] + won, date_played)
+        return ratings
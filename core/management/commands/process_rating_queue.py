@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from core.checkpoints import build_checkpoints
+from core.rating_queue import BATCH_SIZE, apply_next_batch, queue_status
+
+
+class Command(BaseCommand):
+    help = (
+        "Applies the ratings of matches queued with RATING_QUEUE on, in date order and in batches, and "
+        "adds rating checkpoints when idle. Runs until stopped, polling the queue when it is empty, "
+        "unless --once is given"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls of an empty queue')
+        parser.add_argument('--once', action='store_true', help='Drain the queue and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            # A long-running worker must not keep a connection the database has dropped
+            close_old_connections()
+            start = time.perf_counter()
+            applied = apply_next_batch(options['batch_size'])
+            if applied:
+                status = queue_status()
+                self.stdout.write(
+                    f"Rated {applied} matches in {(time.perf_counter() - start) * 1000:.0f} ms, "
+                    f"{status['pending']} pending, lag {status['lag']:.1f}s"
+                )
+                continue
+            if build_checkpoints(timezone.now().year):
+                self.stdout.write("Added rating checkpoints")
+            if options['once']:
+                self.stdout.write(self.style.SUCCESS("Rating queue is empty"))
+                return
+            time.sleep(options['interval'])
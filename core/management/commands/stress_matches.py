@@ -0,0 +1,154 @@
+import math
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from core.cache import bump_league_version
+from core.checkpoints import invalidate as invalidate_checkpoints
+from core.models import Match, MatchParticipant, Player, RatingEvent
+from core.rating_queue import apply_next_batch
+from core.recompute import RatingTable
+
+MODES = ('shared', 'disjoint')
+
+
+class Command(BaseCommand):
+    help = (
+        "Records matches from concurrent threads, each on its own database connection like a gunicorn "
+        "worker, then checks that no rating update was lost. In shared mode every thread draws from one "
+        "small pool of players; in disjoint mode each thread has four players of its own. With "
+        "RATING_QUEUE on, the queue is drained before checking. Needs a database with row locks (PostgreSQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--matches', type=int, default=50, help='Matches recorded by each worker')
+        parser.add_argument('--pool', type=int, default=8, help='Players shared by all workers in shared mode')
+        parser.add_argument('--mode', choices=MODES + ('both',), default='both')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help='Keep the stress players and their matches')
+
+    def handle(self, *args, **options):
+        if options['pool'] < 4:
+            raise CommandError("--pool must be at least 4")
+        modes = MODES if options['mode'] == 'both' else (options['mode'],)
+
+        failures = []
+        created = []
+        try:
+            for mode in modes:
+                players = self.create_players(mode, options)
+                created += players
+                elapsed, errors = self.run_workers(mode, players, options)
+                recorded = options['workers'] * options['matches'] - len(errors)
+                self.stdout.write(
+                    f"{mode:<9} {options['workers']} workers recorded {recorded} matches in {elapsed:.2f}s "
+                    f"({recorded / elapsed:.0f} matches/s), {len(errors)} failed"
+                )
+                failures += [f"{mode}: {error}" for error in errors[:10]]
+                if settings.RATING_QUEUE:
+                    start = time.perf_counter()
+                    while apply_next_batch():
+                        pass
+                    self.stdout.write(f"{mode:<9} rating queue drained in {time.perf_counter() - start:.2f}s")
+                failures += [f"{mode}: {problem}" for problem in self.verify(players)]
+        finally:
+            if created and not options['keep']:
+                first = Match.objects.filter(team1_player1__in=created).order_by('date_played', 'id').first()
+                if first is not None:
+                    # Their matches disappear with them, without going through Match.delete()
+                    invalidate_checkpoints(first.year, first.date_played, first.pk)
+                Player.objects.filter(pk__in=[player.pk for player in created]).delete()
+                bump_league_version()
+
+        if failures:
+            for failure in failures:
+                self.stderr.write(failure)
+            raise CommandError(f"{len(failures)} problem(s) found")
+        self.stdout.write(self.style.SUCCESS("No lost updates"))
+
+    def create_players(self, mode, options):
+        count = options['pool'] if mode == 'shared' else 4 * options['workers']
+        run = uuid.uuid4().hex[:8]
+        return Player.objects.bulk_create([
+            Player(name=f"Stress {mode} {index}", email=f"stress-{run}-{index}@example.com")
+            for index in range(count)
+        ])
+
+    def run_workers(self, mode, players, options):
+        errors = []
+        start_barrier = threading.Barrier(options['workers'])
+
+        def work(worker):
+            rng = random.Random(options['seed'] * 1000 + worker)
+            own = players if mode == 'shared' else players[4 * worker:4 * worker + 4]
+            try:
+                start_barrier.wait()
+                for _ in range(options['matches']):
+                    four = rng.sample(own, 4)
+                    winner_score, loser_score = 10, rng.randint(0, 9)
+                    scores = (winner_score, loser_score) if rng.random() < 0.5 else (loser_score, winner_score)
+                    try:
+                        Match(
+                            team1_player1=four[0], team1_player2=four[1],
+                            team2_player1=four[2], team2_player2=four[3],
+                            team1_score=scores[0], team2_score=scores[1], date_played=timezone.now(),
+                        ).save()
+                    except Exception as e:
+                        errors.append(f"worker {worker}: {type(e).__name__}: {e}")
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work, args=(worker,)) for worker in range(options['workers'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, errors
+
+    def verify(self, players):
+        """
+        Compares the stored ratings with a replay of the players' matches in
+        chronological order; the stress players only ever play each other.
+        """
+        problems = []
+        player_ids = [player.pk for player in players]
+        matches = list(
+            Match.objects.filter(team1_player1__in=player_ids).order_by('date_played', 'id')
+            .values_list('id', 'team1_player1', 'team1_player2', 'team2_player1', 'team2_player2',
+                         'result', 'date_played', 'year')
+        )
+
+        expected = RatingTable()
+        for player_id in player_ids:
+            expected.add(player_id)
+        participants, events = [], []
+        for match_id, *ids, result, date_played, year in matches:
+            expected.play(match_id, ids, result == Match.MatchResult.TEAM1_WIN, date_played, year, participants, events)
+
+        stored_events = RatingEvent.objects.filter(player_id__in=player_ids).count()
+        if stored_events != len(events):
+            problems.append(f"{stored_events} rating events stored for {len(matches)} matches, expected {len(events)}")
+        stored_participants = MatchParticipant.objects.filter(player_id__in=player_ids).count()
+        if stored_participants != len(participants):
+            problems.append(f"{stored_participants} participants stored, expected {len(participants)}")
+
+        for player in Player.objects.filter(pk__in=player_ids).order_by('pk'):
+            if (player.matches_played, player.matches_won) != (expected.played[player.pk], expected.won[player.pk]):
+                problems.append(
+                    f"{player.name}: {player.matches_played} played/{player.matches_won} won, expected "
+                    f"{expected.played[player.pk]}/{expected.won[player.pk]}"
+                )
+            elif player.elo_rating != expected.elo[player.pk] or not (
+                math.isclose(player.trueskill_mu, expected.mu[player.pk], rel_tol=1e-9)
+                and math.isclose(player.trueskill_sigma, expected.sigma[player.pk], rel_tol=1e-9)
+            ):
+                problems.append(f"{player.name}: ratings differ from a chronological replay")
+        return problems
@@ -0,0 +1,98 @@
+"""
+Team balancing and predictions for 2v2 matches.
+
+Every group of four present players, and each of the three ways to split it
+into two teams, is scored with TrueSkill's match quality in a single NumPy
+pass, so a whole session of 30-40 players is ranked in milliseconds. Batches
+of arbitrary matchups are predicted the same way.
+"""
+import math
+from functools import lru_cache
+from itertools import chain, combinations
+
+import numpy as np
+
+from .models import TRUESKILL_DEFAULT_BETA, Player
+from .ratings import win_probabilities
+
+# C(48, 4) * 3 = 583740 candidate matchups, a few tens of MB of arrays
+MAX_PLAYERS = 48
+BETA_SQ = TRUESKILL_DEFAULT_BETA ** 2
+# Column orders of the three splits of a foursome (a, b, c, d): ab-cd, ac-bd, ad-bc
+SPLITS = np.array([[0, 1, 2, 3], [0, 2, 1, 3], [0, 3, 1, 2]])
+
+
+@lru_cache(maxsize=8)
+def _foursomes(n):
+    """(C(n, 4), 4) array of every selection of four indexes out of n"""
+    flat = np.fromiter(chain.from_iterable(combinations(range(n), 4)), dtype=np.intp, count=4 * math.comb(n, 4))
+    foursomes = flat.reshape(-1, 4)
+    foursomes.flags.writeable = False
+    return foursomes
+
+
+def match_quality(mu, sigma):
+    """
+    TrueSkill match quality of 2v2 matchups, the same value trueskill.quality()
+    gives for two teams. mu and sigma are (..., 4) arrays ordered team1_player1,
+    team1_player2, team2_player1, team2_player2.
+    """
+    c_sq = 4 * BETA_SQ + (sigma ** 2).sum(axis=-1)
+    diff = mu[..., 0] + mu[..., 1] - mu[..., 2] - mu[..., 3]
+    return np.sqrt(4 * BETA_SQ / c_sq) * np.exp(-diff ** 2 / (2 * c_sq))
+
+
+def balanced_matchups(mu, sigma, top_k=5):
+    """
+    The `top_k` most balanced matchups among players with the given ratings,
+    best first, keeping only the fairest split of any four players.
+
+    Returns (quality, (i, j, k, l)) pairs, where i, j is team 1 and k, l team 2
+    as indexes into mu and sigma. Raises ValueError for fewer than four or more
+    than MAX_PLAYERS players.
+    """
+    mu = np.asarray(mu, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+    if len(mu) < 4:
+        raise ValueError("At least four players are needed for a match")
+    if len(mu) > MAX_PLAYERS:
+        raise ValueError(f"Matchmaking supports at most {MAX_PLAYERS} players at a time")
+
+    candidates = _foursomes(len(mu))[:, SPLITS]  # (foursomes, 3 splits, 4 players)
+    quality = match_quality(mu[candidates], sigma[candidates])
+    best_split = quality.argmax(axis=1)
+    best_quality = quality[np.arange(len(quality)), best_split]
+
+    top_k = max(1, min(top_k, len(best_quality)))
+    top = np.argpartition(-best_quality, top_k - 1)[:top_k]
+    top = top[np.argsort(-best_quality[top], kind='stable')]
+    return [
+        (float(best_quality[index]), tuple(int(player) for player in candidates[index, best_split[index]]))
+        for index in top
+    ]
+
+
+def predict_matchups(matchups):
+    """
+    Team 1's Elo and TrueSkill win probabilities and the match quality of each
+    (team1_player1, team1_player2, team2_player1, team2_player2) tuple of player
+    ids, from current ratings with inactivity decay, using a single query.
+
+    Returns three lists in the order of `matchups`. Raises ValueError naming
+    any unknown player ids.
+    """
+    ids = np.asarray(matchups, dtype=np.int64).reshape(-1, 4)
+    wanted = np.unique(ids)
+    ratings = np.array(
+        Player.objects.filter(pk__in=wanted.tolist()).with_trueskill_score()
+        .order_by('pk').values_list('pk', 'elo_rating', 'trueskill_mu', 'decayed_trueskill_sigma'),
+        dtype=float,
+    ).reshape(-1, 4)
+    if len(ratings) != len(wanted):
+        unknown = sorted(set(wanted.tolist()) - set(ratings[:, 0].astype(np.int64).tolist()))
+        raise ValueError(f"Unknown players: {', '.join(map(str, unknown))}")
+
+    rows = np.searchsorted(wanted, ids)  # ratings rows line up with the sorted unique ids
+    elo, mu, sigma = ratings[rows, 1], ratings[rows, 2], ratings[rows, 3]
+    elo_expected, trueskill_expected = win_probabilities(elo, mu, sigma)
+    return elo_expected.tolist(), trueskill_expected.tolist(), match_quality(mu, sigma).tolist()
@@ -0,0 +1,290 @@
+"""
+Request and job instrumentation exposed in the Prometheus text format.
+
+Each process keeps its counters and histograms in memory and writes them to
+its own file in METRICS_DIR at most once a second; /metrics sums the files of
+every process, so a scrape sees all gunicorn workers whichever one answers.
+When a scrape finds files of workers that have exited, it adds them into
+exited.json and removes them. Counters never go backwards, and the directory
+doesn't grow with every restart.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+# Seconds; the last buckets are there to catch jobs running into gunicorn's timeout
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FLUSH_INTERVAL = 1.0
+# Running totals of every exited worker
+EXITED_FILE = 'exited.json'
+
+HELP = {
+    'zipleague_http_request_duration_seconds': ('histogram', 'Time to build the response, by view'),
+    'zipleague_http_db_queries_total': ('counter', 'Database queries run while handling requests'),
+    'zipleague_http_db_query_seconds_total': ('counter', 'Time spent in database queries while handling requests'),
+    'zipleague_http_response_bytes_total': ('counter', 'Size of non-streaming response bodies'),
+    'zipleague_job_duration_seconds': ('histogram', 'Duration of rating updates, recomputes and archives'),
+}
+
+
+class QueryRecorder:
+    """
+    Counts and times queries through an execute wrapper. CaptureQueriesContext
+    can't be used here because every request resets connection.queries.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.elapsed += time.perf_counter() - start
+
+
+class Registry:
+    """This process's metrics, keyed by (name, sorted label pairs)"""
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        # name, labels -> bucket counts followed by sum and count
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._path = None
+        self._flushed_at = 0.0
+        self._timer = None
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self.counters[name, _label_key(labels)] += amount
+        self.maybe_flush()
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            key = name, _label_key(labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= FLUSH_INTERVAL:
+            self.flush()
+        elif self._timer is None:
+            # Idle workers still publish their last requests, a second late
+            self._timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Atomically replaces this process's file with its current values"""
+        with self._lock:
+            self._flushed_at = time.monotonic()
+            self._timer = None
+            data = {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, values] for (name, labels), values in self.histograms.items()],
+            }
+            directory = metrics_dir()
+            if self._path is None:
+                # pid alone could be reused by a later worker and overwrite an exited one's totals;
+                # the host tells whose pid it is when several containers share the directory
+                self._path = os.path.join(
+                    directory, f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}.json'
+                )
+            try:
+                os.makedirs(directory, exist_ok=True)
+                temporary = f'{self._path}.tmp'
+                with open(temporary, 'w') as metrics_file:
+                    json.dump(data, metrics_file)
+                os.replace(temporary, self._path)
+            except OSError:
+                # Metrics must never break a request
+                pass
+
+
+registry = Registry()
+
+
+def metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'zipleague-metrics')
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def observe_request(view, method, status, duration, queries, query_time, size):
+    labels = {'view': view, 'method': method, 'status': status}
+    registry.observe('zipleague_http_request_duration_seconds', labels, duration)
+    registry.inc('zipleague_http_db_queries_total', {'view': view}, queries)
+    registry.inc('zipleague_http_db_query_seconds_total', {'view': view}, query_time)
+    if size is not None:
+        registry.inc('zipleague_http_response_bytes_total', {'view': view}, size)
+
+
+@contextlib.contextmanager
+def timed(job):
+    """Records how long the block takes as `job`; also works as a function decorator"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('zipleague_job_duration_seconds', {'job': job}, time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """Records latency, query count and time, and response size for every request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = (match.view_name if match else None) or 'unmatched'
+        # Streaming bodies are produced after this returns; only their time to first byte is counted
+        size = None if response.streaming else len(response.content)
+        observe_request(view, request.method, response.status_code, duration, recorder.count, recorder.elapsed, size)
+        return response
+
+
+def _owner_exited(filename):
+    """Whether the worker that wrote a metrics file was on this host and is gone"""
+    parts = filename[:-len('.json')].rsplit('-', 2)
+    # Files written before the host was part of the name are this host's
+    host, pid = parts[:2] if len(parts) == 3 else (socket.gethostname(), parts[0])
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # Alive, but someone else's
+        pass
+    return False
+
+
+def _read(path):
+    try:
+        with open(path) as metrics_file:
+            return json.load(metrics_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _add(counters, histograms, data):
+    for name, labels, value in data['counters']:
+        counters[name, tuple(map(tuple, labels))] += value
+    for name, labels, values in data['histograms']:
+        key = name, tuple(map(tuple, labels))
+        if key in histograms:
+            histograms[key] = [total + value for total, value in zip(histograms[key], values)]
+        else:
+            histograms[key] = list(values)
+
+
+def _fold_exited(directory, names):
+    """Adds the files of exited workers into EXITED_FILE and removes them"""
+    exited = [name for name in names if name != EXITED_FILE and _owner_exited(name)]
+    if not exited:
+        return
+    counters, histograms = defaultdict(float), {}
+    for name in [EXITED_FILE] + exited:
+        data = _read(os.path.join(directory, name))
+        if data is not None:
+            _add(counters, histograms, data)
+    path = os.path.join(directory, EXITED_FILE)
+    with open(f'{path}.tmp', 'w') as metrics_file:
+        json.dump({
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'histograms': [[name, labels, values] for (name, labels), values in histograms.items()],
+        }, metrics_file)
+    os.replace(f'{path}.tmp', path)
+    for name in exited:
+        os.remove(os.path.join(directory, name))
+
+
+def collect():
+    """Sums the files of every process that has written metrics"""
+    registry.flush()
+    counters = defaultdict(float)
+    histograms = {}
+    directory = metrics_dir()
+    try:
+        lock_file = open(os.path.join(directory, 'collect.lock'), 'w')
+    except OSError:
+        # Nothing was ever written
+        return counters, histograms
+    with lock_file:
+        # Scrapes take turns, so none sees a folded file twice or not at all
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        names = [name for name in os.listdir(directory) if name.endswith('.json')]
+        try:
+            _fold_exited(directory, names)
+        except OSError:
+            pass
+        for filename in os.listdir(directory):
+            if filename.endswith('.json') and (data := _read(os.path.join(directory, filename))) is not None:
+                _add(counters, histograms, data)
+    return counters, histograms
+
+
+def render():
+    """Every process's metrics in the Prometheus text exposition format"""
+    counters, histograms = collect()
+    lines = []
+    for name, (kind, description) in HELP.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(DURATION_BUCKETS, values):
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", f"{bound:g}"),))} {count}')
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {values[-1]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(values[-2])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {values[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
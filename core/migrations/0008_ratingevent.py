@@ -0,0 +1,102 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:16
+
+import math
+
+import django.db.models.deletion
+import trueskill
+from django.db import migrations, models
+from trueskill.backends import cdf, pdf
+
+SLOTS = ['team1_player1', 'team1_player2', 'team2_player1', 'team2_player2']
+
+# The rating model as of this migration, frozen here so later changes to
+# core.ratings or the league's TrueSkill settings can't change the backfill
+TAU_SQ = 0.0833 ** 2
+PERFORMANCE_VARIANCE = 4 * 4.16 ** 2
+DRAW_MARGIN = trueskill.calc_draw_margin(0.1, 4)
+
+
+def rate_2v2(team1, team2, team1_won):
+    """Closed-form TrueSkill update of a 2v2 match without draws, as core.ratings.rate_2v2 had it"""
+    winners, losers = (team1, team2) if team1_won else (team2, team1)
+    variances = [sigma ** 2 + TAU_SQ for _, sigma in winners + losers]
+    c_sq = sum(variances) + PERFORMANCE_VARIANCE
+    c = math.sqrt(c_sq)
+    x = (winners[0][0] + winners[1][0] - losers[0][0] - losers[1][0]) / c - DRAW_MARGIN / c
+    denom = cdf(x)
+    v = pdf(x) / denom if denom else -x
+    w = v * (v + x)
+    rated = [
+        (mu + (1 if index < 2 else -1) * variance / c * v, math.sqrt(variance * (1 - variance / c_sq * w)))
+        for index, ((mu, _), variance) in enumerate(zip(winners + losers, variances))
+    ]
+    new_winners, new_losers = tuple(rated[:2]), tuple(rated[2:])
+    return (new_winners, new_losers) if team1_won else (new_losers, new_winners)
+
+
+def backfill_rating_events(apps, schema_editor):
+    """Derives each match's before/after ratings from its stored snapshots"""
+    Match = apps.get_model('core', 'Match')
+    RatingEvent = apps.get_model('core', 'RatingEvent')
+
+    events = []
+    for match in Match.objects.order_by('date_played', 'id').iterator(chunk_size=2000):
+        team1_won = match.result == 'team1_win'
+        before = [
+            (getattr(match, f'{slot}_trueskill_mu_before'), getattr(match, f'{slot}_trueskill_sigma_before'))
+            for slot in SLOTS
+        ]
+        team1_after, team2_after = rate_2v2(before[:2], before[2:], team1_won)
+        for slot, (mu_before, sigma_before), (mu_after, sigma_after) in zip(SLOTS, before, team1_after + team2_after):
+            won = slot.startswith('team1') == team1_won
+            elo_before = getattr(match, f'{slot}_elo_before')
+            events.append(RatingEvent(
+                player_id=getattr(match, f'{slot}_id'),
+                match_id=match.pk,
+                year=match.year,
+                date_played=match.date_played,
+                won=won,
+                elo_before=elo_before,
+                elo_after=elo_before + (match.elo_change if won else -match.elo_change),
+                trueskill_mu_before=mu_before,
+                trueskill_sigma_before=sigma_before,
+                trueskill_mu_after=mu_after,
+                trueskill_sigma_after=sigma_after,
+            ))
+        if len(events) >= 8000:
+            RatingEvent.objects.bulk_create(events)
+            events = []
+    RatingEvent.objects.bulk_create(events)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_yeararchive_match_year_player_current_year_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('date_played', models.DateTimeField()),
+                ('won', models.BooleanField()),
+                ('elo_before', models.IntegerField()),
+                ('elo_after', models.IntegerField()),
+                ('trueskill_mu_before', models.FloatField()),
+                ('trueskill_sigma_before', models.FloatField()),
+                ('trueskill_mu_after', models.FloatField()),
+                ('trueskill_sigma_after', models.FloatField()),
+                ('match', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_events', to='core.match')),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_events', to='core.player')),
+            ],
+            options={
+                'ordering': ['date_played', 'match_id'],
+                'indexes': [models.Index(fields=['player', 'year', 'date_played', 'match'], name='ratingevent_player_history')],
+                'unique_together': {('player', 'match')},
+            },
+        ),
+        migrations.RunPython(backfill_rating_events, migrations.RunPython.noop),
+    ]
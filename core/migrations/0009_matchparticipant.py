@@ -0,0 +1,58 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+SLOTS = ['team1_player1', 'team1_player2', 'team2_player1', 'team2_player2']
+
+
+def backfill_participants(apps, schema_editor):
+    Match = apps.get_model('core', 'Match')
+    MatchParticipant = apps.get_model('core', 'MatchParticipant')
+
+    participants = []
+    for match in Match.objects.iterator(chunk_size=2000):
+        team1_won = match.result == 'team1_win'
+        for slot in SLOTS:
+            participants.append(MatchParticipant(
+                match_id=match.pk,
+                player_id=getattr(match, f'{slot}_id'),
+                team=1 if slot.startswith('team1') else 2,
+                slot=1 if slot.endswith('1') else 2,
+                won=slot.startswith('team1') == team1_won,
+                year=match.year,
+                date_played=match.date_played,
+            ))
+        if len(participants) >= 8000:
+            MatchParticipant.objects.bulk_create(participants)
+            participants = []
+    MatchParticipant.objects.bulk_create(participants)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_ratingevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchParticipant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('team', models.PositiveSmallIntegerField()),
+                ('slot', models.PositiveSmallIntegerField()),
+                ('won', models.BooleanField()),
+                ('year', models.IntegerField()),
+                ('date_played', models.DateTimeField()),
+                ('match', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='core.match')),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participations', to='core.player')),
+            ],
+            options={
+                'ordering': ['date_played', 'match_id'],
+                'indexes': [models.Index(fields=['player', 'year', 'date_played'], name='participant_player_history'), models.Index(fields=['year', 'player'], name='participant_year_player')],
+                'unique_together': {('match', 'player')},
+            },
+        ),
+        migrations.RunPython(backfill_participants, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_matchparticipant'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['date_played', 'id'], name='match_chronological'),
+        ),
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['year', 'date_played', 'id'], name='match_year_chronological'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_pair_records(apps, schema_editor):
+    MatchParticipant = apps.get_model('core', 'MatchParticipant')
+    PairRecord = apps.get_model('core', 'PairRecord')
+    quote = schema_editor.quote_name
+    participants = quote(MatchParticipant._meta.db_table)
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {quote(PairRecord._meta.db_table)}
+                (player_a_id, player_b_id, relation, year, played, won, last_played)
+            SELECT a.player_id, b.player_id,
+                   CASE WHEN a.team = b.team THEN 'partner' ELSE 'opponent' END,
+                   a.year, COUNT(*), SUM(CASE WHEN a.won THEN 1 ELSE 0 END), MAX(a.date_played)
+            FROM {participants} a
+            JOIN {participants} b ON b.match_id = a.match_id AND b.player_id > a.player_id
+            GROUP BY a.year, a.player_id, b.player_id, a.team = b.team
+            """
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_requestprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PairRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('relation', models.CharField(choices=[('partner', 'Partners'), ('opponent', 'Opponents')], max_length=8)),
+                ('year', models.IntegerField()),
+                ('played', models.IntegerField(default=0)),
+                ('won', models.IntegerField(default=0)),
+                ('last_played', models.DateTimeField(blank=True, null=True)),
+                ('player_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pair_records_as_a', to='core.player')),
+                ('player_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pair_records_as_b', to='core.player')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['player_b', 'year'], name='pairrecord_player_b')],
+                'unique_together': {('player_a', 'player_b', 'relation', 'year')},
+            },
+        ),
+        migrations.RunPython(backfill_pair_records, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_pairrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='rating_queued_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(condition=models.Q(('rating_queued_at__isnull', False)), fields=['date_played', 'id'], name='match_rating_queue'),
+        ),
+    ]
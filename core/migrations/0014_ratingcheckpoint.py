@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_match_rating_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('date_played', models.DateTimeField()),
+                ('match_id', models.BigIntegerField()),
+                ('matches', models.IntegerField()),
+                ('players', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['year', 'date_played', 'match_id'],
+                'indexes': [models.Index(fields=['year', 'date_played', 'match_id'], name='checkpoint_position')],
+            },
+        ),
+    ]
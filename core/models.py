@@ -1,10 +1,15 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, Count, DurationField, Exists, ExpressionWrapper, F, FloatField, OuterRef, Q, Value, When
+from django.db.models.functions import Cast, Extract, Power
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 import uuid
 from datetime import timedelta
 import trueskill
 
+from .metrics import timed
+
 TRUESKILL_DEFAULT_MU = 25.0
 TRUESKILL_DEFAULT_SIGMA = TRUESKILL_DEFAULT_MU / 3
 TRUESKILL_DEFAULT_BETA = 4.16
@@ -19,6 +24,85 @@ def get_current_year():
     return timezone.now().year
 
 
+def decayed_sigma(sigma, last_match_date, now=None):
+    """
+    TrueSkill sigma after inactivity decay at `now` (default: now): from the
+    seventh day without a match it drifts back towards the default by 1% a day
+    """
+    if last_match_date is None:
+        return sigma
+
+    days_inactive = ((now or timezone.now()) - last_match_date).days
+
+    if days_inactive < 7:
+        return sigma
+
+    # Apply decay for each day after day 6
+    days_of_decay = days_inactive - 6
+    decay_factor = 0.99 ** days_of_decay
+    return sigma * decay_factor + TRUESKILL_DEFAULT_SIGMA * (1 - decay_factor)
+
+
+class PlayerQuerySet(models.QuerySet):
+    def with_trueskill_score(self, now=None):
+        """
+        Annotates the decayed TrueSkill sigma and the conservative score (mu - 3*sigma)
+        in SQL, mirroring Player.effective_trueskill_sigma, so rankings can be
+        ordered and limited by the database.
+        """
+        now = now or timezone.now()
+        days_inactive = Extract(
+            ExpressionWrapper(Value(now) - F('last_match_date'), output_field=DurationField()), 'day'
+        )
+        decay_factor = Power(Value(0.99), days_inactive - 6, output_field=FloatField())
+        decayed_sigma = Case(
+            When(
+                Q(last_match_date__isnull=True) | Q(last_match_date__gt=now - timedelta(days=7)),
+                then=F('trueskill_sigma'),
+            ),
+            default=F('trueskill_sigma') * decay_factor + Value(TRUESKILL_DEFAULT_SIGMA) * (1 - decay_factor),
+            output_field=FloatField(),
+        )
+        return self.annotate(
+            decayed_trueskill_sigma=decayed_sigma,
+            conservative_score=ExpressionWrapper(
+                F('trueskill_mu') - 3 * F('decayed_trueskill_sigma'), output_field=FloatField()
+            ),
+        )
+
+    def lock(self, player_ids=None):
+        """
+        Locks the rows of the given players, or of all of them, until the
+        transaction ends and returns them by id. Rows are always locked in
+        primary key order, so writers locking overlapping sets can't deadlock.
+        """
+        queryset = self if player_ids is None else self.filter(pk__in=player_ids)
+        return {player.pk: player for player in queryset.select_for_update().order_by('pk')}
+
+    def reset_ratings(self, **fields):
+        """
+        Resets ratings and records to the start-of-season defaults in one
+        UPDATE, like reset_player_ratings() in memory; `fields` are set too
+        """
+        return self.update(
+            elo_rating=1000, trueskill_mu=TRUESKILL_DEFAULT_MU, trueskill_sigma=TRUESKILL_DEFAULT_SIGMA,
+            matches_played=0, matches_won=0, matches_lost=0, last_match_date=None, **fields,
+        )
+
+    def with_win_percentage(self):
+        """Annotates win_rate, the SQL counterpart of Player.win_percentage"""
+        return self.annotate(
+            win_rate=Case(
+                When(matches_played=0, then=Value(0.0)),
+                default=ExpressionWrapper(
+                    Cast('matches_won', FloatField()) * 100 / Cast('matches_played', FloatField()),
+                    output_field=FloatField(),
+                ),
+                output_field=FloatField(),
+            ),
+        )
+
+
 class Player(models.Model):
     name = models.CharField(max_length=100)
     email = models.EmailField(unique=True)
@@ -32,6 +116,8 @@ class Player(models.Model):
     last_match_date = models.DateTimeField(null=True, blank=True)
     current_year = models.IntegerField(default=get_current_year)
 
+    objects = PlayerQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -44,21 +130,10 @@ class Player(models.Model):
     @property
     def effective_trueskill_sigma(self):
         """Returns the current effective TrueSkill sigma with decay applied for inactivity"""
-        if self.last_match_date is None:
-            return self.trueskill_sigma
-
-        days_inactive = (timezone.now() - self.last_match_date).days
-        
-        if days_inactive < 7:
-            return self.trueskill_sigma
-        
-        # Apply decay for each day after day 6
-        default_sigma = TRUESKILL_DEFAULT_SIGMA
-        days_of_decay = days_inactive - 6
-        decay_factor = 0.99 ** days_of_decay
-        decayed_sigma = self.trueskill_sigma * decay_factor + default_sigma * (1 - decay_factor)
-        
-        return decayed_sigma
+        if hasattr(self, 'decayed_trueskill_sigma'):
+            # Already computed by PlayerQuerySet.with_trueskill_score()
+            return self.decayed_trueskill_sigma
+        return decayed_sigma(self.trueskill_sigma, self.last_match_date)
     
     @property
     def trueskill_rating(self):
@@ -104,6 +179,47 @@ class RegistrationToken(models.Model):
     def __str__(self):
         return f"Registration Token {self.token} (created by {self.created_by.username})"
 
+# Player FK names of a match, in the order ratings and snapshots are laid out
+PLAYER_SLOTS = ['team1_player1', 'team1_player2', 'team2_player1', 'team2_player2']
+
+
+class _Backdated(Exception):
+    """Rolls back the savepoint holding a backdated match's player locks"""
+
+
+def _checkpoint_on_commit(year):
+    """
+    Adds the rating checkpoints due in `year` once the transaction commits,
+    so state_at() replays stay short without a queue worker
+    """
+    from .checkpoints import build_checkpoints
+    transaction.on_commit(lambda: build_checkpoints(year), robust=True)
+
+
+class MatchQuerySet(models.QuerySet):
+    def involving(self, player, partner=None, opponent=None):
+        """Matches played by `player`, optionally alongside `partner` and/or against `opponent`"""
+        participations = MatchParticipant.objects.filter(player=player)
+        if partner is not None:
+            participations = participations.partnered_with(partner)
+        if opponent is not None:
+            participations = participations.against(opponent)
+        return self.filter(pk__in=participations.values('match'))
+
+    def years(self):
+        """
+        Years that have matches, newest first. Walks the year index one probe
+        per year instead of running a DISTINCT over every match.
+        """
+        years = []
+        ordered = self.order_by('year').values_list('year', flat=True)
+        year = ordered.first()
+        while year is not None:
+            years.append(year)
+            year = ordered.filter(year__gt=year).first()
+        return years[::-1]
+
+
 class Match(models.Model):
     team1_player1 = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='matches_as_team1_player1')
     team1_player2 = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='matches_as_team1_player2')
@@ -141,6 +257,20 @@ class Match(models.Model):
         # Result is determined by scores in save() or clean()
     )
     elo_change = models.IntegerField(default=0)
+    # Set while the match waits in the rating queue (see core/rating_queue.py)
+    rating_queued_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = MatchQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination and chronological replays walk (date_played, id)
+            models.Index(fields=['date_played', 'id'], name='match_chronological'),
+            models.Index(fields=['year', 'date_played', 'id'], name='match_year_chronological'),
+            models.Index(
+                fields=['date_played', 'id'], name='match_rating_queue', condition=Q(rating_queued_at__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         team1_str = f"{self.team1_player1.name} & {self.team1_player2.name}"
@@ -196,69 +326,212 @@ class Match(models.Model):
         if is_new_match: # Or always, depending on desired strictness for updates too
              self.full_clean()
 
-        # Capture ELO snapshots before processing the match (only for new matches)
-        if is_new_match:
-            self.capture_elo_snapshots()
+        # An edit touching players, scores or date breaks the rating chronology
+        # (targeted saves are exempt), as does a backdated match; see lock_for_rating()
+        is_backdated = False
+        previous = None
+        if not is_new_match and kwargs.get('update_fields') is None:
+            previous = Match.objects.filter(pk=self.pk).first()
+            if previous is not None and previous.rating_inputs == self.rating_inputs:
+                previous = None
 
-        super().save(*args, **kwargs)
+        from .pairs import add_match, remove_match
 
-        if is_new_match and not hasattr(self, '_stats_updated'):
-            self.update_player_stats()
-            self._stats_updated = True
-    
+        # With RATING_QUEUE on, new matches are committed unrated and left to the queue worker
+        queued = is_new_match and settings.RATING_QUEUE and not hasattr(self, '_stats_updated')
+        if queued:
+            self.rating_queued_at = timezone.now()
+
+        with transaction.atomic():
+            if queued:
+                pass
+            elif is_new_match:
+                is_backdated = self.lock_for_rating()
+            elif previous is not None:
+                # Before touching any pair records, which concurrent inserts lock after their players
+                Player.objects.lock()
+
+            super().save(*args, **kwargs)
+
+            if is_new_match:
+                MatchParticipant.objects.bulk_create(self.build_participants())
+                add_match(self)
+            elif previous is not None:
+                from .checkpoints import invalidate
+                # A match moved to another year leaves that year's later checkpoints behind
+                invalidate(previous.year, previous.date_played, previous.pk)
+                self.participants.all().delete()
+                remove_match(previous)
+                MatchParticipant.objects.bulk_create(self.build_participants())
+                add_match(self)
+
+            if queued:
+                from .cache import bump_league_version
+                bump_league_version()
+            elif is_backdated:
+                self.recompute_from_here()
+                self._stats_updated = True
+            elif is_new_match and not hasattr(self, '_stats_updated'):
+                self.update_player_stats()
+                self._stats_updated = True
+            elif previous is not None:
+                self.recompute_from_here(previous=previous)
+
+            if not queued and (is_new_match or previous is not None):
+                _checkpoint_on_commit(self.year)
+
+    def delete(self, *args, **kwargs):
+        """Deletes the match and re-rates every later match of its year"""
+        from .pairs import remove_match
+        from .recompute import recompute_suffix
+
+        previous = Match.objects.get(pk=self.pk)
+        with transaction.atomic():
+            Player.objects.lock()
+            deleted = super().delete(*args, **kwargs)
+            remove_match(previous)
+            recompute_suffix(previous.year, previous.date_played, previous.pk, previous=previous)
+            _checkpoint_on_commit(previous.year)
+        return deleted
+
+    def lock_for_rating(self):
+        """
+        Locks the player rows a new match is rated against and returns whether
+        it is backdated, i.e. whether any of its players already has a later
+        match this year.
+
+        An in-order match locks its four players, re-reads them and captures
+        its snapshots from the locked rows, so concurrent matches sharing a
+        player are rated one after the other while matches between disjoint
+        players go ahead in parallel. A backdated one is re-rated with the rest
+        of the season by recompute_suffix(), which locks every player.
+        """
+        player_ids = [getattr(self, f'{slot}_id') for slot in PLAYER_SLOTS]
+        try:
+            with transaction.atomic():
+                locked = Player.objects.lock(player_ids)
+                # Checked under the lock: a match committed while we waited counts
+                if MatchParticipant.objects.filter(
+                    player_id__in=player_ids, year=self.year, date_played__gt=self.date_played
+                ).exists():
+                    raise _Backdated
+        except _Backdated:
+            # Rolling back the savepoint releases the four locks, so every
+            # player can then be locked in order without risking a deadlock
+            Player.objects.lock()
+            return True
+
+        for slot, player_id in zip(PLAYER_SLOTS, player_ids):
+            setattr(self, slot, locked[player_id])
+        self.capture_elo_snapshots()
+        return False
+
+    @property
+    def rating_pending(self):
+        return self.rating_queued_at is not None
+
+    @property
+    def rating_inputs(self):
+        """Everything that determines how this match affects ratings"""
+        return (
+            self.team1_player1_id, self.team1_player2_id, self.team2_player1_id, self.team2_player2_id,
+            self.result, self.date_played,
+        )
+
+    def recompute_from_here(self, previous=None):
+        """
+        Re-rates this match and every later match of its year, starting from the
+        earliest position affected by the change. `previous` is the stored version
+        of an edited match; without it the match is treated as newly inserted.
+        """
+        from .recompute import MATCH_RATING_FIELDS, recompute_suffix
+
+        if previous is None:
+            recompute_suffix(self.year, self.date_played, self.pk, unrated_id=self.pk)
+        elif previous.year < self.year:
+            # Players carry the ratings of the latest season only, so a match moved
+            # across years is re-rated as an insert or a delete in the later one
+            recompute_suffix(self.year, self.date_played, self.pk, unrated_id=self.pk)
+        elif previous.year > self.year:
+            recompute_suffix(previous.year, previous.date_played, previous.pk, previous=previous)
+        else:
+            start_date = min(previous.date_played, self.date_played)
+            recompute_suffix(self.year, start_date, self.pk, previous=previous)
+
+        self.refresh_from_db(fields=MATCH_RATING_FIELDS)
+
+    @timed('rating_update')
     def update_player_stats(self):
         """Updates player ELO ratings, TrueSkill ratings and win/loss records after a match."""
-        players = [self.team1_player1, self.team1_player2, self.team2_player1, self.team2_player2]
+        from .checkpoints import invalidate
+        from .recompute import PLAYER_RATING_FIELDS
+
+        # Normally a no-op: only a checkpoint taken after this match's date would include it
+        invalidate(self.year, self.date_played, self.pk)
+        self.apply_rating_changes()
+
+        # Only the rating fields, so a concurrent profile edit isn't overwritten
+        for player in self.players:
+            player.save(update_fields=PLAYER_RATING_FIELDS)
+
+        super().save(update_fields=['elo_change', 'result'])
+        RatingEvent.objects.bulk_create(self.build_rating_events())
+
+        from .cache import bump_league_version
+        from .player_pages import invalidate as invalidate_player_pages
+        bump_league_version()
+        # Only these four players' pages change
+        invalidate_player_pages(player.pk for player in self.players)
+
+    @property
+    def players(self):
+        return [self.team1_player1, self.team1_player2, self.team2_player1, self.team2_player2]
+
+    def apply_rating_changes(self):
+        """Applies this match's outcome to the in-memory player instances without saving anything.
+
+        Ratings are computed from the captured snapshots, so callers must run
+        capture_elo_snapshots() (or load stored snapshots) first.
+        """
+        players = self.players
         
         for player in players:
             player.matches_played += 1
         
+        from .ratings import elo_delta, rate_2v2
+
         # Use the captured ELO snapshots for calculation
-        team1_avg_elo = (self.team1_player1_elo_before + self.team1_player2_elo_before) / 2
-        team2_avg_elo = (self.team2_player1_elo_before + self.team2_player2_elo_before) / 2
-        
-        expected_team1 = 1 / (1 + 10 ** ((team2_avg_elo - team1_avg_elo) / 400))
-        k_factor = 32
-        actual_team1_score_val = 1 if self.result == self.MatchResult.TEAM1_WIN else 0
-        
-        elo_delta = round(k_factor * (actual_team1_score_val - expected_team1))
-        self.elo_change = abs(elo_delta)
+        self.elo_change = elo_delta(
+            (self.team1_player1_elo_before, self.team1_player2_elo_before),
+            (self.team2_player1_elo_before, self.team2_player2_elo_before),
+            team1_won=self.result == self.MatchResult.TEAM1_WIN,
+        )
 
-        # Team 1 gets +/- elo_delta, Team 2 gets -/+ elo_delta
+        # Team 1 gets +/- elo_change, Team 2 gets -/+ elo_change
         team1_multiplier = 1 if self.result == self.MatchResult.TEAM1_WIN else -1
-        self.team1_player1.elo_rating += team1_multiplier * abs(elo_delta)
-        self.team1_player2.elo_rating += team1_multiplier * abs(elo_delta)
-        self.team2_player1.elo_rating -= team1_multiplier * abs(elo_delta)
-        self.team2_player2.elo_rating -= team1_multiplier * abs(elo_delta)
+        self.team1_player1.elo_rating += team1_multiplier * self.elo_change
+        self.team1_player2.elo_rating += team1_multiplier * self.elo_change
+        self.team2_player1.elo_rating -= team1_multiplier * self.elo_change
+        self.team2_player2.elo_rating -= team1_multiplier * self.elo_change
         
-        # Update TrueSkill ratings
-        # Create TrueSkill Rating objects from the captured snapshots
-        team1_rating1 = trueskill.Rating(mu=self.team1_player1_trueskill_mu_before, sigma=self.team1_player1_trueskill_sigma_before)
-        team1_rating2 = trueskill.Rating(mu=self.team1_player2_trueskill_mu_before, sigma=self.team1_player2_trueskill_sigma_before)
-        team2_rating1 = trueskill.Rating(mu=self.team2_player1_trueskill_mu_before, sigma=self.team2_player1_trueskill_sigma_before)
-        team2_rating2 = trueskill.Rating(mu=self.team2_player2_trueskill_mu_before, sigma=self.team2_player2_trueskill_sigma_before)
-
-        # Calculate new TrueSkill ratings based on match result
-        if self.result == self.MatchResult.TEAM1_WIN:
-            # Team 1 won
-            (new_team1_rating1, new_team1_rating2), (new_team2_rating1, new_team2_rating2) = trueskill.rate(
-                [(team1_rating1, team1_rating2), (team2_rating1, team2_rating2)], ranks=[0, 1]
-            )
-        else:
-            # Team 2 won
-            (new_team1_rating1, new_team1_rating2), (new_team2_rating1, new_team2_rating2) = trueskill.rate(
-                [(team1_rating1, team1_rating2), (team2_rating1, team2_rating2)], ranks=[1, 0]
-            )
+        # Update TrueSkill ratings from the captured snapshots with the closed-form 2v2 kernel
+        (new_team1_rating1, new_team1_rating2), (new_team2_rating1, new_team2_rating2) = rate_2v2(
+            ((self.team1_player1_trueskill_mu_before, self.team1_player1_trueskill_sigma_before),
+             (self.team1_player2_trueskill_mu_before, self.team1_player2_trueskill_sigma_before)),
+            ((self.team2_player1_trueskill_mu_before, self.team2_player1_trueskill_sigma_before),
+             (self.team2_player2_trueskill_mu_before, self.team2_player2_trueskill_sigma_before)),
+            team1_won=self.result == self.MatchResult.TEAM1_WIN,
+        )
         
         # Update player TrueSkill ratings
-        self.team1_player1.trueskill_mu = new_team1_rating1.mu
-        self.team1_player1.trueskill_sigma = new_team1_rating1.sigma
-        self.team1_player2.trueskill_mu = new_team1_rating2.mu
-        self.team1_player2.trueskill_sigma = new_team1_rating2.sigma
-        self.team2_player1.trueskill_mu = new_team2_rating1.mu
-        self.team2_player1.trueskill_sigma = new_team2_rating1.sigma
-        self.team2_player2.trueskill_mu = new_team2_rating2.mu
-        self.team2_player2.trueskill_sigma = new_team2_rating2.sigma
+        self.team1_player1.trueskill_mu = new_team1_rating1[0]
+        self.team1_player1.trueskill_sigma = new_team1_rating1[1]
+        self.team1_player2.trueskill_mu = new_team1_rating2[0]
+        self.team1_player2.trueskill_sigma = new_team1_rating2[1]
+        self.team2_player1.trueskill_mu = new_team2_rating1[0]
+        self.team2_player1.trueskill_sigma = new_team2_rating1[1]
+        self.team2_player2.trueskill_mu = new_team2_rating2[0]
+        self.team2_player2.trueskill_sigma = new_team2_rating2[1]
         
         # Update win/loss records
         team1_won = 1 if self.result == self.MatchResult.TEAM1_WIN else 0
@@ -276,9 +549,197 @@ class Match(models.Model):
         
         for player in players:
             player.last_match_date = self.date_played
-            player.save()
-        
-        super().save(update_fields=['elo_change', 'result'])
+
+    def build_participants(self):
+        """Builds this match's MatchParticipant rows from its players and result"""
+        team1_won = self.result == self.MatchResult.TEAM1_WIN
+        return [
+            MatchParticipant(
+                match=self,
+                player_id=getattr(self, f'{slot}_id'),
+                team=1 if slot.startswith('team1') else 2,
+                slot=1 if slot.endswith('1') else 2,
+                won=slot.startswith('team1') == team1_won,
+                year=self.year,
+                date_played=self.date_played,
+            )
+            for slot in PLAYER_SLOTS
+        ]
+
+    def build_rating_events(self):
+        """Builds this match's RatingEvent rows; must run right after apply_rating_changes()"""
+        team1_won = self.result == self.MatchResult.TEAM1_WIN
+        return [
+            RatingEvent(
+                player=player,
+                match=self,
+                year=self.year,
+                date_played=self.date_played,
+                won=slot.startswith('team1') == team1_won,
+                elo_before=getattr(self, f'{slot}_elo_before'),
+                elo_after=player.elo_rating,
+                trueskill_mu_before=getattr(self, f'{slot}_trueskill_mu_before'),
+                trueskill_sigma_before=getattr(self, f'{slot}_trueskill_sigma_before'),
+                trueskill_mu_after=player.trueskill_mu,
+                trueskill_sigma_after=player.trueskill_sigma,
+            )
+            for slot, player in zip(PLAYER_SLOTS, self.players)
+        ]
+
+
+class MatchParticipantQuerySet(models.QuerySet):
+    def partnered_with(self, partner):
+        """Participations where `partner` played on the same team"""
+        return self.filter(Exists(MatchParticipant.objects.filter(
+            match=OuterRef('match'), team=OuterRef('team'), player=partner
+        )))
+
+    def against(self, opponent):
+        """Participations where `opponent` played on the other team"""
+        return self.filter(Exists(MatchParticipant.objects.filter(
+            match=OuterRef('match'), player=opponent
+        ).exclude(team=OuterRef('team'))))
+
+    def record(self):
+        """Played/won/lost totals over these participations, e.g. a head-to-head record"""
+        totals = self.aggregate(played=Count('pk'), won=Count('pk', filter=Q(won=True)))
+        totals['lost'] = totals['played'] - totals['won']
+        return totals
+
+
+class MatchParticipant(models.Model):
+    """One row per player per match, so per-player match lookups are single index scans"""
+    match = models.ForeignKey(Match, on_delete=models.CASCADE, related_name='participants')
+    player = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='participations')
+    team = models.PositiveSmallIntegerField()  # 1 or 2
+    slot = models.PositiveSmallIntegerField()  # 1 or 2 within the team
+    won = models.BooleanField()
+    year = models.IntegerField()
+    date_played = models.DateTimeField()
+
+    objects = MatchParticipantQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['date_played', 'match_id']
+        unique_together = ['match', 'player']
+        indexes = [
+            models.Index(fields=['player', 'year', 'date_played'], name='participant_player_history'),
+            models.Index(fields=['year', 'player'], name='participant_year_player'),
+        ]
+
+    def __str__(self):
+        return f"{self.player} - match {self.match_id} (team {self.team})"
+
+
+class PairRecordQuerySet(models.QuerySet):
+    def involving(self, player):
+        """Records of every pair `player` belongs to, from either side"""
+        return self.filter(Q(player_a=player) | Q(player_b=player))
+
+    def between(self, player, other):
+        """Records of the pair (player, other), in whichever order they are stored"""
+        player_a, player_b = sorted((_pk(player), _pk(other)))
+        return self.filter(player_a_id=player_a, player_b_id=player_b)
+
+
+def _pk(player):
+    return player.pk if isinstance(player, models.Model) else player
+
+
+class PairRecord(models.Model):
+    """
+    Running record of two players in one year, as partners or as opponents.
+
+    Each match touches its six pairs (two partnerships, four rivalries), so the
+    table is kept up to date incrementally and a head-to-head question is a
+    single row read. player_a always has the lower id; `won` counts the
+    matches won by player_a, which for partners are the matches won together.
+    """
+    class Relation(models.TextChoices):
+        PARTNER = 'partner', 'Partners'
+        OPPONENT = 'opponent', 'Opponents'
+
+    player_a = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='pair_records_as_a')
+    player_b = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='pair_records_as_b')
+    relation = models.CharField(max_length=8, choices=Relation.choices)
+    year = models.IntegerField()
+    played = models.IntegerField(default=0)
+    won = models.IntegerField(default=0)
+    last_played = models.DateTimeField(null=True, blank=True)
+
+    objects = PairRecordQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['player_a', 'player_b', 'relation', 'year']
+        indexes = [
+            # The unique index serves player_a lookups; this one the other side
+            models.Index(fields=['player_b', 'year'], name='pairrecord_player_b'),
+        ]
+
+    def __str__(self):
+        return f"{self.player_a_id} & {self.player_b_id} as {self.relation} in {self.year}"
+
+
+class RatingEvent(models.Model):
+    """Append-only record of one player's ratings before and after a match"""
+    player = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='rating_events')
+    match = models.ForeignKey(Match, on_delete=models.CASCADE, related_name='rating_events')
+    year = models.IntegerField()
+    date_played = models.DateTimeField()
+    won = models.BooleanField()
+    elo_before = models.IntegerField()
+    elo_after = models.IntegerField()
+    trueskill_mu_before = models.FloatField()
+    trueskill_sigma_before = models.FloatField()
+    trueskill_mu_after = models.FloatField()
+    trueskill_sigma_after = models.FloatField()
+
+    class Meta:
+        ordering = ['date_played', 'match_id']
+        unique_together = ['player', 'match']
+        indexes = [
+            # Serves a player's history for a year as a single range scan
+            models.Index(fields=['player', 'year', 'date_played', 'match'], name='ratingevent_player_history'),
+        ]
+
+    def __str__(self):
+        return f"{self.player} - match {self.match_id}"
+
+    @property
+    def trueskill_score_before(self):
+        return self.trueskill_mu_before - (3 * self.trueskill_sigma_before)
+
+    @property
+    def trueskill_score_after(self):
+        return self.trueskill_mu_after - (3 * self.trueskill_sigma_after)
+
+    @property
+    def trueskill_change(self):
+        return self.trueskill_score_after - self.trueskill_score_before
+
+
+class RatingCheckpoint(models.Model):
+    """
+    Ratings of everyone who had played in a year, as of right after the match
+    at (date_played, match_id), packed into arrays by core.checkpoints
+    """
+    year = models.IntegerField()
+    date_played = models.DateTimeField()
+    # A plain id: checkpoints are dropped explicitly when an earlier match changes
+    match_id = models.BigIntegerField()
+    matches = models.IntegerField()  # Rated matches of the year up to this one
+    players = models.IntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['year', 'date_played', 'match_id']
+        indexes = [
+            models.Index(fields=['year', 'date_played', 'match_id'], name='checkpoint_position'),
+        ]
+
+    def __str__(self):
+        return f"{self.year} after {self.matches} matches"
 
 
 class YearArchive(models.Model):
@@ -330,3 +791,31 @@ class ArchivedPlayerStats(models.Model):
         if self.matches_played == 0:
             return 0
         return (self.matches_won / self.matches_played) * 100
+
+
+class RequestProfile(models.Model):
+    """Profile of a single request captured on demand by a superuser"""
+    class Mode(models.TextChoices):
+        DETERMINISTIC = 'cprofile', 'Deterministic (cProfile)'
+        SAMPLED = 'sample', 'Sampled stacks'
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey('auth.User', on_delete=models.SET_NULL, null=True, blank=True, related_name='request_profiles')
+    mode = models.CharField(max_length=10, choices=Mode.choices)
+    method = models.CharField(max_length=10)
+    path = models.TextField()
+    view_name = models.CharField(max_length=200, blank=True)
+    status_code = models.IntegerField()
+    duration_ms = models.FloatField()
+    query_count = models.IntegerField()
+    query_time_ms = models.FloatField()
+    # pstats listing, or collapsed "frame;frame;frame count" stacks for sampled profiles
+    python_profile = models.TextField()
+    # [{'sql', 'duration_ms', 'call_site'}] in execution order
+    queries = models.JSONField(default=list, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
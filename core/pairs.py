@@ -0,0 +1,125 @@
+"""
+Maintenance of PairRecord, the per-year partnership and head-to-head table.
+
+Saving, editing or deleting a match adjusts only its six pairs. Bulk loads,
+recomputes and archives rebuild a whole year with one INSERT ... SELECT over
+MatchParticipant instead.
+"""
+from django.db import connection
+from django.db.models import F, Max, Q, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import PLAYER_SLOTS, Match, MatchParticipant, PairRecord
+
+
+def match_pairs(player_ids, team1_won):
+    """
+    (player_a, player_b, relation, player_a won) for the six pairs of a match,
+    given its four player ids in slot order.
+    """
+    pairs = []
+    for i in range(4):
+        for j in range(i + 1, 4):
+            partners = (i < 2) == (j < 2)
+            player_a, player_b = player_ids[i], player_ids[j]
+            a_won = (i < 2) == team1_won
+            if player_a > player_b:
+                player_a, player_b = player_b, player_a
+                a_won = a_won if partners else not a_won
+            relation = PairRecord.Relation.PARTNER if partners else PairRecord.Relation.OPPONENT
+            pairs.append((player_a, player_b, relation, a_won))
+    return pairs
+
+
+def _pairs_of(match):
+    # Sorted, so concurrent writers insert and lock shared pair rows in the same order
+    return sorted(match_pairs(
+        [getattr(match, f'{slot}_id') for slot in PLAYER_SLOTS], match.result == Match.MatchResult.TEAM1_WIN
+    ))
+
+
+def _lock(pairs, year):
+    """
+    Locks the rows of `pairs` in key order. Matches sharing a player usually
+    come in one at a time through the player row locks, but queued ones
+    (see core/rating_queue.py) don't take those.
+    """
+    list(
+        PairRecord.objects.filter(_matching(pairs), year=year).select_for_update()
+        .order_by('player_a', 'player_b', 'relation').values_list('pk', flat=True)
+    )
+
+
+def _matching(pairs):
+    condition = Q(pk__in=[])
+    for player_a, player_b, relation, _ in pairs:
+        condition |= Q(player_a_id=player_a, player_b_id=player_b, relation=relation)
+    return condition
+
+
+def add_match(match):
+    """Counts a saved match in its six pair records, creating any that are missing"""
+    pairs = _pairs_of(match)
+    PairRecord.objects.bulk_create(
+        [
+            PairRecord(player_a_id=player_a, player_b_id=player_b, relation=relation, year=match.year)
+            for player_a, player_b, relation, _ in pairs
+        ],
+        ignore_conflicts=True,
+    )
+    _lock(pairs, match.year)
+    date_played = Value(match.date_played)
+    for a_won in (True, False):
+        selected = [pair for pair in pairs if pair[3] == a_won]
+        PairRecord.objects.filter(_matching(selected), year=match.year).update(
+            played=F('played') + 1,
+            won=F('won') + int(a_won),
+            last_played=Greatest(Coalesce('last_played', date_played), date_played),
+        )
+
+
+def remove_match(match):
+    """
+    Takes a match out of its six pair records. Must run once the match's own
+    participants are gone, since last_played is looked up again from them.
+    """
+    pairs = _pairs_of(match)
+    _lock(pairs, match.year)
+    for a_won in (True, False):
+        selected = [pair for pair in pairs if pair[3] == a_won]
+        PairRecord.objects.filter(_matching(selected), year=match.year).update(
+            played=F('played') - 1, won=F('won') - int(a_won),
+        )
+    records = PairRecord.objects.filter(_matching(pairs), year=match.year)
+    records.filter(played__lte=0).delete()
+
+    # Only pairs whose latest match this was need their date looked up again
+    for record in records.filter(last_played__gte=match.date_played):
+        participations = MatchParticipant.objects.filter(player_id=record.player_a_id, year=record.year)
+        if record.relation == PairRecord.Relation.PARTNER:
+            participations = participations.partnered_with(record.player_b_id)
+        else:
+            participations = participations.against(record.player_b_id)
+        record.last_played = participations.aggregate(last=Max('date_played'))['last']
+        record.save(update_fields=['last_played'])
+
+
+def rebuild_year(year):
+    """Recounts every pair of `year` from MatchParticipant in a single INSERT ... SELECT"""
+    PairRecord.objects.filter(year=year).delete()
+    participants = connection.ops.quote_name(MatchParticipant._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {connection.ops.quote_name(PairRecord._meta.db_table)}
+                (player_a_id, player_b_id, relation, year, played, won, last_played)
+            SELECT a.player_id, b.player_id,
+                   CASE WHEN a.team = b.team THEN %s ELSE %s END,
+                   %s, COUNT(*), SUM(CASE WHEN a.won THEN 1 ELSE 0 END), MAX(a.date_played)
+            FROM {participants} a
+            JOIN {participants} b ON b.match_id = a.match_id AND b.player_id > a.player_id
+            WHERE a.year = %s
+            GROUP BY a.player_id, b.player_id, a.team = b.team
+            """,
+            [PairRecord.Relation.PARTNER, PairRecord.Relation.OPPONENT, year, year],
+        )
@@ -0,0 +1,131 @@
+"""
+Cached player page context.
+
+Everything PlayerDetailView shows below the player's own ratings (recent
+matches, top partners and rivals, the TrueSkill chart) only changes when that
+player plays, so it is built once per player version and kept in the shared
+Django cache (see player_page_key()). The player row itself is still read on
+every request, which keeps the ratings and inactivity decay current.
+
+Recording a match invalidates its four players through invalidate(), which
+also re-renders their pages on a background thread once the transaction
+commits, so the next visit is a hit. Recomputes, archives and renames
+invalidate everyone and leave the pages to be rebuilt on demand.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .cache import bump_player_versions, player_page_key
+from .history import chart_payload, history_columns
+from .models import PairRecord, Player, RatingEvent
+
+logger = logging.getLogger(__name__)
+
+# Unvisited pages needn't stay around forever
+PAGE_TIMEOUT = 24 * 60 * 60
+
+# One thread is plenty for four players a match, and keeps warming off the request path
+_warmer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='player-page-warmer')
+
+
+def page_context(player, year=None):
+    """The cached page context of a player for a season (default: the current one)"""
+    year = year or timezone.now().year
+    # Read before building: a bump meanwhile leaves what we build under the old key
+    key = player_page_key(player.pk, year)
+    context = cache.get(key)
+    if context is None:
+        context = build_page_context(player, year)
+        cache.set(key, context, timeout=PAGE_TIMEOUT)
+    return context
+
+
+def build_page_context(player, year):
+    # One range scan over the player's rating events for the year,
+    # with each match and its four players joined in
+    events = list(
+        RatingEvent.objects.filter(player=player, year=year)
+        .select_related(
+            'match__team1_player1', 'match__team1_player2',
+            'match__team2_player1', 'match__team2_player2',
+        )
+        .order_by('date_played', 'match_id')
+    )
+
+    # TrueSkill history for the chart, downsampled and delta-encoded so the
+    # embedded payload stays the same size however many matches were played
+    trueskill_history = history_columns(events)
+    return {
+        'matches': annotate_matches_with_trueskill_change(events),
+        # Most frequent partners and opponents this year, read from the pair table
+        'pair_widgets': [
+            ('Top Partners', pair_summary(player, PairRecord.Relation.PARTNER, year), 'bg-primary'),
+            ('Top Rivals', pair_summary(player, PairRecord.Relation.OPPONENT, year), 'bg-danger'),
+        ],
+        'trueskill_history_json': json.dumps(chart_payload(trueskill_history)),
+        'trueskill_history': trueskill_history,
+    }
+
+
+def pair_summary(player, relation, year, limit=5):
+    """The player's most frequent partners or opponents in a year, with the record from their side"""
+    records = (
+        PairRecord.objects.involving(player).filter(relation=relation, year=year)
+        .select_related('player_a', 'player_b').order_by('-played', '-last_played')[:limit]
+    )
+    summary = []
+    for record in records:
+        is_a = record.player_a_id == player.pk
+        won = record.won if is_a or relation == PairRecord.Relation.PARTNER else record.played - record.won
+        summary.append({
+            'player': record.player_b if is_a else record.player_a,
+            'played': record.played,
+            'won': won,
+            'lost': record.played - won,
+            'win_rate': won / record.played * 100,
+        })
+    return summary
+
+
+def annotate_matches_with_trueskill_change(events):
+    """
+    Annotates each match (most recent first) with the TrueSkill score change
+    recorded for the player in its rating event.
+    """
+    annotated_matches = []
+    for event in reversed(events):
+        match = event.match
+        match.trueskill_change = event.trueskill_change
+        annotated_matches.append(match)
+    return annotated_matches
+
+
+def invalidate(player_ids=None):
+    """
+    Invalidates the pages of the given players, or of everyone, once the
+    current transaction commits. The given players' pages are then warmed in
+    the background.
+    """
+    if player_ids is None:
+        bump_player_versions()
+        return
+    player_ids = sorted(set(player_ids))
+    bump_player_versions(player_ids)
+    transaction.on_commit(lambda: _warmer.submit(_warm, player_ids))
+
+
+def _warm(player_ids):
+    try:
+        for player in Player.objects.filter(pk__in=player_ids):
+            page_context(player)
+    except Exception:
+        # Only a lost head start: the page is built on the next visit instead
+        logger.exception("Could not warm the pages of players %s", player_ids)
+    finally:
+        # Each warmer thread has its own connection, which nothing else would close
+        connection.close()
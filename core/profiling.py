@@ -0,0 +1,143 @@
+"""
+On-demand profiling of single requests for superusers.
+
+Adding ?_profile=cprofile (or sample) to a URL, or sending an X-Profile header
+with the same value, runs that one request under cProfile or a stack sampler
+and records every SQL query with its duration and the line of project code
+that issued it. The report is saved as a RequestProfile, browsable in the
+admin, and its id is returned in the X-Profile-Id response header.
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+
+from .models import RequestProfile
+
+PROFILE_PARAMETER = '_profile'
+PROFILE_HEADER = 'X-Profile'
+SAMPLE_INTERVAL = 0.001
+PSTATS_LINES = 80
+MAX_RECORDED_QUERIES = 2000
+PROJECT_DIR = str(settings.BASE_DIR)
+# Execute wrappers sit between the caller and the database on every query
+WRAPPER_FILES = {__file__, os.path.join(os.path.dirname(__file__), 'metrics.py')}
+
+
+class QueryLog:
+    """Execute wrapper keeping each query's SQL, duration and originating project frame"""
+
+    def __init__(self):
+        self.queries = []
+        self.count = 0
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.elapsed += duration
+            if len(self.queries) < MAX_RECORDED_QUERIES:
+                self.queries.append({
+                    'sql': sql,
+                    'duration_ms': round(duration * 1000, 3),
+                    'call_site': call_site(),
+                })
+
+
+def call_site():
+    """The innermost frame of project code (not Django or the query wrappers) on the stack"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(PROJECT_DIR) and 'site-packages' not in filename and filename not in WRAPPER_FILES:
+            return f"{os.path.relpath(filename, PROJECT_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return ''
+
+
+class StackSampler(threading.Thread):
+    """Counts the call stacks of one thread every SAMPLE_INTERVAL seconds"""
+
+    def __init__(self, thread_id):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def report(self):
+        """Collapsed stacks, heaviest first, as consumed by flame graph tools"""
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class ProfilerMiddleware:
+    """Profiles requests from superusers that ask for it; must come after AuthenticationMiddleware"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = request.GET.get(PROFILE_PARAMETER) or request.headers.get(PROFILE_HEADER)
+        if not mode or not request.user.is_superuser:
+            return self.get_response(request)
+        if mode not in RequestProfile.Mode.values:
+            mode = RequestProfile.Mode.DETERMINISTIC
+
+        query_log = QueryLog()
+        start = time.perf_counter()
+        with connection.execute_wrapper(query_log):
+            if mode == RequestProfile.Mode.SAMPLED:
+                sampler = StackSampler(threading.get_ident())
+                sampler.start()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    sampler.stopped.set()
+                    sampler.join()
+                python_profile = sampler.report()
+            else:
+                profiler = cProfile.Profile()
+                try:
+                    response = profiler.runcall(self.get_response, request)
+                finally:
+                    output = io.StringIO()
+                    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PSTATS_LINES)
+                    python_profile = output.getvalue()
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        profile = RequestProfile.objects.create(
+            user=request.user,
+            mode=mode,
+            method=request.method,
+            path=request.get_full_path(),
+            view_name=(match.view_name if match else '') or '',
+            status_code=response.status_code,
+            duration_ms=duration * 1000,
+            query_count=query_log.count,
+            query_time_ms=query_log.elapsed * 1000,
+            python_profile=python_profile,
+            queries=query_log.queries,
+        )
+        response['X-Profile-Id'] = str(profile.pk)
+        return response
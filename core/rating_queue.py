@@ -0,0 +1,131 @@
+"""
+Write-behind rating application.
+
+With the RATING_QUEUE setting on, Match.save() commits new matches with
+rating_queued_at set instead of rating them inside the request, and the
+process_rating_queue command applies them later. The queue is the match
+table itself: pending matches are found through a partial index, so no
+broker is needed.
+
+Matches are applied strictly in (date_played, id) order, a batch of
+consecutive ones at a time, replayed in memory against their locked players
+and written back with bulk updates. A batch whose players already have a
+rated match after it, e.g. after an edit, is handed to recompute_suffix(),
+which re-rates the rest of the season.
+"""
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from .bulk import update_instances
+from .cache import bump_league_version, get_or_build
+from .checkpoints import invalidate
+from .metrics import timed
+from .models import PLAYER_SLOTS, Match, MatchParticipant, Player, RatingEvent
+from .player_pages import invalidate as invalidate_player_pages
+from .recompute import MATCH_RATING_FIELDS, PLAYER_RATING_FIELDS, recompute_suffix, replay_matches
+
+BATCH_SIZE = 500
+
+
+class _Retry(Exception):
+    """Releases the batch's player locks so it can be picked again"""
+
+
+class _Backdated(Exception):
+    """Releases the batch's player locks before every player is locked for a recompute"""
+
+
+def pending():
+    return Match.objects.filter(rating_queued_at__isnull=False)
+
+
+def _queue_head():
+    """Number of queued matches and when the oldest was queued"""
+    status = pending().aggregate(pending=Count('pk'), oldest=Min('rating_queued_at'))
+    return status['pending'], status['oldest']
+
+
+def _status(pending_count, oldest):
+    lag = (timezone.now() - oldest).total_seconds() if oldest else 0.0
+    return {'pending': pending_count, 'lag': lag}
+
+
+def queue_status():
+    """Number of queued matches and how long the oldest has been waiting, in seconds"""
+    return _status(*_queue_head())
+
+
+def cached_queue_status():
+    """
+    queue_status() for every page render. Queueing and rating a match both
+    bump the league version, so the queue head is cached with the
+    leaderboards and only the lag is worked out per call.
+    """
+    return _status(*get_or_build('rating-queue', _queue_head))
+
+
+@timed('rating_queue_batch')
+def apply_next_batch(batch_size=BATCH_SIZE):
+    """
+    Rates the earliest queued matches of the earliest queued year, at most
+    `batch_size` of them in the in-order case. Returns how many queued
+    matches were rated; 0 once the queue is empty.
+    """
+    while (applied := _apply_batch(batch_size)) is None:
+        pass
+    return applied
+
+
+def _apply_batch(batch_size):
+    """apply_next_batch() for one pick of the batch; None if it changed meanwhile"""
+    with transaction.atomic():
+        first = pending().order_by('date_played', 'id').first()
+        if first is None:
+            return 0
+        batch = list(pending().filter(year=first.year).order_by('date_played', 'id')[:batch_size])
+        player_ids = {getattr(match, f'{slot}_id') for match in batch for slot in PLAYER_SLOTS}
+
+        try:
+            with transaction.atomic():
+                players_by_id = Player.objects.lock(player_ids)
+                # Edits and deletes lock every player, so the batch can't change under our
+                # locks; one that changed before we got them is picked again
+                current = pending().filter(pk__in=[match.pk for match in batch])
+                if {match.pk: match.rating_inputs for match in current} != {
+                    match.pk: match.rating_inputs for match in batch
+                }:
+                    raise _Retry
+                if MatchParticipant.objects.filter(
+                    player_id__in=player_ids, year=first.year, date_played__gt=first.date_played,
+                    match__rating_queued_at__isnull=True,
+                ).exists():
+                    raise _Backdated
+        except _Retry:
+            return None
+        except _Backdated:
+            queued = pending().filter(year=first.year).count()
+            recompute_suffix(first.year, first.date_played, first.pk)
+            return queued - pending().filter(year=first.year).count()
+
+        invalidate(first.year, first.date_played, first.pk)
+        events = replay_matches(batch, players_by_id)
+        update_instances(Match, batch, MATCH_RATING_FIELDS)
+        update_instances(Player, players_by_id.values(), PLAYER_RATING_FIELDS)
+        RatingEvent.objects.bulk_create(events, batch_size=1000)
+        bump_league_version()
+        invalidate_player_pages(player_ids)
+    return len(batch)
+
+
+def render_metrics():
+    """The queue's length and lag as Prometheus gauges, read from the database at scrape time"""
+    status = queue_status()
+    return (
+        '# HELP zipleague_rating_queue_pending Matches waiting for their ratings\n'
+        '# TYPE zipleague_rating_queue_pending gauge\n'
+        f'zipleague_rating_queue_pending {status["pending"]}\n'
+        '# HELP zipleague_rating_queue_lag_seconds How long the oldest queued match has been waiting\n'
+        '# TYPE zipleague_rating_queue_lag_seconds gauge\n'
+        f'zipleague_rating_queue_lag_seconds {status["lag"]:.3f}\n'
+    )
@@ -0,0 +1,143 @@
+"""
+Closed-form TrueSkill update for the league's only match format: 2 vs 2, no draws.
+
+For two teams the TrueSkill factor graph has a single truncation factor, so
+the message passing in trueskill.rate() converges after one pass and reduces
+to the textbook update below. The same normal approximations as the library's
+default backend are used, so results match trueskill.rate() to floating point
+precision.
+"""
+import math
+
+import numpy as np
+import trueskill
+from trueskill.backends import cdf, pdf
+
+from .models import (
+    TRUESKILL_DEFAULT_BETA,
+    TRUESKILL_DEFAULT_DRAW_PROBABILITY,
+    TRUESKILL_DEFAULT_TAU,
+)
+
+TAU_SQ = TRUESKILL_DEFAULT_TAU ** 2
+# Every match has four players, each contributing beta^2 of performance noise
+PERFORMANCE_VARIANCE = 4 * TRUESKILL_DEFAULT_BETA ** 2
+DRAW_MARGIN = trueskill.calc_draw_margin(TRUESKILL_DEFAULT_DRAW_PROBABILITY, 4)
+ELO_K_FACTOR = 32
+
+
+def elo_delta(team1_elos, team2_elos, team1_won):
+    """
+    Elo points gained by each winner (and lost by each loser) of a 2v2 match,
+    based on the two teams' average ratings before the match.
+    """
+    team1_avg_elo = sum(team1_elos) / 2
+    team2_avg_elo = sum(team2_elos) / 2
+    expected_team1 = 1 / (1 + 10 ** ((team2_avg_elo - team1_avg_elo) / 400))
+    return abs(round(ELO_K_FACTOR * ((1 if team1_won else 0) - expected_team1)))
+
+
+def rate_2v2(team1, team2, team1_won):
+    """
+    Rates a single 2v2 match.
+
+    team1 and team2 are pairs of (mu, sigma) tuples; returns the updated pairs
+    in the same shape, like trueskill.rate() does for rating groups.
+    """
+    winners, losers = (team1, team2) if team1_won else (team2, team1)
+
+    # Dynamics: every player's uncertainty grows by tau before the match
+    variances = [sigma ** 2 + TAU_SQ for _, sigma in winners + losers]
+    c_sq = sum(variances) + PERFORMANCE_VARIANCE
+    c = math.sqrt(c_sq)
+
+    diff = (winners[0][0] + winners[1][0] - losers[0][0] - losers[1][0]) / c
+    x = diff - DRAW_MARGIN / c
+    denom = cdf(x)
+    v = pdf(x) / denom if denom else -x
+    w = v * (v + x)
+
+    rated = []
+    for index, ((mu, _), variance) in enumerate(zip(winners + losers, variances)):
+        sign = 1 if index < 2 else -1
+        rated.append((
+            mu + sign * variance / c * v,
+            math.sqrt(variance * (1 - variance / c_sq * w)),
+        ))
+
+    new_winners, new_losers = tuple(rated[:2]), tuple(rated[2:])
+    return (new_winners, new_losers) if team1_won else (new_losers, new_winners)
+
+
+def _erfc(x):
+    """Vectorized copy of trueskill.backends.erfc (same Chebyshev fit)"""
+    z = np.abs(x)
+    t = 1. / (1. + z / 2.)
+    r = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (
+        0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (
+            0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (
+                -0.82215223 + t * 0.17087277
+            )))
+        )))
+    )))
+    return np.where(x < 0, 2. - r, r)
+
+
+def _cdf(x):
+    return 0.5 * _erfc(-x / math.sqrt(2))
+
+
+def _pdf(x):
+    return np.exp(-x ** 2 / 2) / math.sqrt(2 * math.pi)
+
+
+def rate_2v2_batch(mu, sigma, team1_won):
+    """
+    Rates many independent 2v2 matches in one array pass.
+
+    mu and sigma are (n, 4) arrays ordered team1_player1, team1_player2,
+    team2_player1, team2_player2, and team1_won is a length-n boolean array.
+    Returns the updated (mu, sigma) arrays. Matches must not share players,
+    since each one is rated against the same prior.
+    """
+    mu = np.asarray(mu, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+    team1_won = np.asarray(team1_won, dtype=bool)
+
+    variances = sigma ** 2 + TAU_SQ
+    c_sq = variances.sum(axis=1) + PERFORMANCE_VARIANCE
+    c = np.sqrt(c_sq)
+
+    # +1 for the winning team's columns, -1 for the losing team's
+    team_sign = np.where(team1_won, 1., -1.)[:, None] * np.array([1., 1., -1., -1.])
+    diff = (mu * team_sign).sum(axis=1) / c
+    x = diff - DRAW_MARGIN / c
+    denom = _cdf(x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v = np.where(denom > 0, _pdf(x) / denom, -x)
+    w = v * (v + x)
+
+    new_mu = mu + team_sign * variances / c[:, None] * v[:, None]
+    new_sigma = np.sqrt(variances * (1 - variances / c_sq[:, None] * w[:, None]))
+    return new_mu, new_sigma
+
+
+def win_probabilities(elo, mu, sigma):
+    """
+    Team 1's chances in many hypothetical 2v2 matchups at once.
+
+    elo, mu and sigma are (n, 4) arrays ordered team1_player1, team1_player2,
+    team2_player1, team2_player2. Returns the Elo expected score (from the
+    teams' average ratings, as in elo_delta) and the TrueSkill probability
+    that team 1 performs better, as two length-n arrays.
+    """
+    elo = np.asarray(elo, dtype=float)
+    mu = np.asarray(mu, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+
+    elo_gap = (elo[:, 2] + elo[:, 3] - elo[:, 0] - elo[:, 1]) / 2
+    elo_expected = 1 / (1 + 10 ** (elo_gap / 400))
+
+    c = np.sqrt((sigma ** 2).sum(axis=1) + PERFORMANCE_VARIANCE)
+    trueskill_expected = _cdf((mu[:, 0] + mu[:, 1] - mu[:, 2] - mu[:, 3]) / c)
+    return elo_expected, trueskill_expected
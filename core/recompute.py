@@ -0,0 +1,335 @@
+"""
+In-memory rating replay used to recompute a season without per-match queries.
+"""
+import time
+from dataclasses import dataclass
+
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .bulk import update_instances
+from .cache import bump_league_version
+from .metrics import timed
+from .pairs import rebuild_year as rebuild_pair_records
+from .player_pages import invalidate as invalidate_player_pages
+from .models import (
+    PLAYER_SLOTS, TRUESKILL_DEFAULT_MU, TRUESKILL_DEFAULT_SIGMA, Match, MatchParticipant, Player, RatingCheckpoint,
+    RatingEvent,
+)
+from .ratings import elo_delta, rate_2v2
+
+# Fields written back to each match once the replay is done
+MATCH_RATING_FIELDS = [
+    'elo_change', 'rating_queued_at',
+    'team1_player1_elo_before', 'team1_player2_elo_before',
+    'team2_player1_elo_before', 'team2_player2_elo_before',
+    'team1_player1_trueskill_mu_before', 'team1_player1_trueskill_sigma_before',
+    'team1_player2_trueskill_mu_before', 'team1_player2_trueskill_sigma_before',
+    'team2_player1_trueskill_mu_before', 'team2_player1_trueskill_sigma_before',
+    'team2_player2_trueskill_mu_before', 'team2_player2_trueskill_sigma_before',
+]
+
+# Fields written back to each player once the replay is done
+PLAYER_RATING_FIELDS = [
+    'elo_rating', 'trueskill_mu', 'trueskill_sigma',
+    'matches_played', 'matches_won', 'matches_lost', 'last_match_date',
+]
+
+
+# Column orders of the rows RatingTable produces, for core.bulk.copy_rows
+MATCH_ROW_FIELDS = (
+    ['id'] + [f'{slot}_id' for slot in PLAYER_SLOTS]
+    + ['team1_score', 'team2_score', 'result', 'date_played', 'year', 'elo_change']
+    + [f'{slot}_elo_before' for slot in PLAYER_SLOTS]
+    + [f'{slot}_trueskill_{name}_before' for slot in PLAYER_SLOTS for name in ('mu', 'sigma')]
+)
+PARTICIPANT_ROW_FIELDS = ['match_id', 'player_id', 'team', 'slot', 'won', 'year', 'date_played']
+EVENT_ROW_FIELDS = [
+    'player_id', 'match_id', 'year', 'date_played', 'won', 'elo_before', 'elo_after',
+    'trueskill_mu_before', 'trueskill_sigma_before', 'trueskill_mu_after', 'trueskill_sigma_after',
+]
+
+
+@dataclass
+class RecomputeResult:
+    matches: int
+    players: int
+    elapsed: float
+
+    @property
+    def matches_per_second(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return self.matches / self.elapsed
+
+
+def reset_player_ratings(player):
+    """Resets a player instance (in memory) to the start-of-season defaults"""
+    player.elo_rating = 1000
+    player.trueskill_mu = TRUESKILL_DEFAULT_MU
+    player.trueskill_sigma = TRUESKILL_DEFAULT_SIGMA
+    player.matches_played = 0
+    player.matches_won = 0
+    player.matches_lost = 0
+    player.last_match_date = None
+
+
+class RatingTable:
+    """
+    Running ratings keyed by player id, for replays that write plain rows to the
+    database (bulk seeding and imports) instead of going through model instances.
+    Rates with the same kernels as Match.apply_rating_changes.
+    """
+
+    def __init__(self):
+        self.elo, self.mu, self.sigma = {}, {}, {}
+        self.played, self.won, self.last_played = {}, {}, {}
+
+    def add(self, player_id, elo=1000, mu=TRUESKILL_DEFAULT_MU, sigma=TRUESKILL_DEFAULT_SIGMA,
+            played=0, won=0, last_played=None):
+        self.elo[player_id] = elo
+        self.mu[player_id] = mu
+        self.sigma[player_id] = sigma
+        self.played[player_id] = played
+        self.won[player_id] = won
+        self.last_played[player_id] = last_played
+
+    def add_player(self, player):
+        self.add(player.pk, player.elo_rating, player.trueskill_mu, player.trueskill_sigma,
+                 player.matches_played, player.matches_won, player.last_match_date)
+
+    def reset(self):
+        """Back to start-of-season defaults for everyone, like reset_player_ratings()"""
+        for player_id in list(self.elo):
+            self.add(player_id)
+
+    def apply_to(self, player):
+        """Copies a player's running ratings onto a Player instance (in memory)"""
+        player.elo_rating = self.elo[player.pk]
+        player.trueskill_mu = self.mu[player.pk]
+        player.trueskill_sigma = self.sigma[player.pk]
+        player.matches_played = self.played[player.pk]
+        player.matches_won = self.won[player.pk]
+        player.matches_lost = self.played[player.pk] - self.won[player.pk]
+        player.last_match_date = self.last_played[player.pk]
+
+    def play(self, match_id, player_ids, team1_won, date_played, year, participants=None, events=None):
+        """
+        Rates one match between player_ids (in PLAYER_SLOTS order), appending its
+        PARTICIPANT_ROW_FIELDS and EVENT_ROW_FIELDS rows to the given lists, if any.
+
+        Returns the match's elo_change and snapshot values, the tail of a
+        MATCH_ROW_FIELDS row.
+        """
+        elo_before = [self.elo[player_id] for player_id in player_ids]
+        mu_before = [self.mu[player_id] for player_id in player_ids]
+        sigma_before = [self.sigma[player_id] for player_id in player_ids]
+        change = elo_delta(elo_before[:2], elo_before[2:], team1_won)
+        rated = rate_2v2(
+            ((mu_before[0], sigma_before[0]), (mu_before[1], sigma_before[1])),
+            ((mu_before[2], sigma_before[2]), (mu_before[3], sigma_before[3])),
+            team1_won,
+        )
+
+        for position, player_id in enumerate(player_ids):
+            on_team1 = position < 2
+            won = on_team1 == team1_won
+            mu, sigma = rated[0 if on_team1 else 1][position % 2]
+            self.elo[player_id] += change if won else -change
+            self.mu[player_id] = mu
+            self.sigma[player_id] = sigma
+            self.played[player_id] += 1
+            self.won[player_id] += won
+            self.last_played[player_id] = date_played
+
+            if participants is not None:
+                participants.append(
+                    (match_id, player_id, 1 if on_team1 else 2, position % 2 + 1, won, year, date_played)
+                )
+            if events is not None:
+                events.append((
+                    player_id, match_id, year, date_played, won, elo_before[position], self.elo[player_id],
+                    mu_before[position], sigma_before[position], mu, sigma,
+                ))
+
+        return [change] + elo_before + [value for pair in zip(mu_before, sigma_before) for value in pair]
+
+
+def replay_matches(matches, players_by_id):
+    """
+    Replays matches in the given order against in-memory players.
+
+    Each match gets its snapshots captured from the running player state and
+    its rating changes applied; nothing is written to the database. Returns
+    the RatingEvent rows describing the replay.
+    """
+    events = []
+    for match in matches:
+        match.team1_player1 = players_by_id[match.team1_player1_id]
+        match.team1_player2 = players_by_id[match.team1_player2_id]
+        match.team2_player1 = players_by_id[match.team2_player1_id]
+        match.team2_player2 = players_by_id[match.team2_player2_id]
+        match.capture_elo_snapshots()
+        match.apply_rating_changes()
+        match.rating_queued_at = None
+        events.extend(match.build_rating_events())
+    return events
+
+
+@timed('recompute_year')
+def recompute_year(year, batch_size=1000, update_players=True, since=None):
+    """
+    Recomputes ELO and TrueSkill ratings for every match of a year.
+
+    All players and matches are loaded once, replayed in memory in
+    chronological order and written back with bulk updates. With
+    update_players=False only the year's matches and their rows are rewritten,
+    for years other than the one the players' ratings belong to.
+
+    Given `since`, the earliest date that changed, the replay starts from the
+    latest rating checkpoint before it instead of from scratch, and only the
+    matches after that checkpoint are rewritten.
+    """
+    from .checkpoints import (
+        CheckpointSchedule, CheckpointWriter, after, checkpoint, invalidate, latest, table_from_players, unpack,
+    )
+
+    start = time.perf_counter()
+
+    with transaction.atomic():
+        players_by_id = Player.objects.lock()
+        for player in players_by_id.values():
+            reset_player_ratings(player)
+
+        matches = Match.objects.filter(year=year)
+        # Full recomputes double as the repair path for the participation and pair tables
+        stale = Q(match__year=year)
+        if since is None:
+            RatingCheckpoint.objects.filter(year=year).delete()
+            resumed = None
+        else:
+            invalidate(year, since)
+            resumed = latest(year)
+        if resumed is not None:
+            table = unpack(resumed.data)
+            for player_id in table.elo:
+                if player_id in players_by_id:
+                    table.apply_to(players_by_id[player_id])
+            matches = matches.filter(after(resumed, 'id'))
+            stale &= after(resumed)
+
+        matches = list(matches.order_by('date_played', 'id'))
+        events, checkpoints = [], CheckpointWriter()
+        # Replayed in runs that end where the schedule takes a checkpoint
+        schedule = CheckpointSchedule(resumed)
+        position = 0
+        for index, match in enumerate(matches):
+            next_date_played = matches[index + 1].date_played if index + 1 < len(matches) else None
+            if schedule.due(match.date_played, next_date_played):
+                events.extend(replay_matches(matches[position:index + 1], players_by_id))
+                position = index + 1
+                checkpoints.add(checkpoint(match, schedule.counted, table_from_players(players_by_id.values())))
+        events.extend(replay_matches(matches[position:], players_by_id))
+
+        update_instances(Match, matches, MATCH_RATING_FIELDS)
+        if update_players:
+            update_instances(Player, players_by_id.values(), PLAYER_RATING_FIELDS)
+        RatingEvent.objects.filter(stale).delete()
+        RatingEvent.objects.bulk_create(events, batch_size=batch_size)
+        MatchParticipant.objects.filter(stale).delete()
+        MatchParticipant.objects.bulk_create(
+            [participant for match in matches for participant in match.build_participants()],
+            batch_size=batch_size,
+        )
+        checkpoints.flush()
+        rebuild_pair_records(year)
+        bump_league_version()
+        invalidate_player_pages()
+
+    return RecomputeResult(
+        matches=len(matches),
+        players=len(players_by_id),
+        elapsed=time.perf_counter() - start,
+    )
+
+
+@timed('recompute_suffix')
+def recompute_suffix(year, start_date, start_id, previous=None, unrated_id=None, removed=(), batch_size=1000):
+    """
+    Re-rates every match of a year from the (start_date, start_id) position onwards.
+
+    Instead of replaying the whole season, each player is seeded from the stored
+    snapshots of their first match in the suffix as it was rated before the change;
+    players without one keep their current ratings. Win/loss counters are rolled
+    back by the old suffix's results. `previous` is the stored version of an edited
+    or deleted match and `unrated_id` the id of a newly inserted one, which has no
+    valid snapshots yet. `removed` lists further deleted matches, for bulk deletes.
+    Players take the new ratings only when `year` is the current season, as
+    with recompute_year(update_players=False).
+    """
+    from .checkpoints import invalidate
+
+    start = time.perf_counter()
+    starts_here = Q(date_played__gt=start_date) | Q(date_played=start_date, id__gte=start_id)
+
+    with transaction.atomic():
+        # Any player's rating may move, and no match may be rated against them meanwhile
+        Player.objects.lock()
+        invalidate(year, start_date, start_id)
+        matches = list(Match.objects.filter(starts_here, year=year).order_by('date_played', 'id'))
+
+        # The suffix as it looked when its snapshots were captured
+        gone = list(removed) + ([previous] if previous is not None else [])
+        replaced_ids = {unrated_id} | {match.pk for match in gone}
+        # Queued matches haven't been rated, so their snapshots are meaningless too
+        old_matches = [match for match in matches if match.pk not in replaced_ids and not match.rating_pending]
+        old_matches += [match for match in gone if match.year == year and not match.rating_pending]
+        old_matches.sort(key=lambda match: (match.date_played, match.pk))
+
+        new_player_ids = {getattr(match, f'{slot}_id') for match in matches for slot in PLAYER_SLOTS}
+        old_player_ids = {getattr(match, f'{slot}_id') for match in old_matches for slot in PLAYER_SLOTS}
+        players_by_id = Player.objects.in_bulk(new_player_ids | old_player_ids)
+
+        seeded = set()
+        for match in old_matches:
+            team1_won = match.result == Match.MatchResult.TEAM1_WIN
+            for slot in PLAYER_SLOTS:
+                player = players_by_id[getattr(match, f'{slot}_id')]
+                if player.pk not in seeded:
+                    seeded.add(player.pk)
+                    player.elo_rating = getattr(match, f'{slot}_elo_before')
+                    player.trueskill_mu = getattr(match, f'{slot}_trueskill_mu_before')
+                    player.trueskill_sigma = getattr(match, f'{slot}_trueskill_sigma_before')
+                won = team1_won == slot.startswith('team1')
+                player.matches_played -= 1
+                player.matches_won -= int(won)
+                player.matches_lost -= int(not won)
+
+        # Players dropped from the suffix fall back to their last match before it
+        before_start = Q(date_played__lt=start_date) | Q(date_played=start_date, match_id__lt=start_id)
+        for player_id in old_player_ids - new_player_ids:
+            players_by_id[player_id].last_match_date = (
+                MatchParticipant.objects.filter(before_start, player_id=player_id, year=year)
+                .aggregate(last=Max('date_played'))['last']
+            )
+
+        events = replay_matches(matches, players_by_id)
+
+        update_instances(Match, matches, MATCH_RATING_FIELDS)
+        # Players carry the current season's ratings, which a past season's replay would overwrite
+        if year == timezone.now().year:
+            update_instances(Player, players_by_id.values(), PLAYER_RATING_FIELDS)
+        stale_events = Q(match__in=Match.objects.filter(starts_here, year=year))
+        if gone:
+            stale_events |= Q(match__in=[match.pk for match in gone])
+        RatingEvent.objects.filter(stale_events).delete()
+        RatingEvent.objects.bulk_create(events, batch_size=batch_size)
+        bump_league_version()
+        invalidate_player_pages()
+
+    return RecomputeResult(
+        matches=len(matches),
+        players=len(players_by_id),
+        elapsed=time.perf_counter() - start,
+    )
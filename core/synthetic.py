@@ -0,0 +1,145 @@
+"""
+Synthetic league generation for benchmarks and seeding.
+
+Ratings are replayed with a RatingTable and matches, participants and rating
+events are streamed straight into their tables with COPY (see core.bulk), so
+no model instance is built per row and memory stays bounded by the chunk size
+rather than by the size of the league.
+"""
+import math
+import random
+from datetime import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from .bulk import copy_rows, foreign_keys_checked_after, reserve_ids
+from .checkpoints import CheckpointSchedule, checkpoint
+from .models import (
+    ArchivedPlayerStats, Match, MatchParticipant, PairRecord, Player, RatingCheckpoint, RatingEvent, YearArchive,
+)
+from .pairs import rebuild_year as rebuild_pair_records
+from .recompute import EVENT_ROW_FIELDS, MATCH_ROW_FIELDS, PARTICIPANT_ROW_FIELDS, RatingTable
+
+PLAYER_ROW_FIELDS = [
+    'id', 'name', 'email', 'elo_rating', 'trueskill_mu', 'trueskill_sigma',
+    'matches_played', 'matches_won', 'matches_lost', 'created_at', 'last_match_date', 'current_year',
+]
+
+
+def year_span(year, now):
+    """First and last datetime matches of `year` can be played at, never in the future"""
+    start = timezone.make_aware(datetime(year, 1, 1))
+    end = min(timezone.make_aware(datetime(year + 1, 1, 1)), now)
+    return start, end
+
+
+def matches_per_year(num_matches, years):
+    """Splits `num_matches` as evenly as possible over `years`"""
+    counts = []
+    remaining = num_matches
+    for index in range(len(years)):
+        counts.append(remaining // (len(years) - index))
+        remaining -= counts[-1]
+    return counts
+
+
+def generate_league(num_players, num_matches, years, archived_years=(), seed=None, batch_size=50000,
+                    names=None, log=None):
+    """
+    Generates a league of `num_players` players and `num_matches` matches spread
+    evenly over `years` (in chronological order).
+
+    Each year starts from default ratings, like after an archive; years listed in
+    `archived_years` also get their YearArchive and ArchivedPlayerStats rows. The
+    last year's ratings are left on the players. `names` optionally yields
+    (name, email) pairs for the players. Returns (players, matches) counts.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    log = log or (lambda message: None)
+    if names is None:
+        names = ((f"Player {index:06d}", f"player{index:06d}@example.com") for index in range(num_players))
+    names = [next(names) for _ in range(num_players)]
+
+    with transaction.atomic(), foreign_keys_checked_after(Match, MatchParticipant, RatingEvent, PairRecord):
+        player_ids = reserve_ids(Player, num_players)
+        # Hidden skill that drives outcomes, so ratings have something to converge to
+        strengths = {player_id: rng.gauss(0, 1) for player_id in player_ids}
+        ratings = RatingTable()
+        for player_id in player_ids:
+            ratings.add(player_id)
+
+        for year_index, (year, year_matches) in enumerate(zip(years, matches_per_year(num_matches, years))):
+            if year_index:
+                ratings.reset()
+
+            start, end = year_span(year, now)
+            step = (end - start) / max(year_matches, 1)
+            schedule = CheckpointSchedule()
+            for chunk_start in range(0, year_matches, batch_size):
+                chunk_size = min(batch_size, year_matches - chunk_start)
+                matches, participants, events, checkpoints = [], [], [], []
+                for offset, match_id in enumerate(reserve_ids(Match, chunk_size)):
+                    ids = rng.sample(player_ids, 4)
+                    edge = strengths[ids[0]] + strengths[ids[1]] - strengths[ids[2]] - strengths[ids[3]]
+                    team1_won = rng.random() < 1 / (1 + math.exp(-edge))
+                    winner_score = rng.randint(6, 10)
+                    loser_score = rng.randint(0, winner_score - 1)
+                    date_played = start + step * (chunk_start + offset)
+                    matches.append([match_id] + ids + [
+                        winner_score if team1_won else loser_score,
+                        loser_score if team1_won else winner_score,
+                        Match.MatchResult.TEAM1_WIN if team1_won else Match.MatchResult.TEAM2_WIN,
+                        date_played, year,
+                    ] + ratings.play(match_id, ids, team1_won, date_played, year, participants, events))
+                    played = chunk_start + offset + 1
+                    if schedule.due(date_played, start + step * played if played < year_matches else None):
+                        position = Match(pk=match_id, date_played=date_played, year=year)
+                        checkpoints.append(checkpoint(position, schedule.counted, ratings))
+
+                # Players are written last, with their final ratings; foreign keys
+                # are only checked once everything is loaded
+                copy_rows(Match, MATCH_ROW_FIELDS, matches, batch_size)
+                copy_rows(MatchParticipant, PARTICIPANT_ROW_FIELDS, participants, batch_size)
+                copy_rows(RatingEvent, EVENT_ROW_FIELDS, events, batch_size)
+                RatingCheckpoint.objects.bulk_create(checkpoints)
+                log(f"Created {chunk_start + chunk_size}/{year_matches} matches for {year}")
+            rebuild_pair_records(year)
+
+            if year in archived_years:
+                _archive(year, year_matches, ratings, player_ids, names)
+                log(f"Archived {year}")
+
+        copy_rows(Player, PLAYER_ROW_FIELDS, (
+            (
+                player_id, name, email, ratings.elo[player_id], ratings.mu[player_id], ratings.sigma[player_id],
+                ratings.played[player_id], ratings.won[player_id], ratings.played[player_id] - ratings.won[player_id],
+                now, ratings.last_played[player_id], years[-1],
+            )
+            for player_id, (name, email) in zip(player_ids, names)
+        ), batch_size)
+
+    return num_players, num_matches
+
+
+def _archive(year, year_matches, ratings, player_ids, names):
+    active = [(player_id, name) for player_id, name in zip(player_ids, names) if ratings.played[player_id]]
+    archive = YearArchive.objects.create(year=year, total_matches=year_matches, total_players=len(active))
+    ArchivedPlayerStats.objects.bulk_create(
+        [
+            ArchivedPlayerStats(
+                archive=archive,
+                player_name=name,
+                player_email=email,
+                elo_rating=ratings.elo[player_id],
+                trueskill_mu=ratings.mu[player_id],
+                trueskill_sigma=ratings.sigma[player_id],
+                matches_played=ratings.played[player_id],
+                matches_won=ratings.won[player_id],
+                matches_lost=ratings.played[player_id] - ratings.won[player_id],
+            )
+            for player_id, (name, email) in active
+        ],
+        batch_size=1000,
+    )
@@ -1,3 +1,927 @@
-from django.test import TestCase
+import io
+import json
+import random
+import tempfile
+import threading
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import trueskill
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import player_pages
+from .cache import bump_league_version, get_league_version, get_or_build, local_cache, player_page_key
+from .checkpoints import after, build_checkpoints, pack, state_at, unpack
+from .context_processors import rating_queue as rating_queue_banner
+from .history import (
+    MAX_CHART_POINTS, SCALE, chart_payload, downsample, history_columns, largest_triangle_three_buckets,
+)
+from .models import (
+    PLAYER_SLOTS, TRUESKILL_DEFAULT_SIGMA, Match, MatchParticipant, PairRecord, Player, PlayerQuerySet,
+    RatingCheckpoint, RatingEvent, YearArchive,
+)
+from .pairs import rebuild_year as rebuild_pair_records
+from .rating_queue import apply_next_batch, pending
+from .ratings import rate_2v2
+from .recompute import (
+    MATCH_RATING_FIELDS, PLAYER_RATING_FIELDS, RatingTable, recompute_year, replay_matches, reset_player_ratings,
+)
+
+# Players carry the current season's ratings only
+YEAR = timezone.now().year
+# Keeps the tests off the database cache table, which migrations don't create
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def league_state():
+    """Everything the rating paths write, in a form that compares across them"""
+    return {
+        'players': {row['id']: row for row in Player.objects.values('id', *PLAYER_RATING_FIELDS)},
+        'matches': {row['id']: row for row in Match.objects.values('id', 'result', *MATCH_RATING_FIELDS)},
+        'events': {
+            (row['player_id'], row['match_id']): row
+            for row in RatingEvent.objects.values(*(
+                field.attname for field in RatingEvent._meta.concrete_fields if not field.primary_key
+            ))
+        },
+        'participants': set(MatchParticipant.objects.values_list(
+            'match_id', 'player_id', 'team', 'slot', 'won', 'year', 'date_played'
+        )),
+        'pairs': set(PairRecord.objects.filter(played__gt=0).values_list(
+            'player_a_id', 'player_b_id', 'relation', 'year', 'played', 'won', 'last_played'
+        )),
+    }
+
+
+def in_thread(target, *args):
+    """Starts target(*args) on a thread with its own connection; returns the thread and its errors"""
+    errors = []
+
+    def run():
+        try:
+            target(*args)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, errors
+
+
+@override_settings(CACHES=LOCAL_CACHE, RATING_QUEUE=False)
+class LeagueTestCase(TestCase):
+    """A small seeded league, recorded one Match.save() at a time in date order"""
+    player_count = 8
+    match_count = 40
+
+    def setUp(self):
+        self.rng = random.Random(YEAR)
+        self.players = [
+            Player.objects.create(name=f'Player {index}', email=f'player{index}@example.com')
+            for index in range(self.player_count)
+        ]
+        self.start = datetime(YEAR, 1, 2, 18, tzinfo=dt_timezone.utc)
+        self.matches = [self.play(self.start + index * timedelta(hours=5)) for index in range(self.match_count)]
+
+    def play(self, date_played, players=None):
+        """Records a match between four random players (or the given ones) with a random winner"""
+        players = players or self.rng.sample(self.players, 4)
+        loser_score = self.rng.randrange(10)
+        team1_score, team2_score = (10, loser_score) if self.rng.random() < 0.5 else (loser_score, 10)
+        match = Match(
+            **dict(zip(PLAYER_SLOTS, players)),
+            team1_score=team1_score, team2_score=team2_score, date_played=date_played,
+        )
+        match.save()
+        return match
+
+    def assertSameAsRecompute(self):
+        """The league as it stands is exactly what a full recompute of the year leaves"""
+        state = league_state()
+        recompute_year(YEAR)
+        expected = league_state()
+        for table in expected:
+            self.assertEqual(state[table], expected[table], table)
+
+
+class RecomputeYearTests(LeagueTestCase):
+    def test_recompute_year_matches_per_match_path(self):
+        state = league_state()
+        # Scrambled ratings and snapshots are all rewritten
+        Player.objects.update(elo_rating=0, trueskill_mu=0, trueskill_sigma=1, matches_played=0)
+        Match.objects.update(**{field: 0 for field in MATCH_RATING_FIELDS if field.endswith('_before')})
+
+        result = recompute_year(YEAR)
+
+        self.assertEqual(result.matches, self.match_count)
+        self.assertEqual(league_state(), state)
+
+    def test_replay_matches_matches_stored_snapshots(self):
+        stored = league_state()
+        players_by_id = Player.objects.in_bulk()
+        for player in players_by_id.values():
+            reset_player_ratings(player)
+        matches = list(Match.objects.filter(year=YEAR).order_by('date_played', 'id'))
+
+        events = replay_matches(matches, players_by_id)
+
+        for match in matches:
+            for field in MATCH_RATING_FIELDS:
+                self.assertEqual(getattr(match, field), stored['matches'][match.pk][field], field)
+        for player in players_by_id.values():
+            for field in PLAYER_RATING_FIELDS:
+                self.assertEqual(getattr(player, field), stored['players'][player.pk][field], field)
+        self.assertEqual(len(events), 4 * self.match_count)
+        for event in events:
+            row = stored['events'][event.player_id, event.match_id]
+            self.assertEqual(
+                (event.elo_before, event.elo_after, event.trueskill_mu_after, event.trueskill_sigma_after),
+                (row['elo_before'], row['elo_after'], row['trueskill_mu_after'], row['trueskill_sigma_after']),
+            )
+
+
+class RecomputeSuffixTests(LeagueTestCase):
+    """Every way of changing a rated match leaves the league as a full recompute would"""
+
+    def test_in_order_insert(self):
+        self.play(self.start + self.match_count * timedelta(hours=5))
+        self.assertSameAsRecompute()
+
+    def test_backdated_insert(self):
+        self.play(self.start + timedelta(hours=52))
+        self.assertSameAsRecompute()
+
+    def test_backdated_insert_with_new_player(self):
+        newcomer = Player.objects.create(name='Newcomer', email='newcomer@example.com')
+        self.play(self.start + timedelta(hours=102), players=[newcomer] + self.rng.sample(self.players, 3))
+        self.assertSameAsRecompute()
+
+    def test_result_edit(self):
+        match = self.matches[10]
+        match.team1_score, match.team2_score = match.team2_score, match.team1_score
+        match.save()
+        self.assertSameAsRecompute()
+
+    def test_date_moved_earlier(self):
+        match = self.matches[30]
+        match.date_played = self.start + timedelta(hours=27)
+        match.save()
+        self.assertSameAsRecompute()
+
+    def test_date_moved_later(self):
+        match = self.matches[5]
+        match.date_played = self.start + timedelta(hours=152)
+        match.save()
+        self.assertSameAsRecompute()
+
+    def test_player_swap(self):
+        match = self.matches[12]
+        match.team1_player1 = next(player for player in self.players if player not in match.players)
+        match.save()
+        self.assertSameAsRecompute()
+
+    def test_player_swapped_out_of_only_match(self):
+        newcomer = Player.objects.create(name='Newcomer', email='newcomer@example.com')
+        match = self.play(self.start + timedelta(hours=77), players=[newcomer] + self.rng.sample(self.players, 3))
+        match.team1_player1 = next(player for player in self.players if player not in match.players)
+        match.save()
+
+        newcomer.refresh_from_db()
+        self.assertEqual((newcomer.matches_played, newcomer.elo_rating, newcomer.last_match_date), (0, 1000, None))
+        self.assertSameAsRecompute()
+
+    def test_past_season_change_keeps_current_ratings(self):
+        past = [
+            self.play(datetime(YEAR - 1, 6, 1, 18, tzinfo=dt_timezone.utc) + index * timedelta(hours=5))
+            for index in range(10)
+        ]
+        # Recorded after this season's matches, so rated from the wrong start; put both seasons right
+        recompute_year(YEAR - 1, update_players=False)
+        recompute_year(YEAR)
+        players = league_state()['players']
+
+        past[3].delete()
+        match = past[6]
+        match.team1_score, match.team2_score = match.team2_score, match.team1_score
+        match.save()
+
+        self.assertEqual(league_state()['players'], players)
+        state = league_state()
+        recompute_year(YEAR - 1, update_players=False)
+        self.assertEqual(league_state(), state)
+
+    def test_delete(self):
+        self.matches[20].delete()
+        self.assertSameAsRecompute()
+
+    def test_admin_bulk_delete(self):
+        deleted = [self.matches[index].pk for index in (3, 17, 18, 35)]
+        request = RequestFactory().post('/admin/core/match/')
+        site._registry[Match].delete_queryset(request, Match.objects.filter(pk__in=deleted))
+
+        self.assertFalse(Match.objects.filter(pk__in=deleted).exists())
+        self.assertSameAsRecompute()
+
+
+@override_settings(CACHES=LOCAL_CACHE, RATING_QUEUE=False)
+class ConcurrentSaveTests(TransactionTestCase):
+    """Matches sharing a player, saved from several connections at once"""
+
+    def setUp(self):
+        self.players = [
+            Player.objects.create(name=f'Player {index}', email=f'player{index}@example.com') for index in range(10)
+        ]
+        self.start = datetime(YEAR, 1, 2, 18, tzinfo=dt_timezone.utc)
+
+    def match(self, players, date_played):
+        return Match(**dict(zip(PLAYER_SLOTS, players)), team1_score=10, team2_score=5, date_played=date_played)
+
+    def test_save_waits_for_shared_player_and_rereads_it(self):
+        shared = self.players[0]
+        with transaction.atomic():
+            Player.objects.lock([shared.pk])
+            thread, errors = in_thread(self.match(self.players[:4], self.start).save)
+            thread.join(timeout=0.5)
+            self.assertTrue(thread.is_alive(), "saved without waiting for the locked player")
+            Player.objects.filter(pk=shared.pk).update(elo_rating=1234)
+        thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Match.objects.get().team1_player1_elo_before, 1234)
+
+    def test_concurrent_saves_chain_snapshots(self):
+        shared = self.players[0]
+        rounds = 15
+        barrier = threading.Barrier(3)
+
+        def record(offset, others):
+            barrier.wait()
+            for index in range(rounds):
+                # Interleaved dates, so a save that loses the race is rated as backdated
+                date_played = self.start + timedelta(minutes=3 * index + offset)
+                self.match([shared] + others, date_played).save()
+
+        threads = [in_thread(record, offset, self.players[1 + 3 * offset:4 + 3 * offset]) for offset in range(3)]
+        for thread, errors in threads:
+            thread.join()
+            self.assertEqual(errors, [])
+
+        # Each of the shared player's matches starts where the one before left off
+        events = list(RatingEvent.objects.filter(player=shared).order_by('date_played', 'match_id'))
+        self.assertEqual(len(events), 3 * rounds)
+        for earlier, later in zip(events, events[1:]):
+            self.assertEqual(
+                (later.elo_before, later.trueskill_mu_before, later.trueskill_sigma_before),
+                (earlier.elo_after, earlier.trueskill_mu_after, earlier.trueskill_sigma_after),
+            )
+        shared.refresh_from_db()
+        self.assertEqual(shared.matches_played, 3 * rounds)
+        self.assertEqual(shared.elo_rating, events[-1].elo_after)
+
+        state = league_state()
+        recompute_year(YEAR)
+        self.assertEqual(league_state(), state)
+
+
+def drain(batch_size):
+    """Applies queued matches until none are left, returning the size of each batch"""
+    batches = []
+    while applied := apply_next_batch(batch_size):
+        batches.append(applied)
+    return batches
+
+
+class RatingQueueTests(LeagueTestCase):
+    """Queued matches, once drained, are rated as a full recompute would rate them"""
+
+    def queue(self, count, start):
+        with self.settings(RATING_QUEUE=True):
+            return [self.play(start + index * timedelta(hours=3)) for index in range(count)]
+
+    def test_drain_in_order(self):
+        queued = self.queue(20, self.start + self.match_count * timedelta(hours=5))
+        self.assertEqual(pending().count(), 20)
+        self.assertFalse(RatingEvent.objects.filter(match__in=queued).exists())
+
+        self.assertEqual(drain(batch_size=7), [7, 7, 6])
+        self.assertFalse(pending().exists())
+        self.assertSameAsRecompute()
+
+    def test_backdated_queued_match(self):
+        # Dated among rated matches of its players, so it goes through recompute_suffix()
+        self.queue(1, self.start + timedelta(hours=41))
+        self.assertEqual(drain(batch_size=7), [1])
+        self.assertSameAsRecompute()
+
+    def test_backdated_match_behind_queued_ones(self):
+        self.queue(10, self.start + self.match_count * timedelta(hours=5))
+        self.queue(1, self.start + timedelta(hours=41))
+        self.assertEqual(sum(drain(batch_size=4)), 11)
+        self.assertSameAsRecompute()
+
+    def test_edited_while_pending(self):
+        queued = self.queue(10, self.start + self.match_count * timedelta(hours=5))
+        match = queued[4]
+        match.team1_score, match.team2_score = match.team2_score, match.team1_score
+        match.date_played = self.start + timedelta(hours=93)
+        match.save()
+
+        drain(batch_size=4)
+        self.assertFalse(pending().exists())
+        self.assertSameAsRecompute()
+
+    def test_deleted_while_pending(self):
+        queued = self.queue(10, self.start + self.match_count * timedelta(hours=5))
+        queued[2].delete()
+
+        # The delete re-rates the season from its match on, queued ones included
+        self.assertEqual(pending().count(), 2)
+        self.assertEqual(drain(batch_size=4), [2])
+        self.assertSameAsRecompute()
+
+    @override_settings(CACHES=LOCAL_CACHE, RATING_QUEUE=True)
+    @mock.patch.object(player_pages, '_warmer')
+    def test_banner_served_from_cache(self, warmer):
+        cache.clear()
+        local_cache.clear()
+        request = RequestFactory().get('/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.queue(3, self.start + self.match_count * timedelta(hours=5))
+        self.assertEqual(rating_queue_banner(request)['rating_queue']['pending'], 3)
+
+        with self.assertNumQueries(0):
+            status = rating_queue_banner(request)['rating_queue']
+        self.assertEqual(status['pending'], 3)
+        self.assertGreater(status['lag'], 0)
+
+        # Rating the batch bumps the league version, which moves the banner on
+        with self.captureOnCommitCallbacks(execute=True):
+            drain(batch_size=7)
+        self.assertEqual(rating_queue_banner(request)['rating_queue'], {'pending': 0, 'lag': 0.0})
+
+
+@override_settings(CACHES=LOCAL_CACHE, RATING_QUEUE=True)
+class RatingQueueRetryTests(TransactionTestCase):
+    """A batch that another connection changes after the queue picked it is picked again"""
+
+    def setUp(self):
+        players = [
+            Player.objects.create(name=f'Player {index}', email=f'player{index}@example.com') for index in range(6)
+        ]
+        start = datetime(YEAR, 1, 2, 18, tzinfo=dt_timezone.utc)
+        self.queued = []
+        for index in range(8):
+            match = Match(
+                **dict(zip(PLAYER_SLOTS, players[index % 3:index % 3 + 4])),
+                team1_score=10, team2_score=index, date_played=start + index * timedelta(hours=1),
+            )
+            match.save()
+            self.queued.append(match)
+
+    def drain_after(self, change):
+        """Drains the queue, running change() on another connection once the first batch is picked"""
+        lock = PlayerQuerySet.lock
+        changes = []
+
+        def lock_after_change(queryset, player_ids=None):
+            if not changes:
+                changes.append(change)
+                thread, errors = in_thread(change)
+                thread.join()
+                self.assertEqual(errors, [])
+            return lock(queryset, player_ids)
+
+        with mock.patch.object(PlayerQuerySet, 'lock', lock_after_change):
+            drain(batch_size=10)
+
+        self.assertEqual(changes, [change])
+        self.assertFalse(pending().exists())
+        state = league_state()
+        recompute_year(YEAR)
+        self.assertEqual(league_state(), state)
+
+    def test_edited_after_pick(self):
+        def edit():
+            match = Match.objects.get(pk=self.queued[5].pk)
+            match.team1_score, match.team2_score = 0, 10
+            match.save()
+
+        self.drain_after(edit)
+        self.assertEqual(Match.objects.get(pk=self.queued[5].pk).result, Match.MatchResult.TEAM2_WIN)
+
+    def test_deleted_after_pick(self):
+        self.drain_after(Match.objects.get(pk=self.queued[-1].pk).delete)
+        self.assertEqual(Match.objects.count(), 7)
+
+
+def table_state(table):
+    """Ratings of everyone in a RatingTable who has played, by player id"""
+    return {
+        player_id: (
+            table.elo[player_id], table.mu[player_id], table.sigma[player_id],
+            table.played[player_id], table.won[player_id], table.last_played[player_id],
+        )
+        for player_id, played in table.played.items() if played
+    }
+
+
+def checkpoint_state():
+    return [
+        (point.date_played, point.match_id, point.matches, point.players, table_state(unpack(point.data)))
+        for point in RatingCheckpoint.objects.filter(year=YEAR).order_by('date_played', 'match_id')
+    ]
+
+
+class CheckpointTests(LeagueTestCase):
+    def replayed(self, moment):
+        """RatingTable of the league up to `moment`, replayed from the start of the season"""
+        table = RatingTable()
+        for match in Match.objects.filter(year=YEAR, date_played__lte=moment).order_by('date_played', 'id'):
+            player_ids = [getattr(match, f'{slot}_id') for slot in PLAYER_SLOTS]
+            for player_id in player_ids:
+                if player_id not in table.elo:
+                    table.add(player_id)
+            table.play(match.pk, player_ids, match.result == Match.MatchResult.TEAM1_WIN, match.date_played, YEAR)
+        return table
+
+    def test_pack_round_trip(self):
+        table = self.replayed(self.start + timedelta(days=3))
+        # Players who haven't played are left out
+        table.add(self.players[-1].pk + 1000)
+
+        unpacked = unpack(pack(table))
+
+        self.assertEqual(table_state(unpacked), table_state(table))
+        self.assertNotIn(self.players[-1].pk + 1000, unpacked.elo)
+
+    def test_build_checkpoints(self):
+        added = build_checkpoints(YEAR, interval=3)
+
+        # One after each day that had matches, and after every 3 matches in between
+        self.assertEqual(added, RatingCheckpoint.objects.filter(year=YEAR).count())
+        last_of_day = {
+            day: match.pk for match in self.matches
+            # Days not over yet only get interval checkpoints
+            if (day := timezone.localdate(match.date_played)) < timezone.localdate()
+        }
+        match_ids = set(RatingCheckpoint.objects.filter(year=YEAR).values_list('match_id', flat=True))
+        self.assertLessEqual(set(last_of_day.values()), match_ids)
+        self.assertGreater(len(match_ids), len(last_of_day))
+        self.assertEqual(build_checkpoints(YEAR, interval=3), 0)
+        for point in RatingCheckpoint.objects.filter(year=YEAR):
+            self.assertEqual(table_state(unpack(point.data)), table_state(self.replayed(point.date_played)))
+
+    def test_state_at_matches_replay(self):
+        build_checkpoints(YEAR, interval=7)
+        moments = [self.start - timedelta(hours=1), self.start] + [
+            match.date_played + offset for match in self.matches[::6] for offset in (timedelta(0), timedelta(hours=2))
+        ]
+        for moment in moments:
+            self.assertEqual(table_state(state_at(YEAR, moment)), table_state(self.replayed(moment)), moment)
+
+        players = {player.pk: player for player in Player.objects.filter(matches_played__gt=0)}
+        self.assertEqual(table_state(state_at(YEAR)), {
+            player.pk: (
+                player.elo_rating, player.trueskill_mu, player.trueskill_sigma,
+                player.matches_played, player.matches_won, player.last_match_date,
+            )
+            for player in players.values()
+        })
+
+    def test_resumed_recompute_matches_full_recompute(self):
+        recompute_year(YEAR)
+        state, checkpoints = league_state(), checkpoint_state()
+        since = self.matches[25].date_played
+        # Anything from `since` on is rebuilt; the ratings before it come from a checkpoint
+        Player.objects.update(elo_rating=0, trueskill_mu=0, trueskill_sigma=1, matches_played=0)
+        Match.objects.filter(date_played__gte=since).update(
+            **{field: 0 for field in MATCH_RATING_FIELDS if field.endswith('_before')}
+        )
+
+        result = recompute_year(YEAR, since=since)
+
+        self.assertLess(result.matches, self.match_count - 25 + 7)
+        self.assertEqual(league_state(), state)
+        self.assertEqual(checkpoint_state(), checkpoints)
+
+    @override_settings(RATING_CHECKPOINT_INTERVAL=4)
+    def test_saves_and_deletes_add_checkpoints(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.play(self.matches[-1].date_played + timedelta(hours=1))
+        self.assertCheckpointsBounded()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.matches[12].delete()
+        self.assertCheckpointsBounded()
+
+    def assertCheckpointsBounded(self):
+        """Checkpoints hold, and leave fewer than an interval of matches to replay"""
+        points = RatingCheckpoint.objects.filter(year=YEAR)
+        for point in points:
+            self.assertEqual(table_state(unpack(point.data)), table_state(self.replayed(point.date_played)))
+        last = points.order_by('-date_played', '-match_id').first()
+        self.assertLess(Match.objects.filter(after(last, 'id'), year=YEAR).count(), 4)
+
+    def test_edit_drops_later_checkpoints(self):
+        build_checkpoints(YEAR, interval=7)
+        match = self.matches[20]
+        match.team1_score, match.team2_score = match.team2_score, match.team1_score
+        match.save()
+
+        self.assertFalse(RatingCheckpoint.objects.filter(year=YEAR, date_played__gte=match.date_played).exists())
+        build_checkpoints(YEAR, interval=7)
+        for point in RatingCheckpoint.objects.filter(year=YEAR):
+            self.assertEqual(table_state(unpack(point.data)), table_state(self.replayed(point.date_played)))
+
+
+class PairRecordTests(LeagueTestCase):
+    """Pair records kept up to date match by match equal a rebuild from the participants"""
+
+    def assertSameAsRebuild(self):
+        incremental = league_state()['pairs']
+        rebuild_pair_records(YEAR)
+        self.assertEqual(league_state()['pairs'], incremental)
+
+        # And both equal a count straight from the matches
+        counted = {}
+        for match in Match.objects.filter(year=YEAR):
+            teams = ([match.team1_player1_id, match.team1_player2_id], [match.team2_player1_id, match.team2_player2_id])
+            winners = teams[0] if match.result == Match.MatchResult.TEAM1_WIN else teams[1]
+            pairs = [(*team, PairRecord.Relation.PARTNER) for team in teams] + [
+                (a, b, PairRecord.Relation.OPPONENT) for a in teams[0] for b in teams[1]
+            ]
+            for a, b, relation in pairs:
+                a, b = sorted((a, b))
+                played, won, last_played = counted.get((a, b, relation), (0, 0, match.date_played))
+                counted[a, b, relation] = (played + 1, won + (a in winners), max(last_played, match.date_played))
+        self.assertEqual(incremental, {
+            (a, b, relation, YEAR, played, won, last_played)
+            for (a, b, relation), (played, won, last_played) in counted.items()
+        })
+
+    def test_saves(self):
+        self.assertSameAsRebuild()
+
+    def test_edit_swapping_players(self):
+        match = self.matches[15]
+        outsider = next(player for player in self.players if player not in match.players)
+        # One player leaves, and two swap teams
+        match.team1_player1, match.team1_player2, match.team2_player1 = (
+            outsider, match.team2_player1, match.team1_player2,
+        )
+        match.save()
+        self.assertSameAsRebuild()
+
+    def test_edit_moving_the_latest_match(self):
+        match = self.matches[-1]
+        match.date_played = self.start + timedelta(hours=1)
+        match.team1_score, match.team2_score = match.team2_score, match.team1_score
+        match.save()
+        self.assertSameAsRebuild()
+
+    def test_delete(self):
+        self.matches[-1].delete()
+        self.matches[8].delete()
+        self.assertSameAsRebuild()
+
+    def test_delete_only_match_of_a_pair(self):
+        newcomer = Player.objects.create(name='Newcomer', email='newcomer@example.com')
+        match = self.play(self.start + timedelta(hours=33), players=[newcomer] + self.players[:3])
+        self.assertTrue(PairRecord.objects.involving(newcomer).exists())
+
+        match.delete()
+
+        self.assertFalse(PairRecord.objects.involving(newcomer).exists())
+        self.assertSameAsRebuild()
+
+
+class LeaderboardCacheTests(LeagueTestCase):
+    def setUp(self):
+        super().setUp()
+        # Local memory caches outlive the test that filled them
+        cache.clear()
+        local_cache.clear()
+        self.builds = []
+
+    def build(self):
+        self.builds.append(get_league_version())
+        return len(self.builds)
+
+    def test_rebuilt_after_league_version_bump(self):
+        self.assertEqual(get_or_build('test', self.build), 1)
+        self.assertEqual(get_or_build('test', self.build), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_league_version()
+            # Nothing changes until the transaction commits
+            self.assertEqual(get_or_build('test', self.build), 1)
+
+        self.assertEqual(get_or_build('test', self.build), 2)
+        self.assertEqual(len(set(self.builds)), 2)
+
+    def test_stale_entry_served_while_another_worker_rebuilds(self):
+        get_or_build('test', self.build)
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_league_version()
+        cache.add('leaderboard:test:rebuild', 1)
+
+        self.assertEqual(get_or_build('test', self.build), 1)
+        cache.delete('leaderboard:test:rebuild')
+        self.assertEqual(get_or_build('test', self.build), 2)
+
+    def test_new_match_refreshes_rankings(self):
+        def rankings():
+            response = self.client.get(reverse('rankings'), {'sort': 'elo_rating'})
+            return {player.pk: player.elo_rating for player in response.context['players']}
+
+        self.assertEqual(rankings(), dict(Player.objects.values_list('pk', 'elo_rating')))
+        with self.captureOnCommitCallbacks(execute=True), mock.patch.object(player_pages, '_warmer'):
+            match = self.play(self.matches[-1].date_played + timedelta(hours=1))
+
+        self.assertEqual(rankings(), dict(Player.objects.values_list('pk', 'elo_rating')))
+        winner = match.team1_player1 if match.result == Match.MatchResult.TEAM1_WIN else match.team2_player1
+        self.assertEqual(rankings()[winner.pk], winner.elo_rating)
+
+
+class PlayerPageCacheTests(LeagueTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        warmer = mock.patch.object(player_pages, '_warmer')
+        self.warmer = warmer.start()
+        self.addCleanup(warmer.stop)
+
+    def page_keys(self):
+        return {player.pk: player_page_key(player.pk, YEAR) for player in Player.objects.all()}
+
+    def assertEveryPageInvalidated(self, before):
+        after = self.page_keys()
+        self.assertTrue(all(after[player_id] != key for player_id, key in before.items()))
+
+    def test_new_match_invalidates_its_four_players(self):
+        before = self.page_keys()
+        with self.captureOnCommitCallbacks(execute=True):
+            match = self.play(self.matches[-1].date_played + timedelta(hours=1))
+
+        after = self.page_keys()
+        player_ids = sorted(player.pk for player in match.players)
+        self.assertEqual(sorted(player_id for player_id in before if before[player_id] != after[player_id]), player_ids)
+        self.warmer.submit.assert_called_once_with(player_pages._warm, player_ids)
+
+    def test_page_shows_new_match(self):
+        player = self.players[0]
+        cached = player_pages.page_context(player, YEAR)
+        with self.captureOnCommitCallbacks(execute=True):
+            match = self.play(self.matches[-1].date_played + timedelta(hours=1), players=self.players[:4])
+
+        self.assertNotIn(match.pk, [shown.pk for shown in cached['matches']])
+        self.assertEqual(player_pages.page_context(player, YEAR)['matches'][0].pk, match.pk)
+
+    def test_recompute_invalidates_everyone(self):
+        before = self.page_keys()
+        with self.captureOnCommitCallbacks(execute=True):
+            recompute_year(YEAR)
+        self.assertEveryPageInvalidated(before)
+
+    def test_import_invalidates_everyone(self):
+        before, version = self.page_keys(), get_league_version()
+        day = self.matches[-1].date_played + timedelta(days=1)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as csv_file:
+            csv_file.write('team1_player1,team1_player2,team2_player1,team2_player2,team1_score,team2_score,date_played\n')
+            csv_file.write(','.join(player.email for player in self.players[:4]) + f',10,4,{day.isoformat()}\n')
+            csv_file.flush()
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('import_matches', csv_file.name, stdout=io.StringIO())
+
+        self.assertEqual(Match.objects.count(), self.match_count + 1)
+        self.assertNotEqual(get_league_version(), version)
+        self.assertEveryPageInvalidated(before)
+
+    def test_archive_invalidates_everyone(self):
+        last_season = datetime(YEAR - 1, 6, 1, 18, tzinfo=dt_timezone.utc)
+        for index in range(5):
+            self.play(last_season + index * timedelta(hours=5))
+        self.client.force_login(User.objects.create_superuser('admin'))
+        before, version = self.page_keys(), get_league_version()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('archive-year'), {'year': YEAR - 1})
+
+        self.assertTrue(YearArchive.objects.filter(year=YEAR - 1).exists())
+        self.assertNotEqual(get_league_version(), version)
+        self.assertEveryPageInvalidated(before)
+
+
+@override_settings(CACHES=LOCAL_CACHE, PREDICTIONS_TOKEN='')
+class WinProbabilityViewTests(TestCase):
+    def setUp(self):
+        self.players = [
+            Player.objects.create(name=f'Player {index}', email=f'player{index}@example.com') for index in range(4)
+        ]
+        self.ids = [player.pk for player in self.players]
+        self.client.force_login(User.objects.create_user('user'))
+
+    def post(self, body):
+        return self.client.post(
+            reverse('win-probabilities'), body if isinstance(body, str) else json.dumps(body),
+            content_type='application/json',
+        )
+
+    def test_predicts(self):
+        response = self.post({'matchups': [self.ids, self.ids[::-1]]})
+
+        self.assertEqual(response.status_code, 200)
+        first, second = response.json()['predictions']
+        self.assertEqual(first['players'], self.ids)
+        self.assertAlmostEqual(first['elo_team1_win_probability'], 0.5)
+        self.assertAlmostEqual(first['trueskill_team1_win_probability'], 1 - second['trueskill_team1_win_probability'])
+
+    def test_requires_login_or_token(self):
+        self.client.logout()
+        self.assertEqual(self.post({'matchups': [self.ids]}).status_code, 403)
+
+    def test_malformed_payloads(self):
+        a, b, c, d = self.ids
+        payloads = [
+            'not json',
+            [],
+            {'matchup': [self.ids]},
+            {'matchups': []},
+            {'matchups': 'abcd'},
+            {'matchups': [self.ids] * 1001},
+            {'matchups': [[a, b, c]]},
+            {'matchups': [[a, b, c, d, d + 1]]},
+            {'matchups': [[a, b, c, c]]},
+            {'matchups': [[a, b, c, str(d)]]},
+            {'matchups': [[a, b, c, float(d)]]},
+            {'matchups': [[a, b, c, True]]},
+            {'matchups': [[a, b, c, None]]},
+            {'matchups': [[a, b, c, -d]]},
+            {'matchups': [[a, b, c, 0]]},
+            {'matchups': [[a, b, c, 2 ** 63]]},
+            {'matchups': [[a, b, c, 10 ** 30]]},
+            {'matchups': [self.ids, [a, b, c, d + 1000]]},
+        ]
+        for payload in payloads:
+            with self.subTest(payload=str(payload)[:60]):
+                response = self.post(payload)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+
+class PlayerAnnotationTests(TestCase):
+    """The SQL annotations rankings are ordered by agree with the Player properties"""
+
+    def setUp(self):
+        now = timezone.now()
+        inactive = [None, timedelta(hours=2), timedelta(days=6, hours=23), timedelta(days=7, hours=1),
+                    timedelta(days=30, hours=12), timedelta(days=400)]
+        for index, since in enumerate(inactive):
+            played = 0 if since is None else 3 * index
+            Player.objects.create(
+                name=f'Player {index}', email=f'player{index}@example.com',
+                trueskill_mu=20 + index, trueskill_sigma=2 + index / 2,
+                matches_played=played, matches_won=played // 3, matches_lost=played - played // 3,
+                last_match_date=None if since is None else now - since,
+            )
+
+    def test_trueskill_score(self):
+        annotated = {player.pk: player for player in Player.objects.with_trueskill_score()}
+        for player in Player.objects.all():
+            with self.subTest(last_match_date=player.last_match_date):
+                self.assertFalse(hasattr(player, 'decayed_trueskill_sigma'))
+                self.assertAlmostEqual(annotated[player.pk].decayed_trueskill_sigma, player.effective_trueskill_sigma)
+                self.assertAlmostEqual(annotated[player.pk].conservative_score, player.trueskill_score)
+
+        undecayed = Player.objects.with_trueskill_score().filter(
+            Q(last_match_date__isnull=True) | Q(last_match_date__gt=timezone.now() - timedelta(days=7))
+        )
+        for player in undecayed:
+            self.assertEqual(player.decayed_trueskill_sigma, player.trueskill_sigma)
+        long_gone = Player.objects.with_trueskill_score().get(name='Player 5')
+        self.assertGreater(long_gone.decayed_trueskill_sigma, long_gone.trueskill_sigma)
+        self.assertLess(long_gone.decayed_trueskill_sigma, TRUESKILL_DEFAULT_SIGMA)
+
+    def test_win_percentage(self):
+        for player in Player.objects.with_win_percentage():
+            with self.subTest(matches_played=player.matches_played):
+                self.assertAlmostEqual(player.win_rate, player.win_percentage)
+
+
+def decode_history(encoded):
+    """decodeHistory() of core/templates/core/player_detail.html, point for point"""
+    points = []
+    day = date.fromisoformat(encoded['start']) if encoded['start'] else None
+    mu = sigma = match_id = 0
+    for index in range(len(encoded['days'])):
+        day += timedelta(days=encoded['days'][index])
+        mu += encoded['mu'][index]
+        sigma += encoded['sigma'][index]
+        match_id += encoded['match_id'][index]
+        starting_point = encoded['won'][index] == '-'
+        points.append({
+            'date': day,
+            'mu': mu / encoded['scale'],
+            'sigma': sigma / encoded['scale'],
+            'match_id': None if starting_point else match_id,
+            'won': None if starting_point else encoded['won'][index] == '1',
+        })
+    return points
+
+
+class HistoryTests(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        played = datetime(YEAR, 1, 2, 18, tzinfo=dt_timezone.utc)
+        mu, sigma = 25.0, 25 / 3
+        self.events = []
+        for match_id in range(1, 2001):
+            played += timedelta(hours=rng.choice([1, 2, 30, 100]))
+            mu_after, sigma_after = mu + rng.uniform(-1.5, 1.5), max(sigma * 0.99, 1)
+            self.events.append(SimpleNamespace(
+                date_played=played, match_id=match_id * 3, won=rng.random() < 0.5,
+                trueskill_mu_before=mu, trueskill_sigma_before=sigma,
+                trueskill_mu_after=mu_after, trueskill_sigma_after=sigma_after,
+            ))
+            mu, sigma = mu_after, sigma_after
+
+    def assertRoundTrip(self, columns, payload):
+        points = decode_history(payload)
+        self.assertEqual(len(points), len(columns['mu']))
+        for index, point in enumerate(points):
+            self.assertEqual(point['date'], columns['date'][index])
+            self.assertEqual(point['match_id'], columns['match_id'][index])
+            self.assertEqual(point['won'], columns['won'][index])
+            # Rounded to the nearest hundredth, without drift along the deltas
+            self.assertLessEqual(abs(point['mu'] - columns['mu'][index]), 0.5 / SCALE + 1e-9)
+            self.assertLessEqual(abs(point['sigma'] - columns['sigma'][index]), 0.5 / SCALE + 1e-9)
+
+    def test_delta_round_trip(self):
+        columns = history_columns(self.events)
+        payload = chart_payload(columns, max_points=MAX_CHART_POINTS)
+
+        self.assertEqual(payload['total'], len(self.events) + 1)
+        self.assertEqual(payload['won'][0], '-')
+        self.assertRoundTrip(columns, json.loads(json.dumps(payload)))
+
+    def test_downsampled_round_trip(self):
+        columns = history_columns(self.events)
+        payload = chart_payload(columns, max_points=100)
+
+        self.assertEqual(payload['total'], len(self.events) + 1)
+        self.assertEqual(len(payload['mu']), 100)
+        self.assertRoundTrip(downsample(columns, 100), payload)
+
+    def test_empty_history(self):
+        payload = chart_payload(history_columns([]))
+        self.assertEqual(payload['total'], 0)
+        self.assertEqual(decode_history(payload), [])
+
+    def test_lttb_keeps_ends_and_respects_points(self):
+        values = [event.trueskill_mu_after for event in self.events]
+        for points in (3, 10, 500, 1999):
+            with self.subTest(points=points):
+                selected = largest_triangle_three_buckets(values, points).tolist()
+                self.assertEqual(len(selected), points)
+                self.assertEqual((selected[0], selected[-1]), (0, len(values) - 1))
+                self.assertEqual(selected, sorted(set(selected)))
+        self.assertEqual(largest_triangle_three_buckets(values, 5000).tolist(), list(range(len(values))))
+
+    def test_lttb_keeps_extremes(self):
+        values = [0.0] * 1000
+        values[357], values[700] = 10.0, -10.0
+        selected = largest_triangle_three_buckets(values, 50).tolist()
+        self.assertIn(357, selected)
+        self.assertIn(700, selected)
+
+
+class RateTwoVsTwoTests(TestCase):
+    def test_matches_trueskill_library(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            team1, team2 = (
+                tuple((rng.uniform(10, 40), rng.uniform(0.5, 8.5)) for _ in range(2)) for _ in range(2)
+            )
+            team1_won = rng.random() < 0.5
+            expected = trueskill.rate(
+                [[trueskill.Rating(*rating) for rating in team] for team in (team1, team2)],
+                ranks=[0, 1] if team1_won else [1, 0],
+            )
+
+            rated = rate_2v2(team1, team2, team1_won)
+
+            for team, expected_team in zip(rated, expected):
+                for (mu, sigma), rating in zip(team, expected_team):
+                    self.assertAlmostEqual(mu, rating.mu, places=9)
+                    self.assertAlmostEqual(sigma, rating.sigma, places=9)
@@ -8,12 +8,17 @@ urlpatterns = [
     path('players/', views.PlayerListView.as_view(), name='player-list'),
     path('players/<int:pk>/', views.PlayerDetailView.as_view(), name='player-detail'),
     path('players/new/', views.PlayerCreateView.as_view(), name='player-create'),
+    path('players/search/', views.PlayerSearchView.as_view(), name='player-search'),
     path('players/<int:pk>/edit/', views.PlayerUpdateView.as_view(), name='player-update'),
+    path('players/<int:pk>/history/', views.PlayerHistoryView.as_view(), name='player-history'),
+    path('players/<int:pk>/vs/<int:other_pk>/', views.HeadToHeadView.as_view(), name='head-to-head'),
     
     # Match URLs
     path('matches/', views.MatchListView.as_view(), name='match-list'),
     path('matches/<int:pk>/', views.MatchDetailView.as_view(), name='match-detail'),
     path('matches/new/', views.MatchCreateView.as_view(), name='match-create'),
+    path('matches/matchmaking/', views.MatchmakingView.as_view(), name='matchmaking'),
+    path('matches/predictions/', views.WinProbabilityView.as_view(), name='win-probabilities'),
     
     # Ranking URL
     path('rankings/', views.RankingListView.as_view(), name='rankings'),
@@ -22,6 +27,12 @@ urlpatterns = [
     path('archives/', views.ArchivedYearsListView.as_view(), name='archived-years-list'),
     path('archives/<int:year>/', views.ArchivedYearDetailView.as_view(), name='archived-year-detail'),
     path('archive-year/', views.ArchiveYearView.as_view(), name='archive-year'),
+
+    # Prometheus metrics (admin or METRICS_TOKEN)
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
+
+    # Data export (admin only)
+    path('export/<slug:dataset>/', views.ExportView.as_view(), name='export'),
     
     # ELO Recomputation (admin only) - changed from admin/elo-recompute/ to avoid conflict
     path('elo-recompute/', views.EloRecomputeView.as_view(), name='elo-recompute'),
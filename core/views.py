@@ -6,32 +6,55 @@ from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
-from django.db.models import Q
-from django.http import JsonResponse
+from django.db.models import F, Q
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import user_passes_test
 from django.utils.decorators import method_decorator
 from django.db import transaction
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_date
 import json
+from datetime import datetime, time
+from operator import attrgetter
+from urllib.parse import urlencode
 import trueskill
 
-from .models import TRUESKILL_DEFAULT_MU, TRUESKILL_DEFAULT_SIGMA, Player, Match, RegistrationToken, YearArchive, ArchivedPlayerStats
+from .models import PLAYER_SLOTS, Player, Match, MatchParticipant, RatingEvent, RegistrationToken, YearArchive, ArchivedPlayerStats, PairRecord, RatingCheckpoint
 from .forms import PlayerForm, MatchForm # Assuming these forms are well-defined
+from .cache import bump_league_version, get_or_build
+from .checkpoints import standings_at
+from .exports import CONTENT_TYPES, ExportError, export
+from .history import CHART_POINTS, ENCODINGS, MAX_CHART_POINTS, chart_payload, history_columns
+from .matchmaking import balanced_matchups, predict_matchups
+from .metrics import render as render_metrics, timed
+from .pairs import rebuild_year as rebuild_pair_records
+from .player_pages import invalidate as invalidate_player_pages, page_context
+from .rating_queue import pending as pending_ratings, render_metrics as render_queue_metrics
+from .recompute import recompute_year
 
 class HomeView(ListView):
     model = Player
     template_name = 'core/home.html'
     context_object_name = 'players'
     
+    def get_queryset(self):
+        # Order by TrueSkill score for home page, top 10 players only
+        return get_or_build('home:top-players', lambda: list(
+            Player.objects.with_trueskill_score().order_by('-conservative_score', 'pk')[:10]
+        ))
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        # Order by TrueSkill score for home page
-        players = list(Player.objects.all())
-        players.sort(key=lambda p: p.trueskill_score, reverse=True)
-        context['players'] = players[:10]  # Show top 10 players on home page
         # Add recent matches to context for home page display
-        context['recent_matches'] = Match.objects.order_by('-date_played')[:5]
+        context['recent_matches'] = get_or_build('home:recent-matches', lambda: list(
+            Match.objects.select_related(
+                'team1_player1', 'team1_player2', 'team2_player1', 'team2_player2'
+            ).order_by('-date_played', '-id')[:5]
+        ))
         return context
 
 class PlayerListView(ListView):
@@ -39,13 +62,11 @@ class PlayerListView(ListView):
     template_name = 'core/player_list.html'
     context_object_name = 'players'
     
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    def get_queryset(self):
         # Order by TrueSkill score by default
-        players = list(Player.objects.all())
-        players.sort(key=lambda p: p.trueskill_score, reverse=True)
-        context['players'] = players
-        return context
+        return get_or_build('players:trueskill', lambda: list(
+            Player.objects.with_trueskill_score().order_by('-conservative_score', 'pk')
+        ))
 
 class PlayerDetailView(DetailView):
     model = Player
@@ -54,143 +75,87 @@ class PlayerDetailView(DetailView):
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        player = self.get_object()
-        current_year = timezone.now().year
-        # Fetch only current year matches involving this player
-        matches_qs = Match.objects.filter(
-            Q(team1_player1=player) | Q(team1_player2=player) |
-            Q(team2_player1=player) | Q(team2_player2=player),
-            year=current_year
-        ).distinct().order_by('-date_played')  # Ensure distinct matches and order by date
-        
-        # We need to annotate matches with trueskill changes.
-        matches_with_trueskill = self.annotate_matches_with_trueskill_change(matches_qs, player)
-        context['matches'] = matches_with_trueskill
-
-        # Generate TrueSkill history data for chart
-        trueskill_history = self.generate_trueskill_history(player)
-        # Convert to JSON to prevent JavaScript errors with None values
-        context['trueskill_history_json'] = json.dumps(trueskill_history) if trueskill_history else json.dumps([])
-        context['trueskill_history'] = trueskill_history
-
+        # Matches, partners and the chart only change when the player plays,
+        # so they come from the per-player page cache
+        context.update(page_context(self.object))
         return context
 
-    def annotate_matches_with_trueskill_change(self, matches, player):
-        """
-        Annotates each match with the TrueSkill score change for the given player.
-        This is complex because a player's TrueSkill score depends on all previous matches.
-        """
-        
-        # Get all matches in chronological order to calculate historical TrueSkill
-        all_matches_chrono = list(matches.order_by('date_played'))
-        
-        if not all_matches_chrono:
-            return []
-
-        # Create a map of match.id to the calculated change
-        trueskill_change_map = {}
-
-        # Function to get mu and sigma before a match
-        def get_before_ratings(match, player_obj):
-            if player_obj == match.team1_player1:
-                return match.team1_player1_trueskill_mu_before, match.team1_player1_trueskill_sigma_before
-            elif player_obj == match.team1_player2:
-                return match.team1_player2_trueskill_mu_before, match.team1_player2_trueskill_sigma_before
-            elif player_obj == match.team2_player1:
-                return match.team2_player1_trueskill_mu_before, match.team2_player1_trueskill_sigma_before
-            elif player_obj == match.team2_player2:
-                return match.team2_player2_trueskill_mu_before, match.team2_player2_trueskill_sigma_before
-            return None, None
-
-        for i, match in enumerate(all_matches_chrono):
-            mu_before, sigma_before = get_before_ratings(match, player)
-            
-            mu_after, sigma_after = (None, None)
-            if i + 1 < len(all_matches_chrono):
-                next_match = all_matches_chrono[i+1]
-                mu_after, sigma_after = get_before_ratings(next_match, player)
-            else:
-                # For the last match, the "after" is the player's current TrueSkill
-                mu_after, sigma_after = player.trueskill_mu, player.effective_trueskill_sigma
-
-            if mu_before is not None and sigma_before is not None and mu_after is not None and sigma_after is not None:
-                score_before = mu_before - 3 * sigma_before
-                score_after = mu_after - 3 * sigma_after
-                change = score_after - score_before
-                trueskill_change_map[match.id] = change
-
-        # Annotate the original (desc ordered) match list
-        annotated_matches = []
-        for match in matches:
-            match.trueskill_change = trueskill_change_map.get(match.id)
-            annotated_matches.append(match)
-            
-        return annotated_matches
-
-    def generate_trueskill_history(self, player):
-        """Generate historical TrueSkill progression for chart display"""
-        current_year = timezone.now().year
-        # Get only current year matches involving this player in chronological order
-        matches = Match.objects.filter(
-            Q(team1_player1=player) | Q(team1_player2=player) | 
-            Q(team2_player1=player) | Q(team2_player2=player),
-            year=current_year
-        ).distinct().order_by('date_played')
-        
-        if not matches.exists():
-            return []
-
-        history = []
-
-        def get_before_ratings(match, player_obj):
-            if player_obj == match.team1_player1:
-                return match.team1_player1_trueskill_mu_before, match.team1_player1_trueskill_sigma_before
-            elif player_obj == match.team1_player2:
-                return match.team1_player2_trueskill_mu_before, match.team1_player2_trueskill_sigma_before
-            elif player_obj == match.team2_player1:
-                return match.team2_player1_trueskill_mu_before, match.team2_player1_trueskill_sigma_before
-            elif player_obj == match.team2_player2:
-                return match.team2_player2_trueskill_mu_before, match.team2_player2_trueskill_sigma_before
-            return None, None
-
-        # Add starting point from the first match
-        first_match = matches.first()
-        start_mu, start_sigma = get_before_ratings(first_match, player)
-
-        # The very first point in history is the state *before* the first match.
-        history.append({
-            'date': first_match.date_played.strftime('%Y-%m-%d'),
-            'mu': start_mu,
-            'sigma': start_sigma,
-            'match_id': None,
-            'won': None,
-            'is_starting_point': True
-        })
 
-        # Process each match to build TrueSkill progression
-        for i, match in enumerate(matches):
-            mu_after, sigma_after = (None, None)
-            if i + 1 < len(matches):
-                next_match = matches[i+1]
-                mu_after, sigma_after = get_before_ratings(next_match, player)
-            else:
-                mu_after, sigma_after = player.trueskill_mu, player.effective_trueskill_sigma
+class PlayerSearchView(View):
+    """Players whose name contains ?q=, as JSON, for typeahead filters"""
+    max_results = 20
+    
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '').strip()
+        players = Player.objects.filter(name__icontains=query).order_by('name', 'pk') if query else Player.objects.none()
+        return JsonResponse({'players': list(players.values('id', 'name')[:self.max_results])})
 
-            player_won = (
-                (player in [match.team1_player1, match.team1_player2] and match.result == 'team1_win') or
-                (player in [match.team2_player1, match.team2_player2] and match.result == 'team2_win')
-            )
 
-            history.append({
-                'date': match.date_played.strftime('%Y-%m-%d'),
-                'mu': mu_after,
-                'sigma': sigma_after,
-                'match_id': match.id,
-                'won': player_won,
-                'is_starting_point': False
-            })
+class PlayerHistoryView(View):
+    """
+    A player's TrueSkill history for a year as JSON, downsampled to ?points=
+    (default CHART_POINTS) and delta-encoded, or as plain columns with
+    ?encoding=columns.
+    """
 
-        return history
+    def get(self, request, pk):
+        player = get_object_or_404(Player, pk=pk)
+        try:
+            year = int(request.GET.get('year', timezone.now().year))
+            points = int(request.GET.get('points', CHART_POINTS))
+        except ValueError:
+            return JsonResponse({'error': "year and points must be numbers"}, status=400)
+        encoding = request.GET.get('encoding', 'delta')
+        if not 3 <= points <= MAX_CHART_POINTS:
+            return JsonResponse({'error': f"points must be between 3 and {MAX_CHART_POINTS}"}, status=400)
+        if encoding not in ENCODINGS:
+            return JsonResponse({'error': f"encoding must be one of {', '.join(ENCODINGS)}"}, status=400)
+
+        events = list(
+            RatingEvent.objects.filter(player=player, year=year).order_by('date_played', 'match_id').only(
+                'date_played', 'match_id', 'won', 'trueskill_mu_before', 'trueskill_sigma_before',
+                'trueskill_mu_after', 'trueskill_sigma_after',
+            )
+        )
+        payload = chart_payload(history_columns(events), points, encoding)
+        return JsonResponse({'player': player.pk, 'year': year, **payload})
+
+
+class HeadToHeadView(View):
+    """Record of two players as partners and as opponents, from the first player's side, as JSON"""
+
+    def get(self, request, pk, other_pk):
+        player = get_object_or_404(Player, pk=pk)
+        other = get_object_or_404(Player, pk=other_pk)
+        records = PairRecord.objects.between(player, other)
+        year = request.GET.get('year')
+        if year:
+            if not year.isdigit():
+                return JsonResponse({'error': "year must be a number"}, status=400)
+            records = records.filter(year=int(year))
+
+        totals = {
+            relation: {'played': 0, 'won': 0, 'lost': 0, 'last_played': None}
+            for relation in PairRecord.Relation.values
+        }
+        for record in records:
+            won = record.won
+            if player.pk > other.pk and record.relation == PairRecord.Relation.OPPONENT:
+                won = record.played - won
+            total = totals[record.relation]
+            total['played'] += record.played
+            total['won'] += won
+            total['lost'] += record.played - won
+            if record.last_played and (total['last_played'] is None or record.last_played > total['last_played']):
+                total['last_played'] = record.last_played
+
+        return JsonResponse({
+            'player': {'id': player.pk, 'name': player.name},
+            'other': {'id': other.pk, 'name': other.name},
+            'year': int(year) if year else None,
+            'as_partners': totals[PairRecord.Relation.PARTNER],
+            'as_opponents': totals[PairRecord.Relation.OPPONENT],
+        })
 
 
 class PlayerCreateView(LoginRequiredMixin, CreateView):
@@ -201,6 +166,7 @@ class PlayerCreateView(LoginRequiredMixin, CreateView):
     
     def form_valid(self, form):
         messages.success(self.request, f"Player {form.instance.name} created successfully.")
+        bump_league_version()
         return super().form_valid(form)
 
 class PlayerUpdateView(LoginRequiredMixin, UpdateView):
@@ -217,13 +183,86 @@ class PlayerUpdateView(LoginRequiredMixin, UpdateView):
     
     def form_valid(self, form):
         messages.success(self.request, f"Player {form.instance.name} updated successfully.")
+        bump_league_version()
+        if 'name' in form.changed_data:
+            # The name shows on the pages of everyone who played with or against them
+            invalidate_player_pages()
         return super().form_valid(form)
 
 class MatchListView(ListView):
     model = Match
     template_name = 'core/match_list.html'
     context_object_name = 'matches'
-    ordering = ['-date_played'] # Show most recent matches first
+    page_size = 50
+    
+    def get_queryset(self):
+        # Show most recent matches first, keyset-paginated on (date_played, id) so every
+        # page costs the same number of queries however deep it is
+        queryset = Match.objects.select_related(
+            'team1_player1', 'team1_player2', 'team2_player1', 'team2_player2'
+        ).order_by('-date_played', '-id')
+        
+        self.year = self.get_int_param('year')
+        self.player_id = self.get_int_param('player')
+        if self.year is not None:
+            queryset = queryset.filter(year=self.year)
+        if self.player_id is not None:
+            queryset = queryset.involving(self.player_id)
+        
+        cursor = self.parse_cursor(self.request.GET.get('before'))
+        if cursor is not None:
+            date_played, match_id = cursor
+            queryset = queryset.filter(Q(date_played__lt=date_played) | Q(date_played=date_played, id__lt=match_id))
+        
+        # Fetch one extra row to know whether there is an older page
+        matches = list(queryset[:self.page_size + 1])
+        self.has_next_page = len(matches) > self.page_size
+        return matches[:self.page_size]
+    
+    def get_int_param(self, name):
+        try:
+            return int(self.request.GET[name])
+        except (KeyError, ValueError):
+            return None
+    
+    @staticmethod
+    def parse_cursor(value):
+        """Parses a 'before' cursor of the form '<date_played isoformat>_<id>'"""
+        if not value:
+            return None
+        date_str, _, id_str = value.rpartition('_')
+        try:
+            return datetime.fromisoformat(date_str), int(id_str)
+        except ValueError:
+            return None
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        matches = context['matches']
+        
+        filters = {}
+        if self.year is not None:
+            filters['year'] = self.year
+        if self.player_id is not None:
+            filters['player'] = self.player_id
+        
+        context['next_page_url'] = None
+        if self.has_next_page:
+            last = matches[-1]
+            params = dict(filters, before=f"{last.date_played.isoformat()}_{last.pk}")
+            context['next_page_url'] = f"?{urlencode(params)}"
+        context['first_page_url'] = f"?{urlencode(filters)}" if filters else '?'
+        context['is_first_page'] = 'before' not in self.request.GET
+        
+        context['selected_year'] = self.year
+        context['selected_player'] = self.player_id
+        context['years'] = get_or_build('match-years', Match.objects.years)
+        # The player filter is a typeahead over PlayerSearchView; only the selected name is needed
+        context['selected_player_name'] = (
+            Player.objects.filter(pk=self.player_id).values_list('name', flat=True).first()
+            if self.player_id is not None else ''
+        )
+        return context
 
 class MatchDetailView(DetailView):
     model = Match
@@ -241,6 +280,16 @@ class MatchDetailView(DetailView):
         # Calculate win probability using ELO formula with historical data
         expected_team1_win = 1 / (1 + 10 ** ((team2_avg_elo - team1_avg_elo) / 400))
         expected_team2_win = 1 - expected_team1_win
+        
+        # TrueSkill's view of the same matchup, from the stored rating snapshots
+        from .ratings import win_probabilities
+        _, trueskill_team1_win = win_probabilities(
+            [[getattr(match, f'{slot}_elo_before') for slot in PLAYER_SLOTS]],
+            [[getattr(match, f'{slot}_trueskill_mu_before') for slot in PLAYER_SLOTS]],
+            [[getattr(match, f'{slot}_trueskill_sigma_before') for slot in PLAYER_SLOTS]],
+        )
+        context['team1_trueskill_win_probability'] = round(float(trueskill_team1_win[0]) * 100, 1)
+        context['team2_trueskill_win_probability'] = round(100 - context['team1_trueskill_win_probability'], 1)
           # Calculate what would have happened if the other team won
         k_factor = 32
         if match.result == match.MatchResult.TEAM1_WIN:
@@ -276,9 +325,17 @@ class MatchCreateView(LoginRequiredMixin, CreateView):
     success_url = reverse_lazy('match-list') # Redirect to match list after creation
     
     def get_initial(self):
-        """Pre-populate form with the same players and teams from the last match"""
+        """Pre-populate form with the teams picked by the matchmaker, or the same players and teams from the last match"""
         initial = super().get_initial()
         
+        # Matchmaking suggestions link here with the four player ids in the query string
+        requested = [self.request.GET.get(slot, '') for slot in PLAYER_SLOTS]
+        if all(value.isdigit() for value in requested):
+            players = Player.objects.in_bulk([int(value) for value in requested])
+            if len(players) == 4:
+                initial.update({slot: players[int(value)] for slot, value in zip(PLAYER_SLOTS, requested)})
+                return initial
+        
         # Get the most recent match
         last_match = Match.objects.order_by('-date_played').first()
         
@@ -292,47 +349,185 @@ class MatchCreateView(LoginRequiredMixin, CreateView):
         
         return initial
     
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['matchmaking_players'] = Player.objects.order_by('name').values('id', 'name')
+        return context
+    
     def form_valid(self, form):
         # The Match model's save() method handles ELO calculation and player stat updates.
         # MatchForm should validate that a player is not selected more than once.
         response = super().form_valid(form)
-        messages.success(self.request, "Match recorded successfully and ELO & TrueSkill ratings updated.")
+        if self.object.rating_pending:
+            messages.success(self.request, "Match recorded successfully; ELO & TrueSkill ratings will be updated shortly.")
+        else:
+            messages.success(self.request, "Match recorded successfully and ELO & TrueSkill ratings updated.")
         return response
 
+class MatchmakingView(LoginRequiredMixin, View):
+    """Suggests the most balanced 2v2 matchups among the players present, as JSON"""
+    max_suggestions = 20
+    
+    def get(self, request, *args, **kwargs):
+        try:
+            player_ids = {
+                int(value)
+                for values in request.GET.getlist('players')
+                for value in values.split(',') if value.strip()
+            }
+            top_k = min(int(request.GET.get('top', 5)), self.max_suggestions)
+        except ValueError:
+            return JsonResponse({'error': "players and top must be numbers"}, status=400)
+        
+        players = list(Player.objects.filter(pk__in=player_ids).with_trueskill_score().order_by('pk'))
+        if len(players) != len(player_ids):
+            return JsonResponse({'error': "Unknown player selected"}, status=400)
+        try:
+            matchups = balanced_matchups(
+                [player.trueskill_mu for player in players],
+                [player.effective_trueskill_sigma for player in players],
+                top_k=top_k,
+            )
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        
+        suggestions = []
+        for quality, indexes in matchups:
+            chosen = [players[index] for index in indexes]
+            suggestions.append({
+                'quality': round(quality, 4),
+                'team1': [{'id': player.pk, 'name': player.name} for player in chosen[:2]],
+                'team2': [{'id': player.pk, 'name': player.name} for player in chosen[2:]],
+                'url': f"{reverse_lazy('match-create')}?{urlencode(dict(zip(PLAYER_SLOTS, (p.pk for p in chosen))))}",
+            })
+        return JsonResponse({'matchups': suggestions})
+
+def has_bearer_token(request, token):
+    """Whether the request sends `token`, when one is configured, as its bearer token"""
+    return bool(token) and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+@method_decorator(csrf_exempt, name='dispatch')
+class WinProbabilityView(View):
+    """
+    Predicts many hypothetical 2v2 matchups from current ratings in one pass.
+    
+    POST {"matchups": [[team1_player1, team1_player2, team2_player1, team2_player2], ...]}
+    with player ids, as a logged-in user or with the PREDICTIONS_TOKEN setting
+    as a bearer token; read-only, so scripts need no CSRF token.
+    """
+    max_matchups = 1000
+    
+    def post(self, request, *args, **kwargs):
+        if not (request.user.is_authenticated or has_bearer_token(request, settings.PREDICTIONS_TOKEN)):
+            return JsonResponse({'error': 'Log in or send the predictions token'}, status=403)
+        try:
+            matchups = json.loads(request.body)['matchups']
+        except (ValueError, TypeError, KeyError):
+            return JsonResponse({'error': 'Expected a JSON object with a "matchups" list'}, status=400)
+        
+        if not isinstance(matchups, list) or not matchups:
+            return JsonResponse({'error': '"matchups" must be a non-empty list'}, status=400)
+        if len(matchups) > self.max_matchups:
+            return JsonResponse({'error': f"At most {self.max_matchups} matchups per request"}, status=400)
+        for index, matchup in enumerate(matchups):
+            # Ids past the int64 range would overflow NumPy in predict_matchups()
+            if (not isinstance(matchup, list) or len(matchup) != 4
+                    or not all(type(player_id) is int and 0 < player_id < 2 ** 63 for player_id in matchup)
+                    or len(set(matchup)) != 4):
+                return JsonResponse({'error': f"Matchup {index} must be a list of four distinct player ids"}, status=400)
+        
+        try:
+            elo_expected, trueskill_expected, quality = predict_matchups(matchups)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        
+        return JsonResponse({'predictions': [
+            {
+                'players': matchup,
+                'elo_team1_win_probability': round(elo, 4),
+                'trueskill_team1_win_probability': round(trueskill_win, 4),
+                'quality': round(match_quality, 4),
+            }
+            for matchup, elo, trueskill_win, match_quality in zip(matchups, elo_expected, trueskill_expected, quality)
+        ]})
+
 class RankingListView(ListView):
     model = Player
     template_name = 'core/ranking_list.html' # Template to display player rankings
     context_object_name = 'players'
+    # Sort option -> attribute ordered on; properties are sorted on their SQL annotations
+    SORT_FIELDS = {
+        'trueskill_score': 'conservative_score',
+        'elo_rating': 'elo_rating',
+        'matches_won': 'matches_won',
+        'matches_played': 'matches_played',
+        'win_percentage': 'win_rate',
+    }
+    # A past day's standings only change when matches before it do, which bumps the league version
+    AS_OF_MAX_AGE = 24 * 60 * 60
+    
+    def get(self, request, *args, **kwargs):
+        self.as_of = None
+        as_of = request.GET.get('as_of')
+        if as_of:
+            try:
+                self.as_of = parse_date(as_of)
+            except ValueError:
+                pass
+            if self.as_of is None:
+                messages.error(request, f"'{as_of}' is not a date (YYYY-MM-DD); showing the current rankings.")
+            elif self.as_of >= timezone.localdate():
+                # Today's standings are the current ones
+                self.as_of = None
+        return super().get(request, *args, **kwargs)
     
     def get_queryset(self):
         sort_by = self.request.GET.get('sort', 'trueskill_score') # Default sort: trueskill_score
         direction = self.request.GET.get('direction', 'desc') # Default direction: descending
-        
-        # Handle sorting by properties (win_percentage, trueskill_score)
-        if sort_by in ['win_percentage', 'trueskill_score']:
-            # For properties, we need to use Python sorting since they're computed properties
-            return Player.objects.all()
-        
-        order_by_field = f"{'-' if direction == 'desc' else ''}{sort_by}"
-        return Player.objects.all().order_by(order_by_field)
+        if sort_by not in self.SORT_FIELDS:
+            sort_by = 'trueskill_score'
+        direction = 'desc' if direction == 'desc' else 'asc'
+        
+        current = self.current_rankings(sort_by, direction)
+        if self.as_of is None:
+            return current
+        
+        # Ties keep player id order, as in the SQL ordering
+        order_field = self.SORT_FIELDS[sort_by]
+        players = sorted(self.standings_as_of(self.as_of), key=attrgetter(order_field), reverse=direction == 'desc')
+        current_ranks = {player.pk: rank for rank, player in enumerate(current, 1)}
+        for rank, player in enumerate(players, 1):
+            # Positive when the player has climbed since
+            player.rank_movement = rank - current_ranks[player.pk] if player.pk in current_ranks else None
+        return players
+    
+    def current_rankings(self, sort_by, direction):
+        queryset = Player.objects.all()
+        if sort_by == 'trueskill_score':
+            queryset = queryset.with_trueskill_score()
+        elif sort_by == 'win_percentage':
+            queryset = queryset.with_win_percentage()
+        
+        order_field = self.SORT_FIELDS[sort_by]
+        return get_or_build(f'rankings:{sort_by}:{direction}', lambda: list(
+            queryset.order_by(f"{'-' if direction == 'desc' else ''}{order_field}", 'pk')
+        ))
+    
+    def standings_as_of(self, day):
+        """Everyone's standing at the end of `day`, from the rating checkpoints; cached per day"""
+        moment = timezone.make_aware(datetime.combine(day, time.max))
+        return get_or_build(
+            f'rankings:as_of:{day.isoformat()}', lambda: standings_at(moment), max_age=self.AS_OF_MAX_AGE
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         sort_by = self.request.GET.get('sort', 'trueskill_score')
         direction = self.request.GET.get('direction', 'desc')
         
-        # Handle property-based sorting in context
-        if sort_by == 'win_percentage':
-            players = list(Player.objects.all())
-            players.sort(key=lambda p: p.win_percentage, reverse=(direction == 'desc'))
-            context['players'] = players
-        elif sort_by == 'trueskill_score':
-            players = list(Player.objects.all())
-            players.sort(key=lambda p: p.trueskill_score, reverse=(direction == 'desc'))
-            context['players'] = players
-        
         context['current_sort'] = sort_by
         context['current_direction'] = direction
+        context['as_of'] = self.as_of
         
         # Add archive-related context
         current_year = timezone.now().year
@@ -446,62 +641,13 @@ class EloRecomputeView(View):
         current_year = timezone.now().year
         
         try:
-            with transaction.atomic():
-                # Reset all players to default ELO, TrueSkill, and stats
-                Player.objects.all().update(
-                    elo_rating=1000,
-                    trueskill_mu=TRUESKILL_DEFAULT_MU,
-                    trueskill_sigma=TRUESKILL_DEFAULT_SIGMA,
-                    matches_played=0,
-                    matches_won=0,
-                    matches_lost=0,
-                    last_match_date=None
-                )
-                
-                # Reset match ELO changes and snapshots for current year only
-                Match.objects.filter(year=current_year).update(
-                    elo_change=0,
-                    team1_player1_elo_before=0,
-                    team1_player2_elo_before=0,
-                    team2_player1_elo_before=0,
-                    team2_player2_elo_before=0,
-                    team1_player1_trueskill_mu_before=TRUESKILL_DEFAULT_MU,
-                    team1_player1_trueskill_sigma_before=TRUESKILL_DEFAULT_SIGMA,
-                    team1_player2_trueskill_mu_before=TRUESKILL_DEFAULT_MU,
-                    team1_player2_trueskill_sigma_before=TRUESKILL_DEFAULT_SIGMA,
-                    team2_player1_trueskill_mu_before=TRUESKILL_DEFAULT_MU,
-                    team2_player1_trueskill_sigma_before=TRUESKILL_DEFAULT_SIGMA,
-                    team2_player2_trueskill_mu_before=TRUESKILL_DEFAULT_MU,
-                    team2_player2_trueskill_sigma_before=TRUESKILL_DEFAULT_SIGMA,
-                )
-                
-                # Process only current year matches in chronological order
-                matches = Match.objects.filter(year=current_year).order_by('date_played')
-                
-                for match in matches:
-                    # Refresh player data from database to get current ELO ratings
-                    match.team1_player1.refresh_from_db()
-                    match.team1_player2.refresh_from_db()
-                    match.team2_player1.refresh_from_db()
-                    match.team2_player2.refresh_from_db()
-                    
-                    # Capture ELO snapshots before processing this match
-                    match.capture_elo_snapshots()
-                    
-                    # Update player stats and save the match with snapshots
-                    match._stats_updated = False
-                    match.update_player_stats()
-                    
-                    # Save the match with updated snapshots and elo_change
-                    match.save(update_fields=['elo_change', 'team1_player1_elo_before', 
-                                            'team1_player2_elo_before', 'team2_player1_elo_before', 
-                                            'team2_player2_elo_before', 'team1_player1_trueskill_mu_before',
-                                            'team1_player1_trueskill_sigma_before', 'team1_player2_trueskill_mu_before',
-                                            'team1_player2_trueskill_sigma_before', 'team2_player1_trueskill_mu_before',
-                                            'team2_player1_trueskill_sigma_before', 'team2_player2_trueskill_mu_before',
-                                            'team2_player2_trueskill_sigma_before'])
-                
-                messages.success(request, f"ELO and TrueSkill ratings for {current_year} have been recomputed successfully. Processed {matches.count()} matches.")
+            result = recompute_year(current_year)
+            messages.success(
+                request,
+                f"ELO and TrueSkill ratings for {current_year} have been recomputed successfully. "
+                f"Processed {result.matches} matches in {result.elapsed:.2f}s "
+                f"({result.matches_per_second:.0f} matches/s)."
+            )
         except Exception as e:
             messages.error(request, f"Error recomputing ELO and TrueSkill ratings: {str(e)}")
         
@@ -522,6 +668,9 @@ Archive functionality views - to be added to views.py
 @method_decorator(user_passes_test(lambda u: u.is_superuser), name='dispatch')
 class ArchiveYearView(View):
     """Admin-only view to archive a year's data"""
+    STATISTICS_CHUNK_SIZE = 2000
+    PARTNERSHIPS_SHOWN = 10
+    MIN_PARTNERSHIP_MATCHES = 5
     
     def post(self, request, *args, **kwargs):
         year_to_archive = int(request.POST.get('year'))
@@ -535,63 +684,60 @@ class ArchiveYearView(View):
         if YearArchive.objects.filter(year=year_to_archive).exists():
             messages.error(request, f"Year {year_to_archive} has already been archived.")
             return redirect('rankings')
+
+        if pending_ratings().filter(year=year_to_archive).exists():
+            messages.error(request, f"Year {year_to_archive} still has matches waiting for their ratings; try again shortly.")
+            return redirect('rankings')
         
         try:
-            with transaction.atomic():
+            with timed('archive_year'), transaction.atomic():
+                # Every player is reset below; wait for matches being rated right now
+                Player.objects.lock()
+
                 # Create the archive record
                 archive = YearArchive.objects.create(
                     year=year_to_archive
                 )
                 
-                # Get all matches from that year
-                year_matches = Match.objects.filter(year=year_to_archive)
-                archive.total_matches = year_matches.count()
+                # Snapshot everyone who played in that year, in one query and one insert
+                player_ids = MatchParticipant.objects.filter(year=year_to_archive).values('player_id')
+                players = list(Player.objects.filter(id__in=player_ids).values(
+                    'id', 'elo_rating', 'trueskill_mu', 'trueskill_sigma',
+                    'matches_played', 'matches_won', 'matches_lost',
+                    player_name=F('name'), player_email=F('email'),
+                ))
                 
                 # Calculate statistics before archiving
-                statistics = self.calculate_year_statistics(year_to_archive, year_matches)
+                statistics = self.calculate_year_statistics(year_to_archive, players)
                 archive.statistics = statistics
+                archive.total_matches = statistics['total_matches']
                 
-                # Get all players who played in that year
-                player_ids = set()
-                for match in year_matches:
-                    player_ids.add(match.team1_player1.id)
-                    player_ids.add(match.team1_player2.id)
-                    player_ids.add(match.team2_player1.id)
-                    player_ids.add(match.team2_player2.id)
-                
-                players = Player.objects.filter(id__in=player_ids)
-                archive.total_players = players.count()
-                
-                # Archive player statistics
-                for player in players:
-                    ArchivedPlayerStats.objects.create(
-                        archive=archive,
-                        player_name=player.name,
-                        player_email=player.email,
-                        elo_rating=player.elo_rating,
-                        trueskill_mu=player.trueskill_mu,
-                        trueskill_sigma=player.trueskill_sigma,
-                        matches_played=player.matches_played,
-                        matches_won=player.matches_won,
-                        matches_lost=player.matches_lost,
-                    )
+                player_stats = ArchivedPlayerStats.objects.bulk_create(
+                    [
+                        ArchivedPlayerStats(archive=archive, **{key: value for key, value in row.items() if key != 'id'})
+                        for row in players
+                    ],
+                    batch_size=1000,
+                )
+                archive.total_players = len(player_stats)
                 
                 # Reset all players' stats for the new year
-                Player.objects.all().update(
-                    elo_rating=1000,
-                    trueskill_mu=TRUESKILL_DEFAULT_MU,
-                    trueskill_sigma=TRUESKILL_DEFAULT_SIGMA,
-                    matches_played=0,
-                    matches_won=0,
-                    matches_lost=0,
-                    last_match_date=None,
-                    current_year=current_year
-                )
+                Player.objects.reset_ratings(current_year=current_year)
                 
-                # Update all future year matches to current year
-                Match.objects.filter(year__gt=year_to_archive).update(year=current_year)
+                # Update all future year matches to current year, skipping rows that already are
+                later_years = {'year__gt': year_to_archive, 'year__lt': current_year}
+                if Match.objects.filter(**later_years).update(year=current_year):
+                    MatchParticipant.objects.filter(**later_years).update(year=current_year)
+                    RatingEvent.objects.filter(**later_years).update(year=current_year)
+                    # Pair records of the merged seasons are recounted as part of this one
+                    PairRecord.objects.filter(**later_years).delete()
+                    rebuild_pair_records(current_year)
+                    # Checkpoints of the merged seasons miss each other's matches
+                    RatingCheckpoint.objects.filter(year__gt=year_to_archive).delete()
                 
                 archive.save()
+                bump_league_version()
+                invalidate_player_pages()
                 
                 messages.success(
                     request, 
@@ -627,39 +773,111 @@ class ArchiveYearView(View):
             'unarchived_years': list(unarchived_years),
         })
     
-    def calculate_year_statistics(self, year, matches):
-        """Calculate comprehensive statistics for the year"""
-        from collections import defaultdict
-        from datetime import datetime
-        
-        stats = {
-            'total_matches': matches.count(),
-            'matches_by_month': defaultdict(int),
-            'matches_by_day': defaultdict(int),
-            'player_partnerships': defaultdict(int),
-            'longest_winning_streak': {},
-            'most_matches_in_day': {'date': None, 'count': 0},
+    def calculate_year_statistics(self, year, players):
+        """
+        Calculate comprehensive statistics for the year from a single GROUP BY over
+        match days and one streaming pass for partnerships and streaks
+        """
+        from django.db.models import Count
+        from django.db.models.functions import TruncDate
+        
+        matches_by_day = {
+            day.strftime('%Y-%m-%d'): count
+            for day, count in Match.objects.filter(year=year)
+            .annotate(day=TruncDate('date_played'))
+            .values('day')
+            .annotate(count=Count('id'))
+            .order_by('day')
+            .values_list('day', 'count')
         }
         
-        # Calculate matches by month and day
-        for match in matches:
-            month_key = match.date_played.strftime('%Y-%m')
-            stats['matches_by_month'][month_key] += 1
-            
-            day_key = match.date_played.strftime('%Y-%m-%d')
-            stats['matches_by_day'][day_key] += 1
+        # Months are rolled up from the (at most 366) days rather than queried again
+        matches_by_month = {}
+        for day, count in matches_by_day.items():
+            matches_by_month[day[:7]] = matches_by_month.get(day[:7], 0) + count
         
         # Find day with most matches
-        if stats['matches_by_day']:
-            max_day = max(stats['matches_by_day'].items(), key=lambda x: x[1])
-            stats['most_matches_in_day'] = {'date': max_day[0], 'count': max_day[1]}
+        most_matches_in_day = {'date': None, 'count': 0}
+        if matches_by_day:
+            max_day = max(matches_by_day.items(), key=lambda x: x[1])
+            most_matches_in_day = {'date': max_day[0], 'count': max_day[1]}
+        
+        return {
+            'total_matches': sum(matches_by_day.values()),
+            'matches_by_month': matches_by_month,
+            'matches_by_day': matches_by_day,
+            'most_matches_in_day': most_matches_in_day,
+            **self.calculate_partnerships_and_streaks(year, players),
+        }
+    
+    def calculate_partnerships_and_streaks(self, year, players):
+        """
+        Walks the year's matches once in chronological order through a server-side
+        cursor, counting matches and wins for every pair of teammates and tracking
+        each player's longest winning and losing runs. Memory grows with the number
+        of players and partnerships, never with the number of matches.
+        """
+        import heapq
+        from collections import defaultdict
         
-        # Convert defaultdicts to regular dicts for JSON serialization
-        stats['matches_by_month'] = dict(stats['matches_by_month'])
-        stats['matches_by_day'] = dict(stats['matches_by_day'])
-        stats['player_partnerships'] = dict(stats['player_partnerships'])
+        partnerships = defaultdict(lambda: [0, 0])  # (player id, player id) -> [played, won]
+        current_run = defaultdict(int)  # player id -> wins (> 0) or losses (< 0) in a row
+        longest = defaultdict(lambda: [0, 0])  # player id -> [longest winning run, longest losing run]
+        
+        matches = Match.objects.filter(year=year).order_by('date_played', 'id').values_list(*PLAYER_SLOTS, 'result')
+        for *player_ids, result in matches.iterator(chunk_size=self.STATISTICS_CHUNK_SIZE):
+            team1_won = result == Match.MatchResult.TEAM1_WIN
+            for team, won in ((player_ids[:2], team1_won), (player_ids[2:], not team1_won)):
+                partnership = partnerships[tuple(sorted(team))]
+                partnership[0] += 1
+                partnership[1] += won
+                for player_id in team:
+                    if won:
+                        run = current_run[player_id] = max(current_run[player_id], 0) + 1
+                        longest[player_id][0] = max(longest[player_id][0], run)
+                    else:
+                        run = current_run[player_id] = min(current_run[player_id], 0) - 1
+                        longest[player_id][1] = max(longest[player_id][1], -run)
+        
+        names = {player['id']: player['player_name'] for player in players}
+        emails = {player['id']: player['player_email'] for player in players}
+        
+        def describe(pair, played, won):
+            return {
+                'players': [names.get(player_id, '') for player_id in pair],
+                'matches': played,
+                'wins': won,
+                'win_rate': round(won / played * 100, 1),
+            }
+        
+        most_played = heapq.nlargest(
+            self.PARTNERSHIPS_SHOWN, partnerships.items(), key=lambda item: (item[1][0], item[1][1])
+        )
+        best = heapq.nlargest(
+            self.PARTNERSHIPS_SHOWN,
+            (item for item in partnerships.items() if item[1][0] >= self.MIN_PARTNERSHIP_MATCHES),
+            key=lambda item: (item[1][1] / item[1][0], item[1][0]),
+        )
         
-        return stats
+        def longest_streak(index):
+            if not longest:
+                return {}
+            player_id, runs = max(longest.items(), key=lambda item: item[1][index])
+            return {'player': names.get(player_id, ''), 'length': runs[index]}
+        
+        return {
+            'player_partnerships': {
+                'total': len(partnerships),
+                'most_played': [describe(pair, *counts) for pair, counts in most_played],
+                'best': [describe(pair, *counts) for pair, counts in best],
+            },
+            'longest_winning_streak': longest_streak(0),
+            'longest_losing_streak': longest_streak(1),
+            'player_streaks': {
+                emails[player_id]: {'win': runs[0], 'loss': runs[1]}
+                for player_id, runs in longest.items() if player_id in emails
+            },
+        }
 
 
 class ArchivedYearDetailView(DetailView):
@@ -678,6 +896,13 @@ class ArchivedYearDetailView(DetailView):
         player_stats = list(archive.player_stats.all())
         player_stats.sort(key=lambda p: p.trueskill_score, reverse=True)
         
+        # Longest runs are stored by email in the statistics of archives that have them
+        streaks = (archive.statistics or {}).get('player_streaks', {})
+        for player in player_stats:
+            player_streaks = streaks.get(player.player_email, {})
+            player.longest_winning_streak = player_streaks.get('win')
+            player.longest_losing_streak = player_streaks.get('loss')
+        
         context['player_stats'] = player_stats
         context['chart_data'] = self.prepare_chart_data(archive, player_stats)
         
@@ -735,3 +960,37 @@ class ArchivedYearsListView(ListView):
     template_name = 'core/archived_years_list.html'
     context_object_name = 'archives'
     ordering = ['-year']
+
+
+class ExportView(UserPassesTestMixin, View):
+    """Admin-only streaming download of matches, players or archived player stats"""
+
+    def test_func(self):
+        return self.request.user.is_superuser
+
+    def get(self, request, dataset):
+        export_format = request.GET.get('format', 'csv')
+        year = request.GET.get('year', '').strip()
+        try:
+            chunks = export(
+                dataset, export_format, year=year, since=request.GET.get('since'), until=request.GET.get('until')
+            )
+        except ExportError as e:
+            return HttpResponseBadRequest(str(e))
+
+        filename = f"zipleague-{dataset}{f'-{year}' if year else ''}.{export_format}"
+        response = StreamingHttpResponse(chunks, content_type=CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+
+class MetricsView(View):
+    """
+    Prometheus metrics of every worker, for superusers or a scraper sending
+    the METRICS_TOKEN setting as a bearer token
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not (request.user.is_superuser or has_bearer_token(request, settings.METRICS_TOKEN)):
+            return HttpResponseForbidden()
+        return HttpResponse(render_metrics() + render_queue_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
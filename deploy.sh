@@ -50,6 +50,11 @@ echo "🗄️ Applying migrations..."
 sudo docker compose exec web python manage.py migrate
 check_command "Django migrate"
 
+# Step 7: Create the shared cache table (no-op if it already exists)
+echo "🗃️ Creating cache table..."
+sudo docker compose exec web python manage.py createcachetable
+check_command "Django createcachetable"
+
 # Optional: Collect static files (uncomment if needed)
 echo "📁 Collecting static files..."
 sudo docker compose exec web python manage.py collectstatic --noinput
@@ -1,7 +1,8 @@
-from datetime import datetime
+import argparse
 import os
 import django
 import random
+import time
 from faker import Faker
 from django.utils import timezone
 
@@ -9,7 +10,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'zip_league.settings')
 django.setup()
 
 from django.contrib.auth.models import User
-from core.models import Player, Match
+from core.bulk import truncate
+from core.models import Player, Match, RatingCheckpoint, YearArchive
+from core.synthetic import generate_league, matches_per_year, year_span
 
 fake = Faker()
 
@@ -28,26 +31,31 @@ def create_players(num_players=10):
     print(f'{num_players} players created.')
     return players, player_strengths
 
-def create_matches(players, player_strengths, num_matches=200):
-    from datetime import timedelta, date
-    # Create matches throughout 2025
-    year_2025_start = date(2025, 1, 1)
-    year_2025_end = date(2025, 12, 31)
-    total_days = (year_2025_end - year_2025_start).days
-    
+def create_matches(players, player_strengths, num_matches=200, years=None):
+    years = years or [timezone.now().year]
+    # Distribute match dates evenly across each year, in chronological order
+    now = timezone.now()
+    match_dates = []
+    for year, year_matches in zip(years, matches_per_year(num_matches, years)):
+        year_start, year_end = year_span(year, now)
+        match_dates += [year_start + (year_end - year_start) * i / year_matches for i in range(year_matches)]
+
+    # Grouping logic: strong players are more likely to be grouped together.
+    # Strengths never change, so the players only need sorting once.
+    sorted_players = sorted(players, key=lambda p: player_strengths[p.pk], reverse=True)
+    split_point = len(sorted_players) * 2 // 3  # Use integer division
+
     for i in range(num_matches):
-        # Grouping logic: strong players are more likely to be grouped together
-        sorted_players = sorted(players, key=lambda p: player_strengths[p.pk], reverse=True)
+        if i and match_dates[i].year != match_dates[i - 1].year:
+            # Each year starts from default ratings, as with --bulk (and after an archive)
+            Player.objects.reset_ratings()
         # Pick 2 strong and 2 random (sometimes strong, sometimes weak)
-        split_point = len(sorted_players) * 2 // 3  # Use integer division
         team1 = random.sample(sorted_players[:split_point], 2)
         team2 = random.sample(sorted_players[split_point:], 2)
         match_players = team1 + team2
         random.shuffle(match_players)
-        team1_player1 = Player.objects.get(pk=match_players[0].id)
-        team1_player2 = Player.objects.get(pk=match_players[1].id)
-        team2_player1 = Player.objects.get(pk=match_players[2].id)
-        team2_player2 = Player.objects.get(pk=match_players[3].id)
+        # Only ids are read from these instances; each match re-reads its players' rows to rate them
+        team1_player1, team1_player2, team2_player1, team2_player2 = match_players
         team1_strength = player_strengths[team1_player1.pk] + player_strengths[team1_player2.pk]
         team2_strength = player_strengths[team2_player1.pk] + player_strengths[team2_player2.pk]
         # Probabilistic outcome: strong teams win more often, but not always
@@ -59,10 +67,6 @@ def create_matches(players, player_strengths, num_matches=200):
         else:
             team2_score = random.randint(6, 10)
             team1_score = random.randint(0, team2_score - 1)
-        # Distribute match dates evenly across 2025
-        day_offset = i % total_days
-        match_date = year_2025_start + timedelta(days=day_offset)
-        aware_date = timezone.make_aware(datetime.combine(match_date, datetime.min.time()))
         Match.objects.create(
             team1_player1=team1_player1,
             team1_player2=team1_player2,
@@ -70,7 +74,7 @@ def create_matches(players, player_strengths, num_matches=200):
             team2_player2=team2_player2,
             team1_score=team1_score,
             team2_score=team2_score,
-            date_played=aware_date
+            date_played=match_dates[i]
         )
     print(f'{num_matches} matches created.')
 
@@ -81,16 +85,45 @@ def create_admin_user():
     else:
         print('Admin user already exists.')
 
+def parse_args():
+    current_year = timezone.now().year
+    parser = argparse.ArgumentParser(description='Replace the league data with randomly generated players and matches.')
+    parser.add_argument('--players', type=int, default=10, help='Number of players (default: 10)')
+    parser.add_argument('--matches', type=int, default=200, help='Number of matches (default: 200)')
+    parser.add_argument('--years', type=int, nargs='+', default=[current_year],
+                        help=f'Years to spread the matches over (default: {current_year})')
+    parser.add_argument('--archive', type=int, nargs='*', default=[], metavar='YEAR',
+                        help='Years to archive after generating them (--bulk only)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Write everything with bulk loads and an in-memory rating replay instead of '
+                             'saving matches one by one; use this for large leagues')
+    parser.add_argument('--seed', type=int, help='Random seed, for reproducible data')
+    args = parser.parse_args()
+    args.years = sorted(set(args.years))
+    if any(year not in args.years for year in args.archive):
+        parser.error('--archive years must be among --years')
+    if args.archive and not args.bulk:
+        parser.error('--archive requires --bulk')
+    if args.players < 4:
+        parser.error('at least 4 players are needed to play a match')
+    return args
+
 def main():
+    args = parse_args()
+    random.seed(args.seed)
+    Faker.seed(args.seed)
     print('Seeding database...')
-    Player.objects.all().delete()
-    Match.objects.all().delete()
+    start = time.perf_counter()
+    truncate(Player, Match, YearArchive, RatingCheckpoint)
     User.objects.filter(is_superuser=False).delete()
-    
+
     create_admin_user()
-    players, player_strengths = create_players()
-    create_matches(players, player_strengths)
-    print('Database seeded successfully!')
+    if args.bulk:
+        generate_league(args.players, args.matches, args.years, archived_years=args.archive, seed=args.seed, log=print)
+    else:
+        players, player_strengths = create_players(args.players)
+        create_matches(players, player_strengths, args.matches, args.years)
+    print(f'Database seeded successfully in {time.perf_counter() - start:.1f}s!')
 
 if __name__ == '__main__':
     main()
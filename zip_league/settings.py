@@ -42,12 +42,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    'core.profiling.ProfilerMiddleware',
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -64,6 +66,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "core.context_processors.rating_queue",
             ],
         },
     },
@@ -86,6 +89,49 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Must be shared by all gunicorn workers; the database backend needs `manage.py createcachetable`
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'zip_league_cache'),
+    }
+}
+if CACHES['default']['BACKEND'].endswith(('DatabaseCache', 'LocMemCache', 'FileBasedCache')):
+    # Every player's page is an entry of its own, far more than the default cap of 300
+    CACHES['default']['OPTIONS'] = {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 20000))}
+
+
+# Metrics
+# Each worker writes its counters to its own file in METRICS_DIR (default: a temp
+# directory) and /metrics sums them; scrapers authenticate with METRICS_TOKEN
+
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
+# Win predictions
+# Scripts without a login session call /matches/predictions/ with `Authorization: Bearer <PREDICTIONS_TOKEN>`
+
+PREDICTIONS_TOKEN = os.environ.get('PREDICTIONS_TOKEN', '')
+
+
+# Rating queue
+# With RATING_QUEUE on, submitted matches are saved unrated and `manage.py
+# process_rating_queue` applies their ratings in the background
+
+RATING_QUEUE = os.environ.get('RATING_QUEUE', 'False').lower() == 'true'
+
+
+# Rating checkpoints
+# The league's ratings are checkpointed at the end of each day with matches, and
+# also every RATING_CHECKPOINT_INTERVAL matches within a day
+
+RATING_CHECKPOINT_INTERVAL = int(os.environ.get('RATING_CHECKPOINT_INTERVAL', 1000))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 